@@ -20,14 +20,13 @@
 #
 ###############################################################################
 
-import psycopg2
-import psycopg2.extras
-
 from distutils.util import strtobool as dustrtobool
 
 import daemon_lib.common as pvc_common
 import daemon_lib.ceph as pvc_ceph
 
+from pvcapid.database import open_database, close_database, database
+
 config = None  # Set in this namespace by flaskapi
 
 
@@ -64,30 +63,6 @@ class BenchmarkError(Exception):
     def __str__(self):
         return str(self.message)
 
-#
-# Common functions
-#
-
-
-# Database connections
-def open_database(config):
-    conn = psycopg2.connect(
-        host=config['database_host'],
-        port=config['database_port'],
-        dbname=config['database_name'],
-        user=config['database_user'],
-        password=config['database_password']
-    )
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    return conn, cur
-
-
-def close_database(conn, cur, failed=False):
-    if not failed:
-        conn.commit()
-    cur.close()
-    conn.close()
-
 
 def list_benchmarks(job=None):
     if job is not None:
@@ -97,18 +72,17 @@ def list_benchmarks(job=None):
         query = "SELECT * FROM {} ORDER BY id DESC;".format('storage_benchmarks')
         args = ()
 
-    conn, cur = open_database(config)
-    cur.execute(query, args)
-    orig_data = cur.fetchall()
-    data = list()
-    for benchmark in orig_data:
-        benchmark_data = dict()
-        benchmark_data['id'] = benchmark['id']
-        benchmark_data['job'] = benchmark['job']
-        benchmark_data['benchmark_result'] = benchmark['result']
-        # Append the new data to our actual output structure
-        data.append(benchmark_data)
-    close_database(conn, cur)
+    with database(config) as (conn, cur):
+        cur.execute(query, args)
+        orig_data = cur.fetchall()
+        data = list()
+        for benchmark in orig_data:
+            benchmark_data = dict()
+            benchmark_data['id'] = benchmark['id']
+            benchmark_data['job'] = benchmark['job']
+            benchmark_data['benchmark_result'] = benchmark['result']
+            # Append the new data to our actual output structure
+            data.append(benchmark_data)
     if data:
         return data, 200
     else:
@@ -138,6 +112,7 @@ def run_benchmark(self, pool):
         zk_conn = pvc_common.startZKConnection(config['coordinators'])
     except Exception:
         print('FATAL - failed to connect to Zookeeper')
+        close_database(db_conn, db_cur, failed=True)
         raise Exception
 
     print("Storing running status for job '{}' in database".format(cur_time))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# database.py - PVC API provisioner database connections
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2020 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import os
+import threading
+
+import psycopg2
+import psycopg2.extras
+
+from contextlib import contextmanager
+
+# Number of idle connections each process keeps open for reuse
+database_pool_size = 16
+
+# The idle connections of the current process; the API daemon and each Celery worker process have their own,
+# since connections cannot be shared across a fork. Checked-out connections are not tracked, so one that a
+# caller never returns is simply closed by the garbage collector and replaced, rather than exhausting the pool.
+idle_connections = list()
+idle_pid = None
+idle_lock = threading.Lock()
+
+
+def connect_database(config):
+    return psycopg2.connect(
+        host=config['database_host'],
+        port=config['database_port'],
+        dbname=config['database_name'],
+        user=config['database_user'],
+        password=config['database_password'],
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3
+    )
+
+
+def get_idle_connection():
+    global idle_pid
+    with idle_lock:
+        if idle_pid != os.getpid():
+            # Inherited connections belong to the parent process; forget them without closing them
+            idle_connections.clear()
+            idle_pid = os.getpid()
+        if idle_connections:
+            return idle_connections.pop()
+        return None
+
+
+def connection_is_alive(conn):
+    # conn.closed is only set after a failed operation, so a connection the server dropped (e.g. across a
+    # Postgres restart) must be tested with a real query
+    if conn.closed:
+        return False
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1;")
+        conn.rollback()
+        return True
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        return False
+
+
+# Database connections
+def open_database(config):
+    conn = get_idle_connection()
+    while conn is not None and not connection_is_alive(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        conn = get_idle_connection()
+    if conn is None:
+        conn = connect_database(config)
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    return conn, cur
+
+
+def close_database(conn, cur, failed=False):
+    try:
+        if not failed:
+            conn.commit()
+        else:
+            conn.rollback()
+        cur.close()
+    except Exception:
+        # A connection in an unknown state is not reused
+        conn.close()
+        raise
+    finally:
+        if not conn.closed:
+            with idle_lock:
+                if idle_pid == os.getpid() and len(idle_connections) < database_pool_size:
+                    idle_connections.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+
+
+@contextmanager
+def database(config):
+    """
+    Open a database connection for a with block, committing it if the block completes and rolling it back
+    if the block raises; the connection is returned to the pool either way
+    """
+    conn, cur = open_database(config)
+    try:
+        yield conn, cur
+    except Exception:
+        try:
+            close_database(conn, cur, failed=True)
+        except Exception:
+            pass
+        raise
+    close_database(conn, cur)
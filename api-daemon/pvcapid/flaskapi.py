@@ -203,11 +203,21 @@ def create_vm(self, vm_name, profile_name, define_vm=True, start_vm=True, script
     return api_provisioner.create_vm(self, vm_name, profile_name, define_vm=define_vm, start_vm=start_vm, script_run_args=script_run_args)
 
 
+@celery.task(bind=True)
+def create_vm_batch(self, name_pattern, profile_name, count, start_index=1, define_vm=True, start_vm=True, script_run_args=[], concurrency=None, pool_concurrency=None, node_concurrency=None):
+    return api_provisioner.create_vm_batch(self, name_pattern, profile_name, count, start_index=start_index, define_vm=define_vm, start_vm=start_vm, script_run_args=script_run_args, concurrency=concurrency, pool_concurrency=pool_concurrency, node_concurrency=node_concurrency)
+
+
 @celery.task(bind=True)
 def run_benchmark(self, pool):
     return api_benchmark.run_benchmark(self, pool)
 
 
+@celery.task(bind=True)
+def flatten_volume(self, pool, volume):
+    return api_helper.ceph_volume_flatten(pool, volume)
+
+
 ##########################################################
 # API Root/Authentication
 ##########################################################
@@ -1458,6 +1468,9 @@ class API_VM_Metadata(Resource):
                 migration_method:
                   type: string
                   description: The preferred migration method (live, shutdown, none)
+                recovery_priority:
+                  type: integer
+                  description: The priority of the VM when recovering from a fenced node; higher values are restarted first
           404:
             description: Not found
             schema:
@@ -1472,6 +1485,7 @@ class API_VM_Metadata(Resource):
         {'name': 'autostart'},
         {'name': 'profile'},
         {'name': 'migration_method', 'choices': ('live', 'shutdown', 'none'), 'helptext': "A valid migration_method must be specified"},
+        {'name': 'recovery_priority'},
     ])
     @Authenticator
     def post(self, vm, reqargs):
@@ -1516,6 +1530,11 @@ class API_VM_Metadata(Resource):
               - live
               - shutdown
               - none
+          - in: query
+            name: recovery_priority
+            type: integer
+            required: false
+            description: The priority of the VM when recovering from a fenced node; higher values are restarted first
         responses:
           200:
             description: OK
@@ -1534,7 +1553,8 @@ class API_VM_Metadata(Resource):
             reqargs.get('selector', None),
             reqargs.get('autostart', None),
             reqargs.get('profile', None),
-            reqargs.get('migration_method', None)
+            reqargs.get('migration_method', None),
+            reqargs.get('recovery_priority', None)
         )
 
 
@@ -3861,7 +3881,9 @@ api.add_resource(API_Storage_Ceph_Volume_Element, '/storage/ceph/volume/<pool>/<
 # /storage/ceph/volume/<pool>/<volume>/clone
 class API_Storage_Ceph_Volume_Element_Clone(Resource):
     @RequestParser([
-        {'name': 'new_volume', 'required': True, 'helptext': "A new volume name must be specified."}
+        {'name': 'new_volume', 'required': True, 'helptext': "A new volume name must be specified."},
+        {'name': 'cow'},
+        {'name': 'flatten'}
     ])
     @Authenticator
     def post(self, pool, volume, reqargs):
@@ -3876,6 +3898,18 @@ class API_Storage_Ceph_Volume_Element_Clone(Resource):
             type: string
             required: true
             description: The name of the new cloned volume
+          - in: query
+            name: cow
+            type: boolean
+            required: false
+            default: false
+            description: Create a copy-on-write clone from a protected snapshot of the volume instead of a full copy
+          - in: query
+            name: flatten
+            type: boolean
+            required: false
+            default: false
+            description: Flatten a copy-on-write clone in a background job, detaching it from the source volume
         responses:
           200:
             description: OK
@@ -3893,12 +3927,21 @@ class API_Storage_Ceph_Volume_Element_Clone(Resource):
               type: object
               id: Message
         """
-        return api_helper.ceph_volume_clone(
+        cow = bool(strtobool(reqargs.get('cow', 'false')))
+        retdata, retcode = api_helper.ceph_volume_clone(
             pool,
             reqargs.get('new_volume', None),
-            volume
+            volume,
+            cow=cow
         )
 
+        if retcode == 200 and cow and bool(strtobool(reqargs.get('flatten', 'false'))):
+            task = flatten_volume.delay(pool, reqargs.get('new_volume', None))
+            retdata['task_id'] = task.id
+            retdata['message'] = '{}; flattening in job {}'.format(retdata['message'], task.id)
+
+        return retdata, retcode
+
 
 api.add_resource(API_Storage_Ceph_Volume_Element_Clone, '/storage/ceph/volume/<pool>/<volume>/clone')
 
@@ -3957,6 +4000,225 @@ class API_Storage_Ceph_Volume_Element_Upload(Resource):
 api.add_resource(API_Storage_Ceph_Volume_Element_Upload, '/storage/ceph/volume/<pool>/<volume>/upload')
 
 
+# /storage/ceph/volume/<pool>/<volume>/upload/session
+class API_Storage_Ceph_Volume_Element_Upload_Session_Root(Resource):
+    @RequestParser([
+        {'name': 'image_format', 'required': True, 'location': ['args'], 'helptext': "A source image format must be specified."},
+        {'name': 'size', 'required': True, 'location': ['args'], 'helptext': "A source image size in bytes must be specified."}
+    ])
+    @Authenticator
+    def post(self, pool, volume, reqargs):
+        """
+        Create a chunked upload session for Ceph volume {volume} in pool {pool}
+
+        Chunks of the image are then written with PUT requests to the session, and the upload is completed with a POST to its finalize endpoint. Sessions left idle for a day are removed when a new session is created.
+        ---
+        tags:
+          - storage / ceph
+        parameters:
+          - in: query
+            name: image_format
+            type: string
+            required: true
+            description: The type of source image file
+            enum:
+              - raw
+              - vmdk
+              - qcow2
+              - qed
+              - vdi
+              - vpc
+          - in: query
+            name: size
+            type: integer
+            required: true
+            description: The size of the source image file in bytes
+        responses:
+          200:
+            description: OK
+            schema:
+              type: object
+              id: UploadSession
+              properties:
+                session:
+                  type: string
+                  description: The ID of the upload session
+                image_format:
+                  type: string
+                  description: The type of source image file
+                size:
+                  type: integer
+                  description: The size of the source image file in bytes
+                chunks:
+                  type: array
+                  description: The [offset, length] pairs of the chunks received so far
+                  items:
+                    type: array
+                    items:
+                      type: integer
+                received:
+                  type: integer
+                  description: The total number of bytes received so far
+          400:
+            description: Bad request
+            schema:
+              type: object
+              id: Message
+        """
+        return api_helper.ceph_volume_upload_session_create(
+            pool,
+            volume,
+            reqargs.get('image_format', None),
+            reqargs.get('size', None)
+        )
+
+
+api.add_resource(API_Storage_Ceph_Volume_Element_Upload_Session_Root, '/storage/ceph/volume/<pool>/<volume>/upload/session')
+
+
+# /storage/ceph/volume/<pool>/<volume>/upload/session/<session>
+class API_Storage_Ceph_Volume_Element_Upload_Session_Element(Resource):
+    @Authenticator
+    def get(self, pool, volume, session):
+        """
+        Return the state of chunked upload session {session}, e.g. to resume it
+        ---
+        tags:
+          - storage / ceph
+        responses:
+          200:
+            description: OK
+            schema:
+              type: object
+              id: UploadSession
+          404:
+            description: Not found
+            schema:
+              type: object
+              id: Message
+        """
+        return api_helper.ceph_volume_upload_session_get(pool, volume, session)
+
+    @RequestParser([
+        {'name': 'offset', 'required': True, 'location': ['args'], 'helptext': "A chunk offset must be specified."}
+    ])
+    @Authenticator
+    def put(self, pool, volume, session, reqargs):
+        """
+        Write a chunk of the image to chunked upload session {session}
+
+        The body must be the binary contents of the chunk; it is written directly to the volume at the given offset.
+        ---
+        tags:
+          - storage / ceph
+        parameters:
+          - in: query
+            name: offset
+            type: integer
+            required: true
+            description: The byte offset of the chunk within the source image file
+        responses:
+          200:
+            description: OK
+            schema:
+              type: object
+              id: Message
+          400:
+            description: Bad request
+            schema:
+              type: object
+              id: Message
+          404:
+            description: Not found
+            schema:
+              type: object
+              id: Message
+        """
+        return api_helper.ceph_volume_upload_chunk(
+            pool,
+            volume,
+            session,
+            reqargs.get('offset', None)
+        )
+
+    @Authenticator
+    def delete(self, pool, volume, session):
+        """
+        Abort chunked upload session {session}
+        ---
+        tags:
+          - storage / ceph
+        responses:
+          200:
+            description: OK
+            schema:
+              type: object
+              id: Message
+          400:
+            description: Bad request
+            schema:
+              type: object
+              id: Message
+          404:
+            description: Not found
+            schema:
+              type: object
+              id: Message
+        """
+        return api_helper.ceph_volume_upload_session_remove(pool, volume, session)
+
+
+api.add_resource(API_Storage_Ceph_Volume_Element_Upload_Session_Element, '/storage/ceph/volume/<pool>/<volume>/upload/session/<session>')
+
+
+# /storage/ceph/volume/<pool>/<volume>/upload/session/<session>/finalize
+class API_Storage_Ceph_Volume_Element_Upload_Session_Finalize(Resource):
+    @RequestParser([
+        {'name': 'checksum', 'required': True, 'location': ['args'], 'helptext': "A SHA256 checksum of the source image must be specified."}
+    ])
+    @Authenticator
+    def post(self, pool, volume, session, reqargs):
+        """
+        Complete chunked upload session {session}
+
+        The uploaded data is verified against the checksum, converted to raw format if required, and the session is removed.
+        ---
+        tags:
+          - storage / ceph
+        parameters:
+          - in: query
+            name: checksum
+            type: string
+            required: true
+            description: The SHA256 checksum of the source image file
+        responses:
+          200:
+            description: OK
+            schema:
+              type: object
+              id: Message
+          400:
+            description: Bad request
+            schema:
+              type: object
+              id: Message
+          404:
+            description: Not found
+            schema:
+              type: object
+              id: Message
+        """
+        return api_helper.ceph_volume_upload_session_finalize(
+            pool,
+            volume,
+            session,
+            reqargs.get('checksum', None)
+        )
+
+
+api.add_resource(API_Storage_Ceph_Volume_Element_Upload_Session_Finalize, '/storage/ceph/volume/<pool>/<volume>/upload/session/<session>/finalize')
+
+
 # /storage/ceph/snapshot
 class API_Storage_Ceph_Snapshot_Root(Resource):
     @RequestParser([
@@ -6137,6 +6399,9 @@ class API_Provisioner_Profile_Root(Resource):
                   items:
                     type: string
                     description: Script install() function keyword arguments in "arg=data" format
+                image_cache:
+                  type: boolean
+                  description: Whether provisioning script output is cached and cloned for later VMs
         parameters:
           - in: query
             name: limit
@@ -6164,7 +6429,8 @@ class API_Provisioner_Profile_Root(Resource):
         {'name': 'userdata'},
         {'name': 'script'},
         {'name': 'ova'},
-        {'name': 'arg', 'action': 'append'}
+        {'name': 'arg', 'action': 'append'},
+        {'name': 'image_cache'}
     ])
     @Authenticator
     def post(self, reqargs):
@@ -6221,6 +6487,11 @@ class API_Provisioner_Profile_Root(Resource):
             name: arg
             type: string
             description: Script install() function keywork argument in "arg=data" format; may be specified multiple times to add multiple arguments
+          - in: query
+            name: image_cache
+            type: boolean
+            required: false
+            description: Cache the provisioning script output and clone it for later VMs with the same script, arguments, and storage layout
         responses:
           200:
             description: OK
@@ -6242,7 +6513,8 @@ class API_Provisioner_Profile_Root(Resource):
             reqargs.get('userdata', None),
             reqargs.get('script', None),
             reqargs.get('ova', None),
-            reqargs.get('arg', [])
+            reqargs.get('arg', []),
+            bool(strtobool(reqargs.get('image_cache', 'false')))
         )
 
 
@@ -6282,7 +6554,8 @@ class API_Provisioner_Profile_Element(Resource):
         {'name': 'userdata'},
         {'name': 'script'},
         {'name': 'ova'},
-        {'name': 'arg', 'action': 'append'}
+        {'name': 'arg', 'action': 'append'},
+        {'name': 'image_cache'}
     ])
     @Authenticator
     def post(self, profile, reqargs):
@@ -6334,6 +6607,11 @@ class API_Provisioner_Profile_Element(Resource):
             name: arg
             type: string
             description: Script install() function keywork argument in "arg=data" format; may be specified multiple times to add multiple arguments
+          - in: query
+            name: image_cache
+            type: boolean
+            required: false
+            description: Cache the provisioning script output and clone it for later VMs with the same script, arguments, and storage layout
         responses:
           200:
             description: OK
@@ -6355,7 +6633,8 @@ class API_Provisioner_Profile_Element(Resource):
             reqargs.get('userdata', None),
             reqargs.get('script', None),
             reqargs.get('ova', None),
-            reqargs.get('arg', [])
+            reqargs.get('arg', []),
+            bool(strtobool(reqargs.get('image_cache', 'false')))
         )
 
     @RequestParser([
@@ -6364,7 +6643,8 @@ class API_Provisioner_Profile_Element(Resource):
         {'name': 'storage_template'},
         {'name': 'userdata'},
         {'name': 'script'},
-        {'name': 'arg', 'action': 'append'}
+        {'name': 'arg', 'action': 'append'},
+        {'name': 'image_cache'}
     ])
     @Authenticator
     def put(self, profile, reqargs):
@@ -6403,6 +6683,11 @@ class API_Provisioner_Profile_Element(Resource):
             name: arg
             type: string
             description: Script install() function keywork argument in "arg=data" format; may be specified multiple times to add multiple arguments
+          - in: query
+            name: image_cache
+            type: boolean
+            required: false
+            description: Cache the provisioning script output and clone it for later VMs with the same script, arguments, and storage layout
         responses:
           200:
             description: OK
@@ -6425,6 +6710,7 @@ class API_Provisioner_Profile_Element(Resource):
             reqargs.get('script', None),
             None,  # Can't modify the OVA
             reqargs.get('arg', []),
+            bool(strtobool(reqargs.get('image_cache'))) if reqargs.get('image_cache') is not None else None
         )
 
     @Authenticator
@@ -6539,6 +6825,149 @@ class API_Provisioner_Create_Root(Resource):
 api.add_resource(API_Provisioner_Create_Root, '/provisioner/create')
 
 
+# /provisioner/create/batch
+class API_Provisioner_Create_Batch(Resource):
+    @RequestParser([
+        {'name': 'name', 'required': True, 'helptext': "A VM name pattern must be specified."},
+        {'name': 'profile', 'required': True, 'helptext': "A profile name must be specified."},
+        {'name': 'count', 'required': True, 'helptext': "A VM count must be specified."},
+        {'name': 'start_index'},
+        {'name': 'define_vm'},
+        {'name': 'start_vm'},
+        {'name': 'concurrency'},
+        {'name': 'pool_concurrency'},
+        {'name': 'node_concurrency'},
+        {'name': 'arg', 'action': 'append'}
+    ])
+    @Authenticator
+    def post(self, reqargs):
+        """
+        Create a batch of virtual machines from one profile
+        Note: Starts a single background job in the pvc-provisioner-worker Celery worker while returning a task ID; the profile and its templates are read once for the whole batch, and the "GET /provisioner/status/<task_id>" endpoint reports the aggregated progress and the state of each VM
+        ---
+        tags:
+          - provisioner
+        parameters:
+          - in: query
+            name: name
+            type: string
+            required: true
+            description: Virtual machine name pattern, with "{}" (or a format spec such as "{:02d}") replaced by the VM index
+          - in: query
+            name: profile
+            type: string
+            required: true
+            description: Profile name
+          - in: query
+            name: count
+            type: integer
+            required: true
+            description: Number of virtual machines to create
+          - in: query
+            name: start_index
+            type: integer
+            required: false
+            default: 1
+            description: Index of the first virtual machine
+          - in: query
+            name: define_vm
+            type: boolean
+            required: false
+            description: Whether to define the VMs on the cluster during provisioning
+          - in: query
+            name: start_vm
+            type: boolean
+            required: false
+            description: Whether to start the VMs after provisioning
+          - in: query
+            name: concurrency
+            type: integer
+            required: false
+            description: Maximum number of VMs provisioned at once
+          - in: query
+            name: pool_concurrency
+            type: integer
+            required: false
+            description: Maximum number of VMs provisioned at once using any one storage pool
+          - in: query
+            name: node_concurrency
+            type: integer
+            required: false
+            description: Maximum number of VMs provisioned at once targeting any one node
+          - in: query
+            name: arg
+            type: string
+            description: Script install() function keywork argument in "arg=data" format; may be specified multiple times to add multiple arguments
+        responses:
+          202:
+            description: OK
+            schema:
+              type: object
+              properties:
+                task_id:
+                  type: string
+                  description: Task ID for the provisioner Celery worker
+          400:
+            description: Bad request
+            schema:
+              type: object
+              id: Message
+        """
+        # Verify that the profile is valid
+        _list, code = api_provisioner.list_profile(reqargs.get('profile', None), is_fuzzy=False)
+        if code != 200:
+            return {'message': 'Profile "{}" is not valid.'.format(reqargs.get('profile'))}, 400
+
+        limits = dict()
+        try:
+            count = int(reqargs.get('count'))
+            start_index = int(reqargs.get('start_index', 1))
+            for limit in 'concurrency', 'pool_concurrency', 'node_concurrency':
+                if reqargs.get(limit, None) is not None:
+                    limits[limit] = int(reqargs.get(limit))
+                    if limits[limit] < 1:
+                        raise ValueError
+        except ValueError:
+            return {'message': 'The count, start index, and concurrency limits must be integers, with limits of at least 1.'}, 400
+        if count < 1:
+            return {'message': 'The count must be at least 1.'}, 400
+
+        # Verify that the name pattern produces distinct names
+        try:
+            names = [reqargs.get('name').format(index) for index in range(start_index, start_index + count)]
+        except Exception:
+            return {'message': 'The VM name pattern "{}" is not valid.'.format(reqargs.get('name'))}, 400
+        if len(set(names)) != count:
+            return {'message': 'The VM name pattern "{}" must contain a "{{}}" index field.'.format(reqargs.get('name'))}, 400
+
+        if bool(strtobool(reqargs.get('define_vm', 'true'))):
+            define_vm = True
+        else:
+            define_vm = False
+
+        if bool(strtobool(reqargs.get('start_vm', 'true'))):
+            start_vm = True
+        else:
+            start_vm = False
+
+        task = create_vm_batch.delay(
+            reqargs.get('name', None),
+            reqargs.get('profile', None),
+            count,
+            start_index=start_index,
+            define_vm=define_vm,
+            start_vm=start_vm,
+            script_run_args=reqargs.get('arg', []),
+            concurrency=limits.get('concurrency', None),
+            pool_concurrency=limits.get('pool_concurrency', None),
+            node_concurrency=limits.get('node_concurrency', None),
+        )
+        return {"task_id": task.id}, 202, {'Location': Api.url_for(api, API_Provisioner_Status_Element, task_id=task.id)}
+
+
+api.add_resource(API_Provisioner_Create_Batch, '/provisioner/create/batch')
+
+
 # /provisioner/status
 class API_Provisioner_Status_Root(Resource):
     @Authenticator
@@ -6603,6 +7032,12 @@ class API_Provisioner_Status_Element(Resource):
                 status:
                   type: string
                   description: Status details about job
+                phase_durations:
+                  type: object
+                  description: Duration in seconds of each completed provisioning phase, keyed by phase number
+                vms:
+                  type: object
+                  description: For batch jobs, the state, stage, and status of each VM, keyed by VM name
           404:
             description: Not found
             schema:
@@ -6626,6 +7061,10 @@ class API_Provisioner_Status_Element(Resource):
             }
             if 'result' in task.info:
                 response['result'] = task.info['result']
+            if 'phase_durations' in task.info:
+                response['phase_durations'] = task.info['phase_durations']
+            if 'vms' in task.info:
+                response['vms'] = task.info['vms']
         else:
             response = {
                 'state': task.state,
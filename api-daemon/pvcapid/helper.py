@@ -20,8 +20,11 @@
 #
 ###############################################################################
 
+import os
 import flask
 import json
+import hashlib
+import subprocess
 import lxml.etree as etree
 
 from distutils.util import strtobool as dustrtobool
@@ -35,8 +38,13 @@ import daemon_lib.vm as pvc_vm
 import daemon_lib.network as pvc_network
 import daemon_lib.ceph as pvc_ceph
 
+from pvcapid.ova import PipeStreamWriter
+
 config = None  # Set in this namespace by flaskapi
 
+# The buffer size used when writing and verifying uploaded volume chunks
+upload_buffer_size = 4 * 1024 * 1024
+
 
 def strtobool(stringv):
     if stringv is None:
@@ -73,9 +81,11 @@ def initialize_cluster():
     transaction.create('/ceph/pools', ''.encode('ascii'))
     transaction.create('/ceph/volumes', ''.encode('ascii'))
     transaction.create('/ceph/snapshots', ''.encode('ascii'))
+    transaction.create('/ceph/uploads', ''.encode('ascii'))
     transaction.create('/cmd', ''.encode('ascii'))
     transaction.create('/cmd/domains', ''.encode('ascii'))
     transaction.create('/cmd/ceph', ''.encode('ascii'))
+    transaction.create('/liveness', ''.encode('ascii'))
     transaction.create('/locks', ''.encode('ascii'))
     transaction.create('/locks/flush_lock', ''.encode('ascii'))
     transaction.create('/locks/primary_node', ''.encode('ascii'))
@@ -537,7 +547,8 @@ def get_vm_meta(vm):
                 'node_limit': retdata['node_limit'],
                 'node_selector': retdata['node_selector'],
                 'node_autostart': retdata['node_autostart'],
-                'migration_method': retdata['migration_method']
+                'migration_method': retdata['migration_method'],
+                'recovery_priority': retdata['recovery_priority']
             }
         else:
             retcode = 404
@@ -553,7 +564,7 @@ def get_vm_meta(vm):
     return retdata, retcode
 
 
-def update_vm_meta(vm, limit, selector, autostart, provisioner_profile, migration_method):
+def update_vm_meta(vm, limit, selector, autostart, provisioner_profile, migration_method, recovery_priority):
     """
     Update metadata of a VM.
     """
@@ -563,7 +574,7 @@ def update_vm_meta(vm, limit, selector, autostart, provisioner_profile, migratio
             autostart = bool(strtobool(autostart))
         except Exception:
             autostart = False
-    retflag, retdata = pvc_vm.modify_vm_metadata(zk_conn, vm, limit, selector, autostart, provisioner_profile, migration_method)
+    retflag, retdata = pvc_vm.modify_vm_metadata(zk_conn, vm, limit, selector, autostart, provisioner_profile, migration_method, recovery_priority)
     pvc_common.stopZKConnection(zk_conn)
 
     if retflag:
@@ -1348,12 +1359,31 @@ def ceph_volume_add(pool, name, size):
     return output, retcode
 
 
-def ceph_volume_clone(pool, name, source_volume):
+def ceph_volume_clone(pool, name, source_volume, cow=False):
     """
     Clone a Ceph RBD volume to a new volume on the PVC Ceph storage cluster.
     """
     zk_conn = pvc_common.startZKConnection(config['coordinators'])
-    retflag, retdata = pvc_ceph.clone_volume(zk_conn, pool, source_volume, name)
+    retflag, retdata = pvc_ceph.clone_volume(zk_conn, pool, source_volume, name, cow=cow)
+    pvc_common.stopZKConnection(zk_conn)
+
+    if retflag:
+        retcode = 200
+    else:
+        retcode = 400
+
+    output = {
+        'message': retdata.replace('\"', '\'')
+    }
+    return output, retcode
+
+
+def ceph_volume_flatten(pool, name):
+    """
+    Flatten a copy-on-write clone Ceph RBD volume on the PVC Ceph storage cluster.
+    """
+    zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    retflag, retdata = pvc_ceph.flatten_volume(zk_conn, pool, name)
     pvc_common.stopZKConnection(zk_conn)
 
     if retflag:
@@ -1447,17 +1477,15 @@ def ceph_volume_upload(pool, volume, img_type):
         }
         retcode = 400
         return output, retcode
-    dev_size = retdata[0]['stats']['size']
 
     def cleanup_maps_and_volumes():
         zk_conn = pvc_common.startZKConnection(config['coordinators'])
         # Unmap the target blockdev
         retflag, retdata = pvc_ceph.unmap_volume(zk_conn, pool, volume)
-        # Unmap the temporary blockdev
-        retflag, retdata = pvc_ceph.unmap_volume(zk_conn, pool, "{}_tmp".format(volume))
-        # Remove the temporary blockdev
-        retflag, retdata = pvc_ceph.remove_volume(zk_conn, pool, "{}_tmp".format(volume))
         pvc_common.stopZKConnection(zk_conn)
+        # Remove the temporary image, which only exists in Ceph
+        if img_type != 'raw':
+            pvc_common.run_os_command('rbd rm {}/{}_tmp'.format(pool, volume))
 
     # Create a temporary block device to store non-raw images
     if img_type == 'raw':
@@ -1498,70 +1526,47 @@ def ceph_volume_upload(pool, volume, img_type):
         cleanup_maps_and_volumes()
         return output, retcode
 
-    # Write the image directly to the blockdev
+    # Write the image to a temporary image and convert it into the volume
     else:
-        # Create a temporary blockdev
-        zk_conn = pvc_common.startZKConnection(config['coordinators'])
-        retflag, retdata = pvc_ceph.add_volume(zk_conn, pool, "{}_tmp".format(volume), dev_size)
-        pvc_common.stopZKConnection(zk_conn)
-        if not retflag:
-            output = {
-                'message': retdata.replace('\"', '\'')
-            }
-            retcode = 400
-            cleanup_maps_and_volumes()
-            return output, retcode
-
-        # Map the temporary target blockdev
-        zk_conn = pvc_common.startZKConnection(config['coordinators'])
-        retflag, retdata = pvc_ceph.map_volume(zk_conn, pool, "{}_tmp".format(volume))
-        pvc_common.stopZKConnection(zk_conn)
-        if not retflag:
-            output = {
-                'message': retdata.replace('\"', '\'')
-            }
-            retcode = 400
-            cleanup_maps_and_volumes()
-            return output, retcode
-        temp_blockdev = retdata
-
-        # Map the target blockdev
-        zk_conn = pvc_common.startZKConnection(config['coordinators'])
-        retflag, retdata = pvc_ceph.map_volume(zk_conn, pool, volume)
-        pvc_common.stopZKConnection(zk_conn)
-        if not retflag:
-            output = {
-                'message': retdata.replace('\"', '\'')
-            }
-            retcode = 400
-            cleanup_maps_and_volumes()
-            return output, retcode
-        dest_blockdev = retdata
+        # Import the upload into a temporary image through librbd; the source formats need random
+        # access, so they cannot be converted straight from the upload stream
+        import_process = subprocess.Popen(
+            ['rbd', 'import', '--no-progress', '-', '{}/{}_tmp'.format(pool, volume)],
+            stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        image_stream_writer = PipeStreamWriter(os.dup(import_process.stdin.fileno()))
 
-        # Save the data to the temporary blockdev directly
+        # Save the data to the temporary image directly
         try:
-            # This sets up a custom stream_factory that writes directly into the ova_blockdev,
+            # This sets up a custom stream_factory that writes directly into the rbd import,
             # rather than the standard stream_factory which writes to a temporary file waiting
             # on a save() call. This will break if the API ever uploaded multiple files, but
             # this is an acceptable workaround.
             def image_stream_factory(total_content_length, filename, content_type, content_length=None):
-                return open(temp_blockdev, 'wb')
+                return image_stream_writer
             parse_form_data(flask.request.environ, stream_factory=image_stream_factory)
+            upload_failed = False
         except Exception:
+            upload_failed = True
+        finally:
+            image_stream_writer.close()
+            import_stderr = import_process.communicate()[1].decode('ascii', errors='ignore')
+
+        if upload_failed or import_process.returncode:
             output = {
-                'message': "Failed to upload or write image file to temporary volume."
+                'message': "Failed to upload or write image file to temporary volume: {}".format(import_stderr.strip())
             }
             retcode = 400
             cleanup_maps_and_volumes()
             return output, retcode
 
-        # Convert from the temporary to destination format on the blockdevs
-        retcode, stdout, stderr = pvc_common.run_os_command(
-            'qemu-img convert -C -f {} -O raw {} {}'.format(img_type, temp_blockdev, dest_blockdev)
-        )
-        if retcode:
+        # Convert from the temporary to destination format through librbd
+        zk_conn = pvc_common.startZKConnection(config['coordinators'])
+        retflag, retdata = pvc_ceph.convert_volume(zk_conn, pool, "{}_tmp".format(volume), img_type, volume)
+        pvc_common.stopZKConnection(zk_conn)
+        if not retflag:
             output = {
-                'message': "Failed to convert image format from '{}' to 'raw': {}".format(img_type, stderr)
+                'message': "Failed to convert image format from '{}' to 'raw': {}".format(img_type, retdata)
             }
             retcode = 400
             cleanup_maps_and_volumes()
@@ -1575,6 +1580,247 @@ def ceph_volume_upload(pool, volume, img_type):
         return output, retcode
 
 
+def ceph_volume_upload_session_get(pool, volume, session):
+    """
+    Get the state of a chunked upload session for a PVC Ceph volume
+    """
+    zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    session_data = pvc_ceph.getUploadSession(zk_conn, session)
+    pvc_common.stopZKConnection(zk_conn)
+
+    if session_data is None or session_data['pool'] != pool or session_data['volume'] != volume:
+        output = {
+            'message': "Upload session '{}' does not exist for volume '{}' in pool '{}'.".format(session, volume, pool)
+        }
+        retcode = 404
+        return output, retcode
+
+    output = {
+        'session': session_data['session'],
+        'image_format': session_data['image_format'],
+        'size': session_data['size'],
+        'chunks': session_data['chunks'],
+        'received': sum(length for offset, length in session_data['chunks'])
+    }
+    retcode = 200
+    return output, retcode
+
+
+def ceph_volume_upload_session_create(pool, volume, img_type, size):
+    """
+    Create a chunked upload session for a PVC Ceph volume
+    """
+    # Determine the image conversion options
+    if img_type not in ['raw', 'vmdk', 'qcow2', 'qed', 'vdi', 'vpc']:
+        output = {
+            "message": "Image type '{}' is not valid.".format(img_type)
+        }
+        retcode = 400
+        return output, retcode
+
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        output = {
+            "message": "Image size must be an integer number of bytes."
+        }
+        retcode = 400
+        return output, retcode
+
+    zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    retflag, retdata = pvc_ceph.add_upload_session(zk_conn, pool, volume, img_type, size)
+    pvc_common.stopZKConnection(zk_conn)
+
+    if retflag:
+        output = {
+            'session': retdata['session'],
+            'image_format': retdata['image_format'],
+            'size': retdata['size'],
+            'chunks': retdata['chunks'],
+            'received': 0
+        }
+        retcode = 200
+    else:
+        output = {
+            'message': retdata.replace('\"', '\'')
+        }
+        retcode = 400
+    return output, retcode
+
+
+def ceph_volume_upload_chunk(pool, volume, session, offset):
+    """
+    Write a byte range of a chunked upload directly to its mapped volume
+    """
+    zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    session_data = pvc_ceph.getUploadSessionInfo(zk_conn, session)
+    pvc_common.stopZKConnection(zk_conn)
+
+    if session_data is None or session_data['pool'] != pool or session_data['volume'] != volume:
+        output = {
+            'message': "Upload session '{}' does not exist for volume '{}' in pool '{}'.".format(session, volume, pool)
+        }
+        retcode = 404
+        return output, retcode
+
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        offset = -1
+    length = flask.request.content_length
+    if offset < 0 or length is None or offset + length > session_data['size']:
+        output = {
+            'message': "Chunk must have a length and lie within the image size of {} bytes.".format(session_data['size'])
+        }
+        retcode = 400
+        return output, retcode
+
+    # Write the body straight to the target blockdev at its offset
+    try:
+        written = 0
+        dest_fd = os.open(session_data['blockdev'], os.O_WRONLY)
+        try:
+            while written < length:
+                data = flask.request.stream.read(min(upload_buffer_size, length - written))
+                if not data:
+                    break
+                os.pwrite(dest_fd, data, offset + written)
+                written += len(data)
+            os.fdatasync(dest_fd)
+        finally:
+            os.close(dest_fd)
+    except Exception as e:
+        output = {
+            'message': "Failed to write chunk at offset {}: {}".format(offset, e)
+        }
+        retcode = 400
+        return output, retcode
+
+    if written != length:
+        output = {
+            'message': "Chunk at offset {} was truncated ({} of {} bytes).".format(offset, written, length)
+        }
+        retcode = 400
+        return output, retcode
+
+    zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    pvc_ceph.add_upload_chunk(zk_conn, session_data, offset, length)
+    pvc_common.stopZKConnection(zk_conn)
+
+    output = {
+        'message': "Wrote {} bytes at offset {}.".format(length, offset)
+    }
+    retcode = 200
+    return output, retcode
+
+
+def ceph_volume_upload_session_finalize(pool, volume, session, checksum):
+    """
+    Verify a completed chunked upload and write it to its PVC Ceph volume
+    """
+    zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    session_data = pvc_ceph.getUploadSession(zk_conn, session)
+    pvc_common.stopZKConnection(zk_conn)
+
+    if session_data is None or session_data['pool'] != pool or session_data['volume'] != volume:
+        output = {
+            'message': "Upload session '{}' does not exist for volume '{}' in pool '{}'.".format(session, volume, pool)
+        }
+        retcode = 404
+        return output, retcode
+
+    # Ensure the chunks cover the whole image
+    covered = 0
+    for offset, length in session_data['chunks']:
+        if offset > covered:
+            break
+        covered = max(covered, offset + length)
+    if covered < session_data['size']:
+        output = {
+            'message': "Upload is incomplete; no data has been received from offset {}.".format(covered)
+        }
+        retcode = 400
+        return output, retcode
+
+    # Verify the written data against the checksum of the source image
+    try:
+        image_hash = hashlib.sha256()
+        remaining = session_data['size']
+        with open(session_data['blockdev'], 'rb') as blk_file:
+            while remaining > 0:
+                data = blk_file.read(min(upload_buffer_size, remaining))
+                if not data:
+                    break
+                image_hash.update(data)
+                remaining -= len(data)
+    except Exception as e:
+        output = {
+            'message': "Failed to read back uploaded image: {}".format(e)
+        }
+        retcode = 400
+        return output, retcode
+
+    if image_hash.hexdigest() != str(checksum).lower():
+        output = {
+            'message': "Uploaded image checksum '{}' does not match expected checksum '{}'.".format(image_hash.hexdigest(), checksum)
+        }
+        retcode = 400
+        return output, retcode
+
+    # Convert the image into the destination volume if needed; the temporary volume stays mapped until the
+    # session is removed, so a failed conversion can simply be retried by finalizing again
+    zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    if session_data['target'] != volume:
+        retflag, retdata = pvc_ceph.convert_volume(zk_conn, pool, session_data['target'], session_data['image_format'], volume)
+        if not retflag:
+            pvc_common.stopZKConnection(zk_conn)
+            output = {
+                'message': "Failed to convert image format from '{}' to 'raw': {}".format(session_data['image_format'], retdata)
+            }
+            retcode = 400
+            return output, retcode
+    pvc_ceph.remove_upload_session(zk_conn, session)
+    pvc_common.stopZKConnection(zk_conn)
+
+    if session_data['target'] != volume:
+        message = "Converted and wrote uploaded file to volume '{}' in pool '{}'.".format(volume, pool)
+    else:
+        message = "Wrote uploaded file to volume '{}' in pool '{}'.".format(volume, pool)
+    output = {
+        'message': message
+    }
+    retcode = 200
+    return output, retcode
+
+
+def ceph_volume_upload_session_remove(pool, volume, session):
+    """
+    Abort a chunked upload session for a PVC Ceph volume
+    """
+    zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    session_data = pvc_ceph.getUploadSessionInfo(zk_conn, session)
+    if session_data is None or session_data['pool'] != pool or session_data['volume'] != volume:
+        pvc_common.stopZKConnection(zk_conn)
+        output = {
+            'message': "Upload session '{}' does not exist for volume '{}' in pool '{}'.".format(session, volume, pool)
+        }
+        retcode = 404
+        return output, retcode
+
+    retflag, retdata = pvc_ceph.remove_upload_session(zk_conn, session)
+    pvc_common.stopZKConnection(zk_conn)
+
+    if retflag:
+        retcode = 200
+    else:
+        retcode = 400
+
+    output = {
+        'message': retdata.replace('\"', '\'')
+    }
+    return output, retcode
+
+
 def ceph_volume_snapshot_list(pool=None, volume=None, limit=None, is_fuzzy=True):
     """
     Get the list of RBD volume snapshots in the Ceph storage cluster.
@@ -211,8 +211,9 @@ class DBProfile(db.Model):
     script = db.Column(db.Integer, db.ForeignKey("script.id"))
     ova = db.Column(db.Integer, db.ForeignKey("ova.id"))
     arguments = db.Column(db.Text)
+    image_cache = db.Column(db.Boolean)
 
-    def __init__(self, name, profile_type, system_template, network_template, storage_template, userdata, script, ova, arguments):
+    def __init__(self, name, profile_type, system_template, network_template, storage_template, userdata, script, ova, arguments, image_cache=False):
         self.name = name
         self.profile_type = profile_type
         self.system_template = system_template
@@ -222,6 +223,7 @@ class DBProfile(db.Model):
         self.script = script
         self.ova = ova
         self.arguments = arguments
+        self.image_cache = image_cache
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
@@ -240,3 +242,24 @@ class DBStorageBenchmarks(db.Model):
 
     def __repr__(self):
         return '<id {}>'.format(self.id)
+
+
+class DBImageCache(db.Model):
+    __tablename__ = 'image_cache'
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.Text, nullable=False, unique=True)
+    volumes = db.Column(db.Text, nullable=False)
+    size_bytes = db.Column(db.BigInteger, nullable=False)
+    created = db.Column(db.BigInteger, nullable=False)
+    last_used = db.Column(db.BigInteger, nullable=False)
+
+    def __init__(self, key, volumes, size_bytes, created, last_used):
+        self.key = key
+        self.volumes = volumes
+        self.size_bytes = size_bytes
+        self.created = created
+        self.last_used = last_used
+
+    def __repr__(self):
+        return '<id {}>'.format(self.id)
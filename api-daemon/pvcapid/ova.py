@@ -21,11 +21,11 @@
 ###############################################################################
 
 import flask
-import psycopg2
-import psycopg2.extras
+import os
 import re
 import math
 import tarfile
+import threading
 
 import lxml.etree
 
@@ -36,31 +36,64 @@ import daemon_lib.ceph as pvc_ceph
 
 import pvcapid.provisioner as provisioner
 
+from pvcapid.database import open_database, close_database, database
+
 config = None  # Set in this namespace by flaskapi
 
+# The buffer size used when streaming disk images out of an OVA archive
+ova_copy_chunk_size = 4 * 1024 * 1024
+
 
 #
 # Common functions
 #
 
-# Database connections
-def open_database(config):
-    conn = psycopg2.connect(
-        host=config['database_host'],
-        port=config['database_port'],
-        dbname=config['database_name'],
-        user=config['database_user'],
-        password=config['database_password']
-    )
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    return conn, cur
+# Write a buffer fully to a file descriptor
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+# Stream a file object into a block device using constant memory
+def write_ova_member(member_file, dest_blockdev):
+    dest_fd = os.open(dest_blockdev, os.O_WRONLY)
+    try:
+        while True:
+            chunk = member_file.read(ova_copy_chunk_size)
+            if not chunk:
+                break
+            write_all(dest_fd, chunk)
+
+        # Flush the target device only, rather than performing a global sync
+        os.fdatasync(dest_fd)
+    finally:
+        os.close(dest_fd)
 
 
-def close_database(conn, cur, failed=False):
-    if not failed:
-        conn.commit()
-    cur.close()
-    conn.close()
+# A write-only file object handed to the form parser, which feeds an upload into a pipe
+class PipeStreamWriter(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+    def write(self, data):
+        write_all(self.fd, data)
+
+    def seek(self, *args):
+        # The form parser rewinds its containers once they are complete; this stream cannot be
+        return 0
+
+    def tell(self):
+        return 0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
 
 
 #
@@ -85,10 +118,9 @@ def list_ova(limit, is_fuzzy=True):
         query = "SELECT id, name FROM {};".format('ova')
         args = ()
 
-    conn, cur = open_database(config)
-    cur.execute(query, args)
-    data = cur.fetchall()
-    close_database(conn, cur)
+    with database(config) as (conn, cur):
+        cur.execute(query, args)
+        data = cur.fetchall()
 
     ova_data = list()
 
@@ -98,10 +130,9 @@ def list_ova(limit, is_fuzzy=True):
 
         query = "SELECT pool, volume_name, volume_format, disk_id, disk_size_gb FROM {} WHERE ova = %s;".format('ova_volume')
         args = (ova_id,)
-        conn, cur = open_database(config)
-        cur.execute(query, args)
-        volumes = cur.fetchall()
-        close_database(conn, cur)
+        with database(config) as (conn, cur):
+            cur.execute(query, args)
+            volumes = cur.fetchall()
 
         ova_data.append({'id': ova_id, 'name': ova_name, 'volumes': volumes})
 
@@ -161,31 +192,111 @@ def delete_ova(name):
     return retmsg, retcode
 
 
+# Import the disks of an OVA from its tar stream, as the stream is uploaded
+def import_ova_stream(ova_stream, pool, name, result):
+    try:
+        ova_archive = tarfile.open(fileobj=ova_stream, mode='r|')
+        disk_volumes = None
+
+        for member in ova_archive:
+            # Parse the OVF file to get our VM details; OVA archives carry it as their first member
+            if re.match(r'.*\.ovf$', member.name):
+                ovf_file = ova_archive.extractfile(member)
+                ovf_parser = OVFParser(ovf_file)
+                ovf_file.close()
+
+                virtual_system = ovf_parser.getVirtualSystems()[0]
+                result['ovf_xml_raw'] = ovf_parser.getXML()
+                result['virtual_hardware'] = ovf_parser.getVirtualHardware(virtual_system)
+                result['disk_map'] = ovf_parser.getDiskMap(virtual_system)
+
+                disk_volumes = dict()
+                for idx, disk in enumerate(result['disk_map']):
+                    disk_identifier = "sd{}".format(chr(ord('a') + idx))
+                    disk_volumes[disk.get('src')] = "ova_{}_{}".format(name, disk_identifier)
+                continue
+
+            if disk_volumes is None:
+                if member.isreg():
+                    raise ValueError("The OVF file must precede the disk image '{}' in the OVA.".format(member.name))
+                continue
+
+            volume = disk_volumes.get(member.name)
+            if volume is None:
+                continue
+
+            # Normalize the dev size to bytes
+            dev_size = pvc_ceph.format_bytes_fromhuman(member.size)
+
+            # Create the blockdev
+            zk_conn = pvc_common.startZKConnection(config['coordinators'])
+            retflag, retdata = pvc_ceph.add_volume(zk_conn, pool, volume, dev_size)
+            pvc_common.stopZKConnection(zk_conn)
+            if not retflag:
+                raise ValueError(retdata)
+            result['volumes'].append(volume)
+
+            # Map the blockdev
+            zk_conn = pvc_common.startZKConnection(config['coordinators'])
+            retflag, retdata = pvc_ceph.map_volume(zk_conn, pool, volume)
+            pvc_common.stopZKConnection(zk_conn)
+            if not retflag:
+                raise ValueError(retdata)
+            temp_blockdev = retdata
+
+            # Stream the disk image from the OVA archive straight into the blockdev
+            try:
+                member_file = ova_archive.extractfile(member)
+                write_ova_member(member_file, temp_blockdev)
+                member_file.close()
+            except Exception:
+                raise ValueError("Failed to write image file '{}' to volume.".format(member.name))
+            finally:
+                # Unmap the blockdev
+                zk_conn = pvc_common.startZKConnection(config['coordinators'])
+                pvc_ceph.unmap_volume(zk_conn, pool, volume)
+                pvc_common.stopZKConnection(zk_conn)
+
+        if disk_volumes is None:
+            raise ValueError("The uploaded OVA file does not contain an OVF file.")
+        missing_disks = [src for src, volume in disk_volumes.items() if volume not in result['volumes']]
+        if missing_disks:
+            raise ValueError("The uploaded OVA file is missing the image file(s) {}.".format(', '.join(missing_disks)))
+
+        # Consume any trailing data so that the uploader completes
+        while ova_stream.read(ova_copy_chunk_size):
+            pass
+    except tarfile.TarError:
+        result['error'] = "The uploaded OVA file is not readable."
+    except Exception as e:
+        result['error'] = str(e)
+    finally:
+        ova_stream.close()
+
+
 def upload_ova(pool, name, ova_size):
-    ova_archive = None
+    result = {
+        'error': None,
+        'volumes': list()
+    }
 
     # Cleanup function
-    def cleanup_ova_maps_and_volumes():
-        # Close the OVA archive
-        if ova_archive:
-            ova_archive.close()
+    def cleanup_ova_volumes():
         zk_conn = pvc_common.startZKConnection(config['coordinators'])
-        # Unmap the OVA temporary blockdev
-        retflag, retdata = pvc_ceph.unmap_volume(zk_conn, pool, "ova_{}".format(name))
-        # Remove the OVA temporary blockdev
-        retflag, retdata = pvc_ceph.remove_volume(zk_conn, pool, "ova_{}".format(name))
+        # Remove any disk volumes created before the failure
+        for volume in result['volumes']:
+            retflag, retdata = pvc_ceph.remove_volume(zk_conn, pool, volume)
         pvc_common.stopZKConnection(zk_conn)
 
     # Normalize the OVA size to bytes
     ova_size_bytes = int(pvc_ceph.format_bytes_fromhuman(ova_size)[:-1])
-    ova_size = pvc_ceph.format_bytes_fromhuman(ova_size)
 
-    # Verify that the cluster has enough space to store the OVA volumes (2x OVA size, temporarily, 1x permanently)
+    # Verify that the cluster has enough space to store the OVA volumes
     zk_conn = pvc_common.startZKConnection(config['coordinators'])
     pool_information = pvc_ceph.getPoolInformation(zk_conn, pool)
     pvc_common.stopZKConnection(zk_conn)
     pool_free_space_bytes = int(pool_information['stats']['free_bytes'])
-    if ova_size_bytes * 2 >= pool_free_space_bytes:
+    if ova_size_bytes >= pool_free_space_bytes:
         output = {
             'message': "The cluster does not have enough free space ({}) to store the OVA volume ({}).".format(
                 pvc_ceph.format_bytes_tohuman(pool_free_space_bytes),
@@ -193,149 +304,41 @@ def upload_ova(pool, name, ova_size):
             )
         }
         retcode = 400
-        cleanup_ova_maps_and_volumes()
         return output, retcode
 
-    # Create a temporary OVA blockdev
-    zk_conn = pvc_common.startZKConnection(config['coordinators'])
-    retflag, retdata = pvc_ceph.add_volume(zk_conn, pool, "ova_{}".format(name), ova_size)
-    pvc_common.stopZKConnection(zk_conn)
-    if not retflag:
-        output = {
-            'message': retdata.replace('\"', '\'')
-        }
-        retcode = 400
-        cleanup_ova_maps_and_volumes()
-        return output, retcode
+    # Parse the OVA as it is uploaded; the form parser writes the upload into a pipe, and the
+    # importer reads the tar stream from the other end, routing each disk into its own volume
+    read_fd, write_fd = os.pipe()
+    ova_stream_writer = PipeStreamWriter(write_fd)
+    import_thread = threading.Thread(target=import_ova_stream, args=(os.fdopen(read_fd, 'rb'), pool, name, result))
+    import_thread.start()
 
-    # Map the temporary OVA blockdev
-    zk_conn = pvc_common.startZKConnection(config['coordinators'])
-    retflag, retdata = pvc_ceph.map_volume(zk_conn, pool, "ova_{}".format(name))
-    pvc_common.stopZKConnection(zk_conn)
-    if not retflag:
-        output = {
-            'message': retdata.replace('\"', '\'')
-        }
-        retcode = 400
-        cleanup_ova_maps_and_volumes()
-        return output, retcode
-    ova_blockdev = retdata
-
-    # Save the OVA data to the temporary blockdev directly
     try:
-        # This sets up a custom stream_factory that writes directly into the ova_blockdev,
+        # This sets up a custom stream_factory that writes directly into the import pipe,
         # rather than the standard stream_factory which writes to a temporary file waiting
         # on a save() call. This will break if the API ever uploaded multiple files, but
         # this is an acceptable workaround.
         def ova_stream_factory(total_content_length, filename, content_type, content_length=None):
-            return open(ova_blockdev, 'wb')
+            return ova_stream_writer
         parse_form_data(flask.request.environ, stream_factory=ova_stream_factory)
     except Exception:
-        output = {
-            'message': "Failed to upload or write OVA file to temporary volume."
-        }
-        retcode = 400
-        cleanup_ova_maps_and_volumes()
-        return output, retcode
+        if result['error'] is None:
+            result['error'] = "Failed to upload OVA file."
+    finally:
+        ova_stream_writer.close()
+        import_thread.join()
 
-    try:
-        # Set up the TAR reader for the OVA temporary blockdev
-        ova_archive = tarfile.open(name=ova_blockdev)
-        # Determine the files in the OVA
-        members = ova_archive.getmembers()
-    except tarfile.TarError:
+    if result['error'] is not None:
         output = {
-            'message': "The uploaded OVA file is not readable."
+            'message': result['error'].replace('\"', '\'')
         }
         retcode = 400
-        cleanup_ova_maps_and_volumes()
+        cleanup_ova_volumes()
         return output, retcode
 
-    # Parse through the members list and extract the OVF file
-    for element in set(x for x in members if re.match(r'.*\.ovf$', x.name)):
-        ovf_file = ova_archive.extractfile(element)
-
-    # Parse the OVF file to get our VM details
-    ovf_parser = OVFParser(ovf_file)
-    ovf_xml_raw = ovf_parser.getXML()
-    virtual_system = ovf_parser.getVirtualSystems()[0]
-    virtual_hardware = ovf_parser.getVirtualHardware(virtual_system)
-    disk_map = ovf_parser.getDiskMap(virtual_system)
-
-    # Close the OVF file
-    ovf_file.close()
-
-    # Create and upload each disk volume
-    for idx, disk in enumerate(disk_map):
-        disk_identifier = "sd{}".format(chr(ord('a') + idx))
-        volume = "ova_{}_{}".format(name, disk_identifier)
-        dev_src = disk.get('src')
-        dev_size_raw = ova_archive.getmember(dev_src).size
-        vm_volume_size = disk.get('capacity')
-
-        # Normalize the dev size to bytes
-        dev_size = pvc_ceph.format_bytes_fromhuman(dev_size_raw)
-
-        def cleanup_img_maps():
-            zk_conn = pvc_common.startZKConnection(config['coordinators'])
-            # Unmap the temporary blockdev
-            retflag, retdata = pvc_ceph.unmap_volume(zk_conn, pool, volume)
-            pvc_common.stopZKConnection(zk_conn)
-
-        # Create the blockdev
-        zk_conn = pvc_common.startZKConnection(config['coordinators'])
-        retflag, retdata = pvc_ceph.add_volume(zk_conn, pool, volume, dev_size)
-        pvc_common.stopZKConnection(zk_conn)
-        if not retflag:
-            output = {
-                'message': retdata.replace('\"', '\'')
-            }
-            retcode = 400
-            cleanup_img_maps()
-            cleanup_ova_maps_and_volumes()
-            return output, retcode
-
-        # Map the blockdev
-        zk_conn = pvc_common.startZKConnection(config['coordinators'])
-        retflag, retdata = pvc_ceph.map_volume(zk_conn, pool, volume)
-        pvc_common.stopZKConnection(zk_conn)
-        if not retflag:
-            output = {
-                'message': retdata.replace('\"', '\'')
-            }
-            retcode = 400
-            cleanup_img_maps()
-            cleanup_ova_maps_and_volumes()
-            return output, retcode
-        temp_blockdev = retdata
-
-        try:
-            # Open (extract) the TAR archive file and seek to byte 0
-            vmdk_file = ova_archive.extractfile(disk.get('src'))
-            vmdk_file.seek(0)
-            # Open the temporary blockdev and seek to byte 0
-            blk_file = open(temp_blockdev, 'wb')
-            blk_file.seek(0)
-            # Write the contents of vmdk_file into blk_file
-            blk_file.write(vmdk_file.read())
-            # Close blk_file (and flush the buffers)
-            blk_file.close()
-            # Close vmdk_file
-            vmdk_file.close()
-            # Perform an OS-level sync
-            pvc_common.run_os_command('sync')
-        except Exception:
-            output = {
-                'message': "Failed to write image file '{}' to temporary volume.".format(disk.get('src'))
-            }
-            retcode = 400
-            cleanup_img_maps()
-            cleanup_ova_maps_and_volumes()
-            return output, retcode
-
-        cleanup_img_maps()
-
-    cleanup_ova_maps_and_volumes()
+    ovf_xml_raw = result['ovf_xml_raw']
+    virtual_hardware = result['virtual_hardware']
+    disk_map = result['disk_map']
 
     # Prepare the database entries
     query = "INSERT INTO ova (name, ovf) VALUES (%s, %s);"
@@ -355,10 +358,9 @@ def upload_ova(pool, name, ova_size):
     # Get the OVA database id
     query = "SELECT id FROM ova WHERE name = %s;"
     args = (name, )
-    conn, cur = open_database(config)
-    cur.execute(query, args)
-    ova_id = cur.fetchone()['id']
-    close_database(conn, cur)
+    with database(config) as (conn, cur):
+        cur.execute(query, args)
+        ova_id = cur.fetchone()['id']
 
     # Prepare disk entries in ova_volume
     for idx, disk in enumerate(disk_map):
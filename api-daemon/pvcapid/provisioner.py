@@ -21,13 +21,17 @@
 ###############################################################################
 
 import json
-import psycopg2
-import psycopg2.extras
 import re
+import time
+import copy
+import hashlib
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from distutils.util import strtobool as dustrtobool
 
 import daemon_lib.common as pvc_common
+import daemon_lib.zkhandler as zkhandler
 import daemon_lib.node as pvc_node
 import daemon_lib.vm as pvc_vm
 import daemon_lib.network as pvc_network
@@ -35,10 +39,23 @@ import daemon_lib.ceph as pvc_ceph
 
 import pvcapid.libvirt_schema as libvirt_schema
 
+from pvcapid.database import open_database, close_database, database
+
 from pvcapid.ova import list_ova
 
 config = None  # Set in this namespace by flaskapi
 
+# Cached images are evicted, least recently used first, while a pool has less than this fraction free
+image_cache_min_free_ratio = 0.2
+
+# Number of volumes created, mapped, and formatted concurrently during provisioning
+storage_workers = 8
+
+# Default limits for batch provisioning: VMs provisioned at once, and at once per pool and per target node
+batch_workers = 8
+batch_pool_concurrency = 4
+batch_node_concurrency = 4
+
 
 def strtobool(stringv):
     if stringv is None:
@@ -79,24 +96,9 @@ class ProvisioningError(Exception):
 # Common functions
 #
 
-# Database connections
-def open_database(config):
-    conn = psycopg2.connect(
-        host=config['database_host'],
-        port=config['database_port'],
-        dbname=config['database_name'],
-        user=config['database_user'],
-        password=config['database_password']
-    )
-    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-    return conn, cur
-
-
-def close_database(conn, cur, failed=False):
-    if not failed:
-        conn.commit()
-    cur.close()
-    conn.close()
+# Signal node Metadata APIs that profile or userdata contents changed; delivered on commit
+def notify_userdata_change(cur):
+    cur.execute("NOTIFY pvc_userdata;")
 
 
 #
@@ -116,38 +118,32 @@ def list_template(limit, table, is_fuzzy=True):
                 limit = limit[:-1]
 
         args = (limit, )
-        query = "SELECT * FROM {} WHERE name LIKE %s;".format(table)
+        where = "WHERE {}.name LIKE %s".format(table)
     else:
         args = ()
-        query = "SELECT * FROM {};".format(table)
+        where = ""
 
-    conn, cur = open_database(config)
-    cur.execute(query, args)
-    data = cur.fetchall()
+    # Network and storage templates carry their VNIs and disks, aggregated in the same query
+    if table == 'network_template':
+        query = """SELECT network_template.*,
+                   COALESCE(json_agg(network ORDER BY network.vni) FILTER (WHERE network.id IS NOT NULL), '[]') AS networks
+                   FROM network_template LEFT JOIN network ON network.network_template = network_template.id
+                   {} GROUP BY network_template.id;""".format(where)
+    elif table == 'storage_template':
+        query = """SELECT storage_template.*,
+                   COALESCE(json_agg(storage ORDER BY storage.disk_id) FILTER (WHERE storage.id IS NOT NULL), '[]') AS disks
+                   FROM storage_template LEFT JOIN storage ON storage.storage_template = storage_template.id
+                   {} GROUP BY storage_template.id;""".format(where)
+    else:
+        query = "SELECT * FROM {} {};".format(table, where)
+
+    with database(config) as (conn, cur):
+        cur.execute(query, args)
+        data = cur.fetchall()
 
     if not isinstance(data, list):
         data = [data]
 
-    if table == 'network_template':
-        for template_id, template_data in enumerate(data):
-            # Fetch list of VNIs from network table
-            query = "SELECT * FROM network WHERE network_template = %s;"
-            args = (template_data['id'],)
-            cur.execute(query, args)
-            vnis = cur.fetchall()
-            data[template_id]['networks'] = vnis
-
-    if table == 'storage_template':
-        for template_id, template_data in enumerate(data):
-            # Fetch list of VNIs from network table
-            query = 'SELECT * FROM storage WHERE storage_template = %s'
-            args = (template_data['id'],)
-            cur.execute(query, args)
-            disks = cur.fetchall()
-            data[template_id]['disks'] = disks
-
-    close_database(conn, cur)
-
     return data
 
 
@@ -621,10 +617,9 @@ def list_userdata(limit, is_fuzzy=True):
         query = "SELECT * FROM {};".format('userdata')
         args = ()
 
-    conn, cur = open_database(config)
-    cur.execute(query, args)
-    data = cur.fetchall()
-    close_database(conn, cur)
+    with database(config) as (conn, cur):
+        cur.execute(query, args)
+        data = cur.fetchall()
     if data:
         return data, 200
     else:
@@ -665,6 +660,7 @@ def update_userdata(name, userdata):
         query = "UPDATE userdata SET userdata = %s WHERE id = %s;"
         args = (userdata, tid)
         cur.execute(query, args)
+        notify_userdata_change(cur)
         retmsg = {"message": 'Updated userdata document "{}".'.format(name)}
         retcode = 200
     except Exception as e:
@@ -685,6 +681,7 @@ def delete_userdata(name):
         query = "DELETE FROM userdata WHERE name = %s;"
         args = (name,)
         cur.execute(query, args)
+        notify_userdata_change(cur)
         retmsg = {"message": 'Removed userdata document "{}".'.format(name)}
         retcode = 200
     except Exception as e:
@@ -716,10 +713,9 @@ def list_script(limit, is_fuzzy=True):
         query = "SELECT * FROM {};".format('script')
         args = ()
 
-    conn, cur = open_database(config)
-    cur.execute(query, args)
-    data = cur.fetchall()
-    close_database(conn, cur)
+    with database(config) as (conn, cur):
+        cur.execute(query, args)
+        data = cur.fetchall()
     if data:
         return data, 200
     else:
@@ -805,43 +801,43 @@ def list_profile(limit, is_fuzzy=True):
             else:
                 limit = limit[:-1]
 
-        query = "SELECT * FROM {} WHERE name LIKE %s;".format('profile')
+        where = "WHERE profile.name LIKE %s"
         args = (limit, )
     else:
-        query = "SELECT * FROM {};".format('profile')
+        where = ""
         args = ()
 
-    conn, cur = open_database(config)
-    cur.execute(query, args)
-    orig_data = cur.fetchall()
-    data = list()
-    for profile in orig_data:
-        profile_data = dict()
-        profile_data['id'] = profile['id']
-        profile_data['name'] = profile['name']
-        profile_data['type'] = profile['profile_type']
-        # Parse the name of each subelement
-        for etype in 'system_template', 'network_template', 'storage_template', 'userdata', 'script', 'ova':
-            query = 'SELECT name from {} WHERE id = %s'.format(etype)
-            args = (profile[etype],)
-            cur.execute(query, args)
-            try:
-                name = cur.fetchone()['name']
-            except Exception:
-                name = "N/A"
-            profile_data[etype] = name
-        # Split the arguments back into a list
-        profile_data['arguments'] = profile['arguments'].split('|')
-        # Append the new data to our actual output structure
-        data.append(profile_data)
-    close_database(conn, cur)
+    # Resolve the name of each subelement in the same query
+    element_types = ['system_template', 'network_template', 'storage_template', 'userdata', 'script', 'ova']
+    query = "SELECT profile.*, {} FROM profile {} {};".format(
+        ', '.join(['{etype}.name AS {etype}_name'.format(etype=etype) for etype in element_types]),
+        ' '.join(['LEFT JOIN {etype} ON {etype}.id = profile.{etype}'.format(etype=etype) for etype in element_types]),
+        where
+    )
+
+    with database(config) as (conn, cur):
+        cur.execute(query, args)
+        orig_data = cur.fetchall()
+        data = list()
+        for profile in orig_data:
+            profile_data = dict()
+            profile_data['id'] = profile['id']
+            profile_data['name'] = profile['name']
+            profile_data['type'] = profile['profile_type']
+            for etype in element_types:
+                profile_data[etype] = profile['{}_name'.format(etype)] or "N/A"
+            # Split the arguments back into a list
+            profile_data['arguments'] = profile['arguments'].split('|')
+            profile_data['image_cache'] = bool(profile['image_cache'])
+            # Append the new data to our actual output structure
+            data.append(profile_data)
     if data:
         return data, 200
     else:
         return {'message': 'No profiles found.'}, 404
 
 
-def create_profile(name, profile_type, system_template, network_template, storage_template, userdata=None, script=None, ova=None, arguments=None):
+def create_profile(name, profile_type, system_template, network_template, storage_template, userdata=None, script=None, ova=None, arguments=None, image_cache=False):
     if list_profile(name, is_fuzzy=False)[-1] != 404:
         retmsg = {'message': 'The profile "{}" already exists.'.format(name)}
         retcode = 400
@@ -919,8 +915,8 @@ def create_profile(name, profile_type, system_template, network_template, storag
 
     conn, cur = open_database(config)
     try:
-        query = "INSERT INTO profile (name, profile_type, system_template, network_template, storage_template, userdata, script, ova, arguments) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);"
-        args = (name, profile_type, system_template_id, network_template_id, storage_template_id, userdata_id, script_id, ova_id, arguments_formatted)
+        query = "INSERT INTO profile (name, profile_type, system_template, network_template, storage_template, userdata, script, ova, arguments, image_cache) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s);"
+        args = (name, profile_type, system_template_id, network_template_id, storage_template_id, userdata_id, script_id, ova_id, arguments_formatted, bool(image_cache))
         cur.execute(query, args)
         retmsg = {"message": 'Created VM profile "{}".'.format(name)}
         retcode = 200
@@ -931,7 +927,7 @@ def create_profile(name, profile_type, system_template, network_template, storag
     return retmsg, retcode
 
 
-def modify_profile(name, profile_type, system_template, network_template, storage_template, userdata, script, ova, arguments=None):
+def modify_profile(name, profile_type, system_template, network_template, storage_template, userdata, script, ova, arguments=None, image_cache=None):
     if list_profile(name, is_fuzzy=False)[-1] != 200:
         retmsg = {'message': 'The profile "{}" does not exist.'.format(name)}
         retcode = 400
@@ -1025,12 +1021,16 @@ def modify_profile(name, profile_type, system_template, network_template, storag
             arguments_formatted = ''
         fields.append({'field': 'arguments', 'data': arguments_formatted})
 
+    if image_cache is not None:
+        fields.append({'field': 'image_cache', 'data': bool(image_cache)})
+
     conn, cur = open_database(config)
     try:
         for field in fields:
             query = "UPDATE profile SET {}=%s WHERE name=%s;".format(field.get('field'))
             args = (field.get('data'), name)
             cur.execute(query, args)
+        notify_userdata_change(cur)
         retmsg = {"message": 'Modified VM profile "{}".'.format(name)}
         retcode = 200
     except Exception as e:
@@ -1051,6 +1051,7 @@ def delete_profile(name):
         query = "DELETE FROM profile WHERE name = %s;"
         args = (name,)
         cur.execute(query, args)
+        notify_userdata_change(cur)
         retmsg = {"message": 'Removed VM profile "{}".'.format(name)}
         retcode = 200
     except Exception as e:
@@ -1061,75 +1062,222 @@ def delete_profile(name):
 
 
 #
-# Main VM provisioning function - executed by the Celery worker
+# Image cache functions
 #
-def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_run_args=[]):
-    # Runtime imports
-    import time
-    import importlib
-    import uuid
-    import datetime
-    import random
+def get_image_cache_key(script, script_arguments, volumes, networks):
+    """
+    Hash everything that determines the output of a provisioning script: the script itself, its
+    final arguments, the layout of the volumes it installs onto, and the networks it is given.
+    """
+    cache_data = {
+        'script': script,
+        'arguments': sorted(script_arguments.items()),
+        'volumes': [
+            {
+                'pool': volume['pool'],
+                'disk_id': volume['disk_id'],
+                'disk_size_gb': volume['disk_size_gb'],
+                'filesystem': volume['filesystem'],
+                'filesystem_args': volume['filesystem_args'],
+                'mountpoint': volume['mountpoint']
+            }
+            for volume in volumes if volume.get('source_volume') is None
+        ],
+        'networks': [network['vni'] for network in networks]
+    }
+    return hashlib.sha256(json.dumps(cache_data, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def get_script_arguments(vm_data, script_run_args):
+    """
+    Merge the profile's script arguments with the runtime arguments, which take precedence
+    """
+    script_arguments = dict()
+    for argument in vm_data['script_arguments']:
+        argument_name, argument_data = argument.split('=')
+        script_arguments[argument_name] = argument_data
+    if script_run_args is not None:
+        for argument in script_run_args:
+            argument_name, argument_data = argument.split('=')
+            script_arguments[argument_name] = argument_data
+    return script_arguments
 
-    time.sleep(2)
 
-    print("Starting provisioning of VM '{}' with profile '{}'".format(vm_name, vm_profile))
+def get_image_cache_volume_name(key, disk_id):
+    return 'pvcimg_{}_{}'.format(key[:16], disk_id)
+
+
+def get_image_cache_entry(zk_conn, key):
+    """
+    Return the cached volumes for key, or None if there is no complete entry in the cache.
+    """
+    with database(config) as (conn, cur):
+        query = "SELECT * FROM image_cache WHERE key = %s;"
+        args = (key,)
+        cur.execute(query, args)
+        entry = cur.fetchone()
+        if not entry:
+            return None
+
+        volumes = json.loads(entry['volumes'])
+        for volume in volumes:
+            if not pvc_ceph.verifyVolume(zk_conn, volume['pool'], volume['volume_name']):
+                # A cached volume went missing; drop the entry so it is captured again
+                query = "DELETE FROM image_cache WHERE key = %s;"
+                cur.execute(query, args)
+                return None
+
+        query = "UPDATE image_cache SET last_used = %s WHERE key = %s;"
+        args = (int(time.time()), key)
+        cur.execute(query, args)
+    return volumes
 
-    # Phase 0 - connect to databases
-    try:
-        db_conn, db_cur = open_database(config)
-    except Exception:
-        print('FATAL - failed to connect to Postgres')
-        raise Exception
 
+def evict_image_cache(zk_conn, pools):
+    """
+    Remove least recently used cache entries from pools until each has image_cache_min_free_ratio free.
+    Entries which still have copy-on-write children are skipped, since removing them would free nothing.
+    """
+    pool_space = dict()
+    for pool in pools:
+        try:
+            pool_stats = pvc_ceph.getPoolInformation(zk_conn, pool)['stats']
+            pool_space[pool] = {'free': int(pool_stats['free_bytes']), 'used': int(pool_stats['used_bytes'])}
+        except Exception:
+            continue
+
+    def needs_eviction(pool):
+        space = pool_space[pool]
+        total = space['free'] + space['used']
+        return total > 0 and space['free'] / total < image_cache_min_free_ratio
+
+    if not [pool for pool in pool_space if needs_eviction(pool)]:
+        return
+
+    with database(config) as (conn, cur):
+        query = "SELECT * FROM image_cache ORDER BY last_used ASC;"
+        cur.execute(query)
+        entries = cur.fetchall()
+        for entry in entries:
+            volumes = json.loads(entry['volumes'])
+            if not [volume for volume in volumes if volume['pool'] in pool_space and needs_eviction(volume['pool'])]:
+                continue
+
+            in_use = False
+            for volume in volumes:
+                try:
+                    snapshots = zkhandler.listchildren(zk_conn, '/ceph/snapshots/{}/{}'.format(volume['pool'], volume['volume_name']))
+                except Exception:
+                    continue
+                for snapshot in snapshots:
+                    if snapshot.startswith('clone_'):
+                        in_use = True
+            if in_use:
+                continue
+
+            print('Evicting cached image {}'.format(entry['key']))
+            for volume in volumes:
+                retcode, retmsg = pvc_ceph.remove_volume(zk_conn, volume['pool'], volume['volume_name'])
+                print(retmsg)
+                if retcode and volume['pool'] in pool_space:
+                    pool_space[volume['pool']]['free'] += volume['size_bytes']
+                    pool_space[volume['pool']]['used'] -= volume['size_bytes']
+            query = "DELETE FROM image_cache WHERE key = %s;"
+            args = (entry['key'],)
+            cur.execute(query, args)
+
+            if not [pool for pool in pool_space if needs_eviction(pool)]:
+                break
+
+
+def capture_image_cache(zk_conn, key, vm_name, volumes):
+    """
+    Copy the freshly-installed volumes of vm_name into the cache under key. The copies are full
+    (not copy-on-write) so that the cache entry is independent of the lifetime of the VM.
+    """
+    with database(config) as (conn, cur):
+        query = "SELECT key FROM image_cache WHERE key = %s;"
+        args = (key,)
+        cur.execute(query, args)
+        if cur.fetchone():
+            return False, 'Cached image {} has already been captured'.format(key)
+
+    cache_volumes = list()
+    for volume in volumes:
+        if volume.get('source_volume') is not None:
+            continue
+        cache_volume_name = get_image_cache_volume_name(key, volume['disk_id'])
+        # A volume without a cache entry is left over from a capture that was interrupted before it was recorded
+        if pvc_ceph.verifyVolume(zk_conn, volume['pool'], cache_volume_name):
+            print('Removing orphaned cached image volume {}/{}'.format(volume['pool'], cache_volume_name))
+            retcode, retmsg = pvc_ceph.remove_volume(zk_conn, volume['pool'], cache_volume_name)
+            if not retcode:
+                return False, 'Failed to remove orphaned volume of cached image {}: {}'.format(key, retmsg)
+        retcode, retmsg = pvc_ceph.clone_volume(zk_conn, volume['pool'], '{}_{}'.format(vm_name, volume['disk_id']), cache_volume_name, cow=False)
+        print(retmsg)
+        if not retcode:
+            for cache_volume in cache_volumes:
+                pvc_ceph.remove_volume(zk_conn, cache_volume['pool'], cache_volume['volume_name'])
+            return False, 'Failed to capture cached image {}: {}'.format(key, retmsg)
+        cache_volumes.append({
+            'pool': volume['pool'],
+            'disk_id': volume['disk_id'],
+            'volume_name': cache_volume_name,
+            'size_bytes': int(volume['disk_size_gb']) * 1024 * 1024 * 1024
+        })
+
+    conn, cur = open_database(config)
     try:
-        zk_conn = pvc_common.startZKConnection(config['coordinators'])
-    except Exception:
-        print('FATAL - failed to connect to Zookeeper')
-        raise Exception
+        now = int(time.time())
+        query = "INSERT INTO image_cache (key, volumes, size_bytes, created, last_used) VALUES (%s, %s, %s, %s, %s);"
+        args = (key, json.dumps(cache_volumes), sum([volume['size_bytes'] for volume in cache_volumes]), now, now)
+        cur.execute(query, args)
+    except Exception as e:
+        close_database(conn, cur, failed=True)
+        for cache_volume in cache_volumes:
+            pvc_ceph.remove_volume(zk_conn, cache_volume['pool'], cache_volume['volume_name'])
+        return False, 'Failed to record cached image {}: {}'.format(key, e)
+    close_database(conn, cur)
 
-    # Phase 1 - setup
-    #  * Get the profile elements
-    #  * Get the details from these elements
-    #  * Assemble a VM configuration dictionary
-    self.update_state(state='RUNNING', meta={'current': 1, 'total': 10, 'status': 'Collecting configuration'})
-    time.sleep(1)
+    evict_image_cache(zk_conn, set([volume['pool'] for volume in cache_volumes]))
 
-    vm_id = re.findall(r'/(\d+)$/', vm_name)
-    if not vm_id:
-        vm_id = 0
-    else:
-        vm_id = vm_id[0]
+    return True, 'Captured cached image {}'.format(key)
 
+
+#
+# Main VM provisioning function - executed by the Celery worker
+#
+def get_vm_configuration(cur, vm_profile):
+    """
+    Collect the profile and every template, script, and OVA element it references into a VM configuration dictionary
+    """
     vm_data = dict()
 
     # Get the profile information
     query = "SELECT * FROM profile WHERE name = %s"
     args = (vm_profile,)
-    db_cur.execute(query, args)
-    profile_data = db_cur.fetchone()
+    cur.execute(query, args)
+    profile_data = cur.fetchone()
+    if profile_data is None:
+        raise ClusterError('The profile "{}" does not exist.'.format(vm_profile))
     if profile_data.get('arguments'):
         vm_data['script_arguments'] = profile_data.get('arguments').split('|')
     else:
         vm_data['script_arguments'] = []
 
-    if profile_data.get('profile_type') == 'ova':
-        is_ova_install = True
-        is_script_install = False  # By definition
-    else:
-        is_ova_install = False
+    is_ova_install = profile_data.get('profile_type') == 'ova'
 
     # Get the system details
     query = 'SELECT * FROM system_template WHERE id = %s'
     args = (profile_data['system_template'],)
-    db_cur.execute(query, args)
-    vm_data['system_details'] = db_cur.fetchone()
+    cur.execute(query, args)
+    vm_data['system_details'] = cur.fetchone()
 
     # Get the MAC template
     query = 'SELECT mac_template FROM network_template WHERE id = %s'
     args = (profile_data['network_template'],)
-    db_cur.execute(query, args)
-    db_row = db_cur.fetchone()
+    cur.execute(query, args)
+    db_row = cur.fetchone()
     if db_row:
         vm_data['mac_template'] = db_row.get('mac_template')
     else:
@@ -1138,44 +1286,120 @@ def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_r
     # Get the networks
     query = 'SELECT * FROM network WHERE network_template = %s'
     args = (profile_data['network_template'],)
-    db_cur.execute(query, args)
-    vm_data['networks'] = db_cur.fetchall()
+    cur.execute(query, args)
+    vm_data['networks'] = cur.fetchall()
 
     # Get the storage volumes
     # ORDER BY ensures disks are always in the sdX/vdX order, regardless of add order
     query = 'SELECT * FROM storage WHERE storage_template = %s ORDER BY disk_id'
     args = (profile_data['storage_template'],)
-    db_cur.execute(query, args)
-    vm_data['volumes'] = db_cur.fetchall()
+    cur.execute(query, args)
+    vm_data['volumes'] = cur.fetchall()
 
     # Get the script
     query = 'SELECT script FROM script WHERE id = %s'
     args = (profile_data['script'],)
-    db_cur.execute(query, args)
-    db_row = db_cur.fetchone()
+    cur.execute(query, args)
+    db_row = cur.fetchone()
     if db_row:
         vm_data['script'] = db_row.get('script')
     else:
         vm_data['script'] = None
 
-    if vm_data['script'] and not is_ova_install:
-        is_script_install = True
-    else:
-        is_script_install = False
-
     # Get the OVA details
     if is_ova_install:
         query = 'SELECT * FROM ova WHERE id = %s'
         args = (profile_data['ova'],)
-        db_cur.execute(query, args)
-        vm_data['ova_details'] = db_cur.fetchone()
+        cur.execute(query, args)
+        vm_data['ova_details'] = cur.fetchone()
 
         query = 'SELECT * FROM ova_volume WHERE ova = %s'
         args = (profile_data['ova'],)
-        db_cur.execute(query, args)
-        vm_data['volumes'] = db_cur.fetchall()
+        cur.execute(query, args)
+        vm_data['volumes'] = cur.fetchall()
+
+    return profile_data, vm_data
+
+
+def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_run_args=[], batch=None):
+    # Runtime imports
+    import importlib
+    import uuid
+    import datetime
+    import random
+
+    # Track the duration of each phase, reported in the task metadata
+    phase_durations = dict()
+    phase_timer = {'phase': None, 'start': None}
+
+    def set_state(current, status):
+        self.update_state(state='RUNNING', meta={'current': current, 'total': 10, 'status': status, 'phase_durations': phase_durations})
+
+    def end_phase():
+        if phase_timer['phase'] is not None:
+            phase_durations[str(phase_timer['phase'])] = round(time.monotonic() - phase_timer['start'], 3)
+            phase_timer['phase'] = None
+
+    def start_phase(current, status):
+        end_phase()
+        phase_timer['phase'] = current
+        phase_timer['start'] = time.monotonic()
+        set_state(current, status)
+
+    # Run a per-volume function over volumes in parallel, raising the first failure once all have finished
+    def run_volume_tasks(function, volumes):
+        with ThreadPoolExecutor(max_workers=storage_workers) as executor:
+            futures = [executor.submit(function, volume) for volume in volumes]
+        for future in futures:
+            future.result()
+
+    print("Starting provisioning of VM '{}' with profile '{}'".format(vm_name, vm_profile))
+
+    # Phase 0 - connect to databases
+    if batch is not None:
+        # Batches share a single Zookeeper connection, and have already read their configuration and looked up
+        # their cached image; only capturing a missing cached image opens a database connection
+        zk_conn = batch.zk_conn
+    else:
+        try:
+            zk_conn = pvc_common.startZKConnection(config['coordinators'])
+        except Exception:
+            print('FATAL - failed to connect to Zookeeper')
+            raise Exception
+
+    # Phase 1 - setup
+    #  * Get the profile elements
+    #  * Get the details from these elements
+    #  * Assemble a VM configuration dictionary
+    start_phase(1, 'Collecting configuration')
+
+    vm_id = re.findall(r'/(\d+)$/', vm_name)
+    if not vm_id:
+        vm_id = 0
+    else:
+        vm_id = vm_id[0]
 
-    close_database(db_conn, db_cur)
+    if batch is not None:
+        # The batch has already collected the configuration once for all of its VMs
+        profile_data = copy.deepcopy(batch.profile_data)
+        vm_data = copy.deepcopy(batch.vm_data)
+    else:
+        try:
+            with database(config) as (db_conn, db_cur):
+                profile_data, vm_data = get_vm_configuration(db_cur, vm_profile)
+        except Exception as e:
+            pvc_common.stopZKConnection(zk_conn)
+            raise ClusterError('Failed to collect the configuration of profile "{}": {}'.format(vm_profile, e))
+
+    if profile_data.get('profile_type') == 'ova':
+        is_ova_install = True
+    else:
+        is_ova_install = False
+
+    if vm_data['script'] and not is_ova_install:
+        is_script_install = True
+    else:
+        is_script_install = False
 
     print("VM configuration data:\n{}".format(json.dumps(vm_data, sort_keys=True, indent=2)))
 
@@ -1184,8 +1408,7 @@ def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_r
     #  * Ensure that all networks are valid
     #  * Ensure that there is enough disk space in the Ceph cluster for the disks
     # This is the "safe fail" step when an invalid configuration will be caught
-    self.update_state(state='RUNNING', meta={'current': 2, 'total': 10, 'status': 'Verifying configuration against cluster'})
-    time.sleep(1)
+    start_phase(2, 'Verifying configuration against cluster')
 
     # Verify that a VM with this name does not already exist
     if pvc_vm.searchClusterByName(zk_conn, vm_name):
@@ -1195,10 +1418,12 @@ def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_r
     _discard, nodes = pvc_node.get_list(zk_conn, None)
     target_node = None
     last_free = 0
+    node_candidates = list()
     for node in nodes:
         # Skip the node if it is not ready to run VMs
         if node['daemon_state'] != "run" or node['domain_state'] != "ready":
             continue
+        node_candidates.append(node['name'])
         # Skip the node if its free memory is less than the new VM's size, plus a 512MB buffer
         if node['memory']['free'] < (vm_data['system_details']['vram_mb'] + 512):
             continue
@@ -1206,11 +1431,17 @@ def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_r
         if node['memory']['free'] > last_free:
             last_free = node['memory']['free']
             target_node = node['name']
-    # Raise if no node was found
-    if not target_node:
-        raise ClusterError("No ready cluster node contains at least {}+512 MB of free RAM.".format(vm_data['system_details']['vram_mb']))
 
-    print('Selecting target node "{}" with "{}" MB free RAM'.format(target_node, last_free))
+    if batch is None:
+        # Raise if no node was found
+        if not target_node:
+            raise ClusterError("No ready cluster node contains at least {}+512 MB of free RAM.".format(vm_data['system_details']['vram_mb']))
+
+        print('Selecting target node "{}" with "{}" MB free RAM'.format(target_node, last_free))
+    else:
+        # Within a batch, the live free memory already includes VMs the batch has started, so the target node
+        # is chosen later against the batch's own snapshot instead
+        print('Deferring target node selection to the batch')
 
     # Verify that all configured networks are present on the cluster
     cluster_networks, _discard = pvc_network.getClusterNetworkList(zk_conn)
@@ -1280,8 +1511,43 @@ def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_r
     # Phase 3 - provisioning script preparation
     #  * Import the provisioning script as a library with importlib
     #  * Ensure the required function(s) are present
-    self.update_state(state='RUNNING', meta={'current': 3, 'total': 10, 'status': 'Preparing provisioning script'})
-    time.sleep(1)
+    start_phase(3, 'Preparing provisioning script')
+
+    is_cache_install = False
+    image_cache_key = None
+    capture_image = False
+
+    if is_script_install:
+        # Parse the script and runtime arguments
+        script_arguments = get_script_arguments(vm_data, script_run_args)
+
+        # Look for a cached image of this script's output
+        if profile_data.get('image_cache') and batch is not None:
+            # The batch looked up the cached image once; its first script install captures the image if it was
+            # missing, and the other VMs wait for that capture to clone from it instead of running the script
+            image_cache_key = batch.image_cache_key
+            batch.gate.hold(None)
+            set_state(3, 'Waiting for the cached image')
+            image_cache_action = batch.claim_image_cache(vm_name)
+            batch.gate.hold('shared')
+            if image_cache_action == 'cached':
+                print("Using cached image {}; the provisioning script will not be run".format(image_cache_key))
+                is_cache_install = True
+                is_script_install = False
+            elif image_cache_action == 'capture':
+                print("No cached image {}; it will be captured after the provisioning script runs".format(image_cache_key))
+            else:
+                print("Capturing cached image {} failed earlier in this batch; running the provisioning script uncached".format(image_cache_key))
+                image_cache_key = None
+        elif profile_data.get('image_cache'):
+            image_cache_key = get_image_cache_key(vm_data['script'], script_arguments, vm_data['volumes'], vm_data['networks'])
+            image_cache_volumes = get_image_cache_entry(zk_conn, image_cache_key)
+            if image_cache_volumes is not None:
+                print("Using cached image {}; the provisioning script will not be run".format(image_cache_key))
+                is_cache_install = True
+                is_script_install = False
+            else:
+                print("No cached image {}; it will be captured after the provisioning script runs".format(image_cache_key))
 
     if is_script_install:
         # Write the script out to a temporary file
@@ -1307,8 +1573,7 @@ def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_r
 
     # Phase 4 - configuration creation
     #  * Create the libvirt XML configuration
-    self.update_state(state='RUNNING', meta={'current': 4, 'total': 10, 'status': 'Preparing Libvirt XML configuration'})
-    time.sleep(1)
+    start_phase(4, 'Preparing Libvirt XML configuration')
 
     print("Creating Libvirt configuration")
 
@@ -1426,245 +1691,506 @@ def create_vm(self, vm_name, vm_profile, define_vm=True, start_vm=True, script_r
 
     print("Final VM schema:\n{}\n".format(vm_schema))
 
-    # All the following steps may require cleanup later on, so catch them here and do cleanup in a Finally block
+    # Wait for a free provisioning slot on a target node and on every pool the VM uses; within a batch,
+    # the node is chosen against the memory already claimed by earlier VMs of the batch
+    if batch is not None:
+        set_state(4, 'Waiting for a free provisioning slot')
+        # Never wait for a slot while holding the batch gate, since the slot holders may need it exclusively
+        batch.gate.hold(None)
+        target_node = batch.acquire_node(node_candidates, vm_data['system_details']['vram_mb'] + 512)
+        batch.acquire_pools(pools.keys())
+        batch.gate.hold('shared')
+        print('Selecting batch target node "{}"'.format(target_node))
+
+    temp_dir = None
+    vm_started = False
+
+    # Hold the batch slots through every following step, however they end
     try:
-        # Phase 5 - definition
-        #  * Create the VM in the PVC cluster
-        self.update_state(state='RUNNING', meta={'current': 5, 'total': 10, 'status': 'Defining VM on the cluster'})
-        time.sleep(1)
-
-        if define_vm:
-            print("Defining VM on cluster")
-            node_limit = vm_data['system_details']['node_limit']
-            if node_limit:
-                node_limit = node_limit.split(',')
-            node_selector = vm_data['system_details']['node_selector']
-            node_autostart = vm_data['system_details']['node_autostart']
-            migration_method = vm_data['system_details']['migration_method']
-            retcode, retmsg = pvc_vm.define_vm(zk_conn, vm_schema.strip(), target_node, node_limit, node_selector, node_autostart, migration_method, vm_profile, initial_state='provision')
-            print(retmsg)
-        else:
-            print("Skipping VM definition")
-
-        # Phase 6 - disk creation
-        #  * Create each Ceph storage volume for the disks
-        self.update_state(state='RUNNING', meta={'current': 6, 'total': 10, 'status': 'Creating storage volumes'})
-        time.sleep(1)
-
-        for volume in vm_data['volumes']:
-            if volume.get('source_volume') is not None:
-                success, message = pvc_ceph.clone_volume(zk_conn, volume['pool'], "{}_{}".format(vm_name, volume['disk_id']), volume['source_volume'])
-                print(message)
-                if not success:
-                    raise ProvisioningError('Failed to clone volume "{}" to "{}".'.format(volume['source_volume'], volume['disk_id']))
+        # All the following steps may require cleanup later on, so catch them here and do cleanup in a Finally block
+        try:
+            # Phase 5 - definition
+            #  * Create the VM in the PVC cluster
+            start_phase(5, 'Defining VM on the cluster')
+
+            if define_vm:
+                print("Defining VM on cluster")
+                node_limit = vm_data['system_details']['node_limit']
+                if node_limit:
+                    node_limit = node_limit.split(',')
+                node_selector = vm_data['system_details']['node_selector']
+                node_autostart = vm_data['system_details']['node_autostart']
+                migration_method = vm_data['system_details']['migration_method']
+                retcode, retmsg = pvc_vm.define_vm(zk_conn, vm_schema.strip(), target_node, node_limit, node_selector, node_autostart, migration_method, vm_profile, initial_state='provision')
+                print(retmsg)
             else:
-                success, message = pvc_ceph.add_volume(zk_conn, volume['pool'], "{}_{}".format(vm_name, volume['disk_id']), "{}G".format(volume['disk_size_gb']))
-                print(message)
-                if not success:
-                    raise ProvisioningError('Failed to create volume "{}".'.format(volume['disk_id']))
-
-        # Phase 7 - disk mapping
-        #  * Map each volume to the local host in order
-        #  * Format each volume with any specified filesystems
-        #  * If any mountpoints are specified, create a temporary mount directory
-        #  * Mount any volumes to their respective mountpoints
-        self.update_state(state='RUNNING', meta={'current': 7, 'total': 10, 'status': 'Mapping, formatting, and mounting storage volumes locally'})
-        time.sleep(1)
+                print("Skipping VM definition")
 
-        for volume in vm_data['volumes']:
-            dst_volume_name = "{}_{}".format(vm_name, volume['disk_id'])
-            dst_volume = "{}/{}".format(volume['pool'], dst_volume_name)
-
-            if is_ova_install:
-                src_volume_name = volume['volume_name']
-                src_volume = "{}/{}".format(volume['pool'], src_volume_name)
-
-                print('Converting {} source volume {} to raw format on {}'.format(volume['volume_format'], src_volume, dst_volume))
-
-                # Map the target RBD device
-                retcode, retmsg = pvc_ceph.map_volume(zk_conn, volume['pool'], dst_volume_name)
-                if not retcode:
-                    raise ProvisioningError('Failed to map destination volume "{}": {}'.format(dst_volume_name, retmsg))
-                # Map the source RBD device
-                retcode, retmsg = pvc_ceph.map_volume(zk_conn, volume['pool'], src_volume_name)
-                if not retcode:
-                    raise ProvisioningError('Failed to map source volume "{}": {}'.format(src_volume_name, retmsg))
-                # Convert from source to target
-                retcode, stdout, stderr = pvc_common.run_os_command(
-                    'qemu-img convert -C -f {} -O raw {} {}'.format(
-                        volume['volume_format'],
-                        "/dev/rbd/{}".format(src_volume),
-                        "/dev/rbd/{}".format(dst_volume)
-                    )
-                )
-                if retcode:
-                    raise ProvisioningError('Failed to convert {} volume "{}" to raw volume "{}": {}'.format(volume['volume_format'], src_volume, dst_volume, stderr))
-
-                # Unmap the source RBD device (don't bother later)
-                retcode, retmsg = pvc_ceph.unmap_volume(zk_conn, volume['pool'], src_volume_name)
-                if not retcode:
-                    raise ProvisioningError('Failed to unmap source volume "{}": {}'.format(src_volume_name, retmsg))
-                # Unmap the target RBD device (don't bother later)
-                retcode, retmsg = pvc_ceph.unmap_volume(zk_conn, volume['pool'], dst_volume_name)
-                if not retcode:
-                    raise ProvisioningError('Failed to unmap destination volume "{}": {}'.format(dst_volume_name, retmsg))
-            else:
+            # Phase 6 - disk creation
+            #  * Create each Ceph storage volume for the disks, in parallel
+            start_phase(6, 'Creating storage volumes')
+
+            def create_volume(volume):
                 if volume.get('source_volume') is not None:
-                    continue
+                    success, message = pvc_ceph.clone_volume(zk_conn, volume['pool'], volume['source_volume'], "{}_{}".format(vm_name, volume['disk_id']), cow=True)
+                    print(message)
+                    if not success:
+                        raise ProvisioningError('Failed to clone volume "{}" to "{}".'.format(volume['source_volume'], volume['disk_id']))
+                elif is_cache_install:
+                    cache_volume_name = get_image_cache_volume_name(image_cache_key, volume['disk_id'])
+                    success, message = pvc_ceph.clone_volume(zk_conn, volume['pool'], cache_volume_name, "{}_{}".format(vm_name, volume['disk_id']), cow=True)
+                    print(message)
+                    if not success:
+                        raise ProvisioningError('Failed to clone cached volume "{}" to "{}".'.format(cache_volume_name, volume['disk_id']))
+                else:
+                    success, message = pvc_ceph.add_volume(zk_conn, volume['pool'], "{}_{}".format(vm_name, volume['disk_id']), "{}G".format(volume['disk_size_gb']))
+                    print(message)
+                    if not success:
+                        raise ProvisioningError('Failed to create volume "{}".'.format(volume['disk_id']))
+
+            run_volume_tasks(create_volume, vm_data['volumes'])
+
+            # Phase 7 - disk mapping
+            #  * Map each volume to the local host, in parallel
+            #  * Format each volume with any specified filesystems, in parallel
+            #  * If any mountpoints are specified, create a temporary mount directory
+            #  * Mount any volumes to their respective mountpoints, in order
+            start_phase(7, 'Mapping, formatting, and mounting storage volumes locally')
+
+            # Provisioning scripts may chroot, which moves every thread of the process; within a batch, a script
+            # install therefore holds the batch gate exclusively from formatting until its mounts are cleaned up
+            if batch is not None and is_script_install:
+                set_state(7, 'Waiting for exclusive access to run the provisioning script')
+                batch.gate.hold('exclusive')
+
+            def prepare_volume(volume):
+                dst_volume_name = "{}_{}".format(vm_name, volume['disk_id'])
+                dst_volume = "{}/{}".format(volume['pool'], dst_volume_name)
+
+                if is_ova_install:
+                    src_volume_name = volume['volume_name']
+                    src_volume = "{}/{}".format(volume['pool'], src_volume_name)
+
+                    print('Converting {} source volume {} to raw format on {}'.format(volume['volume_format'], src_volume, dst_volume))
+
+                    # Convert from source to target directly through librbd
+                    def conversion_progress(percent, rate):
+                        set_state(7, 'Converting volume {}: {}% ({}/s)'.format(dst_volume, percent, pvc_ceph.format_bytes_tohuman(rate)))
+
+                    retcode, retmsg = pvc_ceph.convert_volume(zk_conn, volume['pool'], src_volume_name, volume['volume_format'], dst_volume_name, progress_callback=conversion_progress)
+                    print(retmsg)
+                    if not retcode:
+                        raise ProvisioningError('Failed to convert {} volume "{}" to raw volume "{}": {}'.format(volume['volume_format'], src_volume, dst_volume, retmsg))
+                else:
+                    if volume.get('source_volume') is not None:
+                        return
 
-                if volume.get('filesystem') is None:
-                    continue
+                    # Cached images already contain their filesystems
+                    if is_cache_install:
+                        return
 
-                print("Creating {} filesystem on {}:\n{}".format(volume['filesystem'], dst_volume, stdout))
+                    if volume.get('filesystem') is None:
+                        return
 
-                filesystem_args_list = list()
-                for arg in volume['filesystem_args'].split():
-                    arg_entry, arg_data = arg.split('=')
-                    filesystem_args_list.append(arg_entry)
-                    filesystem_args_list.append(arg_data)
-                filesystem_args = ' '.join(filesystem_args_list)
+                    print("Creating {} filesystem on {}".format(volume['filesystem'], dst_volume))
 
-                # Map the RBD device
-                retcode, retmsg = pvc_ceph.map_volume(zk_conn, volume['pool'], dst_volume_name)
-                if not retcode:
-                    raise ProvisioningError('Failed to map volume "{}": {}'.format(dst_volume, retmsg))
+                    filesystem_args_list = list()
+                    for arg in volume['filesystem_args'].split():
+                        arg_entry, arg_data = arg.split('=')
+                        filesystem_args_list.append(arg_entry)
+                        filesystem_args_list.append(arg_data)
+                    filesystem_args = ' '.join(filesystem_args_list)
+
+                    # Map the RBD device
+                    retcode, retmsg = pvc_ceph.map_volume(zk_conn, volume['pool'], dst_volume_name)
+                    if not retcode:
+                        raise ProvisioningError('Failed to map volume "{}": {}'.format(dst_volume, retmsg))
+
+                    # Create the filesystem
+                    if volume['filesystem'] == 'swap':
+                        retcode, stdout, stderr = pvc_common.run_os_command("mkswap -f /dev/rbd/{}".format(dst_volume))
+                        if retcode:
+                            raise ProvisioningError('Failed to create swap on "{}": {}'.format(dst_volume, stderr))
+                    else:
+                        retcode, stdout, stderr = pvc_common.run_os_command("mkfs.{} {} /dev/rbd/{}".format(volume['filesystem'], filesystem_args, dst_volume))
+                        if retcode:
+                            raise ProvisioningError('Failed to create {} filesystem on "{}": {}'.format(volume['filesystem'], dst_volume, stderr))
+
+            run_volume_tasks(prepare_volume, vm_data['volumes'])
+
+            if is_script_install:
+                # Create temporary directory
+                retcode, stdout, stderr = pvc_common.run_os_command("mktemp -d")
+                if retcode:
+                    raise ProvisioningError("Failed to create a temporary directory: {}".format(stderr))
+                temp_dir = stdout.strip()
 
-                # Create the filesystem
-                if volume['filesystem'] == 'swap':
-                    retcode, stdout, stderr = pvc_common.run_os_command("mkswap -f /dev/rbd/{}".format(dst_volume))
+                for volume in vm_data['volumes']:
+                    if volume['source_volume'] is not None:
+                        continue
+
+                    if not volume['mountpoint'] or volume['mountpoint'] == 'swap':
+                        continue
+
+                    mapped_dst_volume = "/dev/rbd/{}/{}_{}".format(volume['pool'], vm_name, volume['disk_id'])
+                    mount_path = "{}{}".format(temp_dir, volume['mountpoint'])
+
+                    # Ensure the mount path exists (within the filesystems)
+                    retcode, stdout, stderr = pvc_common.run_os_command("mkdir -p {}".format(mount_path))
                     if retcode:
-                        raise ProvisioningError('Failed to create swap on "{}": {}'.format(dst_volume, stderr))
-                else:
-                    retcode, stdout, stderr = pvc_common.run_os_command("mkfs.{} {} /dev/rbd/{}".format(volume['filesystem'], filesystem_args, dst_volume))
+                        raise ProvisioningError('Failed to create mountpoint "{}": {}'.format(mount_path, stderr))
+
+                    # Mount filesystems to temporary directory
+                    retcode, stdout, stderr = pvc_common.run_os_command("mount {} {}".format(mapped_dst_volume, mount_path))
                     if retcode:
-                        raise ProvisioningError('Failed to create {} filesystem on "{}": {}'.format(volume['filesystem'], dst_volume, stderr))
+                        raise ProvisioningError('Failed to mount "{}" on "{}": {}'.format(mapped_dst_volume, mount_path, stderr))
 
-        if is_script_install:
-            # Create temporary directory
-            retcode, stdout, stderr = pvc_common.run_os_command("mktemp -d")
-            if retcode:
-                raise ProvisioningError("Failed to create a temporary directory: {}".format(stderr))
-            temp_dir = stdout.strip()
+                    print("Successfully mounted {} on {}".format(mapped_dst_volume, mount_path))
 
-            for volume in vm_data['volumes']:
-                if volume['source_volume'] is not None:
-                    continue
+            # Phase 8 - provisioning script execution
+            #  * Execute the provisioning script main function ("install") passing any custom arguments
+            start_phase(8, 'Executing provisioning script')
 
-                if not volume['mountpoint'] or volume['mountpoint'] == 'swap':
-                    continue
+            if is_script_install:
+                print("Running installer script")
 
-                mapped_dst_volume = "/dev/rbd/{}/{}_{}".format(volume['pool'], vm_name, volume['disk_id'])
-                mount_path = "{}{}".format(temp_dir, volume['mountpoint'])
+                print("Script arguments: {}".format(script_arguments))
 
-                # Ensure the mount path exists (within the filesystems)
-                retcode, stdout, stderr = pvc_common.run_os_command("mkdir -p {}".format(mount_path))
-                if retcode:
-                    raise ProvisioningError('Failed to create mountpoint "{}": {}'.format(mount_path, stderr))
+                # Run the script
+                try:
+                    installer_script.install(
+                        vm_name=vm_name,
+                        vm_id=vm_id,
+                        temporary_directory=temp_dir,
+                        disks=vm_data['volumes'],
+                        networks=vm_data['networks'],
+                        **script_arguments
+                    )
+                except Exception as e:
+                    raise ProvisioningError('Failed to run install script: {}'.format(e))
+
+                # Capture the result once the volumes are unmounted and unmapped below
+                if image_cache_key is not None:
+                    capture_image = True
+
+        except Exception as e:
+            start_vm = False
+            raise e
+
+        # Always perform the cleanup steps
+        finally:
+            # Phase 9 - install cleanup
+            #  * Unmount any mounted volumes
+            #  * Remove any temporary directories
+            start_phase(9, 'Cleaning up local mounts and directories')
+
+            if not is_ova_install and not is_cache_install:
+                for volume in list(reversed(vm_data['volumes'])):
+                    if volume.get('source_volume') is not None:
+                        continue
+
+                    if is_script_install and temp_dir is not None:
+                        # Unmount the volume
+                        if volume.get('mountpoint') is not None and volume.get('mountpoint') != 'swap':
+                            print("Cleaning up mount {}{}".format(temp_dir, volume['mountpoint']))
+
+                            mount_path = "{}{}".format(temp_dir, volume['mountpoint'])
+
+                            # Make sure any bind mounts or submounts are unmounted first
+                            if volume['mountpoint'] == '/':
+                                retcode, stdout, stderr = pvc_common.run_os_command('umount {}/**/**'.format(mount_path))
+                                retcode, stdout, stderr = pvc_common.run_os_command('umount {}/**'.format(mount_path))
+
+                            retcode, stdout, stderr = pvc_common.run_os_command('umount {}'.format(mount_path))
+                            if retcode:
+                                print('Failed to unmount "{}": {}'.format(mount_path, stderr))
+
+                    # Unmap the RBD device
+                    if volume['filesystem']:
+                        print("Cleaning up RBD mapping /dev/rbd/{}/{}_{}".format(volume['pool'], vm_name, volume['disk_id']))
+
+                        rbd_volume = "/dev/rbd/{}/{}_{}".format(volume['pool'], vm_name, volume['disk_id'])
+                        retcode, stdout, stderr = pvc_common.run_os_command("rbd unmap {}".format(rbd_volume))
+                        if retcode:
+                            print('Failed to unmap volume "{}": {}'.format(rbd_volume, stderr))
 
-                # Mount filesystems to temporary directory
-                retcode, stdout, stderr = pvc_common.run_os_command("mount {} {}".format(mapped_dst_volume, mount_path))
-                if retcode:
-                    raise ProvisioningError('Failed to mount "{}" on "{}": {}'.format(mapped_dst_volume, mount_path, stderr))
-
-                print("Successfully mounted {} on {}".format(mapped_dst_volume, mount_path))
-
-        # Phase 8 - provisioning script execution
-        #  * Execute the provisioning script main function ("install") passing any custom arguments
-        self.update_state(state='RUNNING', meta={'current': 8, 'total': 10, 'status': 'Executing provisioning script'})
-        time.sleep(1)
-
-        if is_script_install:
-            print("Running installer script")
-
-            # Parse the script arguments
-            script_arguments = dict()
-            for argument in vm_data['script_arguments']:
-                argument_name, argument_data = argument.split('=')
-                script_arguments[argument_name] = argument_data
-
-            # Parse the runtime arguments
-            if script_run_args is not None:
-                for argument in script_run_args:
-                    argument_name, argument_data = argument.split('=')
-                    script_arguments[argument_name] = argument_data
-
-            print("Script arguments: {}".format(script_arguments))
-
-            # Run the script
-            try:
-                installer_script.install(
-                    vm_name=vm_name,
-                    vm_id=vm_id,
-                    temporary_directory=temp_dir,
-                    disks=vm_data['volumes'],
-                    networks=vm_data['networks'],
-                    **script_arguments
-                )
-            except Exception as e:
-                raise ProvisioningError('Failed to run install script: {}'.format(e))
+            print("Cleaning up temporary directories and files")
 
-    except Exception as e:
-        start_vm = False
-        raise e
+            if is_script_install:
+                # Remove temporary mount directory (don't fail if not removed)
+                if temp_dir is not None:
+                    retcode, stdout, stderr = pvc_common.run_os_command("rmdir {}".format(temp_dir))
+                    if retcode:
+                        print('Failed to delete temporary directory "{}": {}'.format(temp_dir, stderr))
+
+                # Remote temporary script (don't fail if not removed)
+                retcode, stdout, stderr = pvc_common.run_os_command("rm -f {}".format(script_file))
+                if retcode:
+                    print('Failed to delete temporary script file "{}": {}'.format(script_file, stderr))
+
+            if batch is not None:
+                batch.gate.hold('shared')
+
+            # Save the installed volumes as a cached image for future VMs with the same script and layout
+            if capture_image:
+                set_state(9, 'Capturing cached image')
+                retcode, retmsg = capture_image_cache(zk_conn, image_cache_key, vm_name, vm_data['volumes'])
+                print(retmsg)
+                if batch is not None:
+                    batch.end_image_capture(vm_name, 'cached' if retcode else 'failed')
+
+            # Phase 10 - startup
+            #  * Start the VM in the PVC cluster
+            if start_vm:
+                start_phase(10, 'Starting VM')
+                retcode, retmsg = pvc_vm.start_vm(zk_conn, vm_name)
+                print(retmsg)
+                vm_started = retcode
+
+            end_phase()
+            print("Phase durations: {}".format(phase_durations))
 
-    # Always perform the cleanup steps
     finally:
-        # Phase 9 - install cleanup
-        #  * Unmount any mounted volumes
-        #  * Remove any temporary directories
-        self.update_state(state='RUNNING', meta={'current': 9, 'total': 10, 'status': 'Cleaning up local mounts and directories'})
-        time.sleep(1)
-
-        if not is_ova_install:
-            for volume in list(reversed(vm_data['volumes'])):
-                if volume.get('source_volume') is not None:
-                    continue
+        if batch is not None:
+            batch.release(target_node, pools.keys(), vm_data['system_details']['vram_mb'] + 512, keep_claim=vm_started)
 
-                if is_script_install:
-                    # Unmount the volume
-                    if volume.get('mountpoint') is not None and volume.get('mountpoint') != 'swap':
-                        print("Cleaning up mount {}{}".format(temp_dir, volume['mountpoint']))
+    if batch is None:
+        pvc_common.stopZKConnection(zk_conn)
+    return {'status': 'VM "{}" with profile "{}" has been provisioned and started successfully'.format(vm_name, vm_profile), 'current': 10, 'total': 10, 'phase_durations': phase_durations}
 
-                        mount_path = "{}{}".format(temp_dir, volume['mountpoint'])
 
-                        # Make sure any bind mounts or submounts are unmounted first
-                        if volume['mountpoint'] == '/':
-                            retcode, stdout, stderr = pvc_common.run_os_command('umount {}/**/**'.format(mount_path))
-                            retcode, stdout, stderr = pvc_common.run_os_command('umount {}/**'.format(mount_path))
+#
+# Batch VM provisioning - executed by the Celery worker
+#
+class BatchGate(object):
+    """
+    Shared/exclusive gate between the threads of a batch. Every thread holds it shared while it runs commands,
+    and a script install holds it exclusively, since a chroot in the script affects the whole process.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared = 0
+        self.exclusive = False
+        self.exclusive_waiting = 0
+        self.local = threading.local()
+
+    def hold(self, mode):
+        """
+        Switch the calling thread's hold to mode ('shared', 'exclusive', or None to release it)
+        """
+        current = getattr(self.local, 'mode', None)
+        if current == mode:
+            return
+        with self.condition:
+            if current == 'shared':
+                self.shared -= 1
+            elif current == 'exclusive':
+                self.exclusive = False
+            self.local.mode = None
+            self.condition.notify_all()
+
+            if mode == 'shared':
+                # Waiting exclusive holders go first, so a stream of shared holders cannot starve them
+                while self.exclusive or self.exclusive_waiting:
+                    self.condition.wait()
+                self.shared += 1
+            elif mode == 'exclusive':
+                self.exclusive_waiting += 1
+                while self.exclusive or self.shared:
+                    self.condition.wait()
+                self.exclusive_waiting -= 1
+                self.exclusive = True
+            self.local.mode = mode
+
+
+class ProvisioningBatch(object):
+    """
+    State shared by the create_vm runs of one batch: the configuration collected once from the database,
+    a Zookeeper connection, the concurrency limits per pool and per target node, and the aggregated progress
+    """
+    def __init__(self, task, zk_conn, profile_data, vm_data, vm_names, node_free, pool_concurrency, node_concurrency, image_cache_key=None, image_cached=False):
+        self.task = task
+        self.zk_conn = zk_conn
+        self.profile_data = profile_data
+        self.vm_data = vm_data
+        self.pool_concurrency = pool_concurrency
+        self.node_concurrency = node_concurrency
+
+        self.gate = BatchGate()
+        self.condition = threading.Condition()
+        # Free memory of each node when the batch started; VMs started by the batch are tracked in node_claimed
+        self.node_free = node_free
+        self.pool_active = dict()
+        self.node_active = dict()
+        self.node_claimed = dict()
+        # The cached image shared by the batch's VMs: 'cached', 'capturing', 'failed', or None if not yet captured
+        self.image_cache_key = image_cache_key
+        self.image_cache_state = 'cached' if image_cached else None
+        self.image_cache_capturer = None
+
+        self.state_lock = threading.Lock()
+        self.vms = dict()
+        for vm_name in vm_names:
+            self.vms[vm_name] = {'state': 'PENDING', 'current': 0, 'total': 10, 'status': 'Pending job start'}
+
+    def acquire_node(self, node_candidates, memory):
+        """
+        Block until a candidate node has a free provisioning slot, then claim memory on the one with the most left
+        """
+        with self.condition:
+            while True:
+                fitting = [
+                    node for node in node_candidates
+                    if node in self.node_free and self.node_free[node] - self.node_claimed.get(node, 0) >= memory
+                ]
+                if not fitting:
+                    raise ClusterError('No ready cluster node has {} MB of free RAM left for this batch.'.format(memory))
+                available = [node for node in fitting if self.node_active.get(node, 0) < self.node_concurrency]
+                if available:
+                    target_node = max(available, key=lambda node: self.node_free[node] - self.node_claimed.get(node, 0))
+                    self.node_active[target_node] = self.node_active.get(target_node, 0) + 1
+                    self.node_claimed[target_node] = self.node_claimed.get(target_node, 0) + memory
+                    return target_node
+                self.condition.wait()
+
+    def acquire_pools(self, pools):
+        """
+        Block until every pool in pools has a free provisioning slot, then take them all at once
+        """
+        with self.condition:
+            while [pool for pool in pools if self.pool_active.get(pool, 0) >= self.pool_concurrency]:
+                self.condition.wait()
+            for pool in pools:
+                self.pool_active[pool] = self.pool_active.get(pool, 0) + 1
+
+    def release(self, node, pools, memory, keep_claim=False):
+        # The memory claimed on the node is kept only if the VM was started and now occupies it
+        with self.condition:
+            self.node_active[node] -= 1
+            if not keep_claim:
+                self.node_claimed[node] -= memory
+            for pool in pools:
+                self.pool_active[pool] -= 1
+            self.condition.notify_all()
+
+    def claim_image_cache(self, vm_name):
+        """
+        Block while another VM captures the cached image, then return 'cached' if the image can be cloned,
+        'capture' if vm_name should run the provisioning script and capture it, or 'failed' if capturing failed
+        """
+        with self.condition:
+            while self.image_cache_state == 'capturing':
+                self.condition.wait()
+            if self.image_cache_state is None:
+                self.image_cache_state = 'capturing'
+                self.image_cache_capturer = vm_name
+                return 'capture'
+            return self.image_cache_state
+
+    def end_image_capture(self, vm_name, state=None):
+        # A capturing VM that failed before its capture leaves the image to be captured by the next one
+        with self.condition:
+            if self.image_cache_state == 'capturing' and self.image_cache_capturer == vm_name:
+                self.image_cache_state = state
+                self.image_cache_capturer = None
+                self.condition.notify_all()
+
+    def update_vm(self, vm_name, state, meta):
+        with self.state_lock:
+            # Copy the metadata, since its phase durations keep changing in the VM's own thread
+            self.vms[vm_name].update(copy.deepcopy(meta))
+            self.vms[vm_name]['state'] = state
+            self.task.update_state(state='RUNNING', meta=self.get_progress())
+
+    def get_progress(self):
+        completed = len([vm for vm in self.vms.values() if vm['state'] == 'COMPLETED'])
+        failed = len([vm for vm in self.vms.values() if vm['state'] == 'FAILED'])
+        running = len([vm for vm in self.vms.values() if vm['state'] == 'RUNNING'])
+        return {
+            'current': completed + failed,
+            'total': len(self.vms),
+            'status': '{} provisioned, {} failed, {} running, {} pending'.format(completed, failed, running, len(self.vms) - completed - failed - running),
+            'vms': self.vms
+        }
+
+
+class BatchTaskState(object):
+    """
+    Stand-in for the Celery task passed to create_vm, which reports each VM's state into its batch
+    """
+    def __init__(self, batch, vm_name):
+        self.batch = batch
+        self.vm_name = vm_name
 
-                        retcode, stdout, stderr = pvc_common.run_os_command('umount {}'.format(mount_path))
-                        if retcode:
-                            print('Failed to unmount "{}": {}'.format(mount_path, stderr))
+    def update_state(self, state=None, meta=None):
+        self.batch.update_vm(self.vm_name, state, meta)
 
-                # Unmap the RBD device
-                if volume['filesystem']:
-                    print("Cleaning up RBD mapping /dev/rbd/{}/{}_{}".format(volume['pool'], vm_name, volume['disk_id']))
 
-                    rbd_volume = "/dev/rbd/{}/{}_{}".format(volume['pool'], vm_name, volume['disk_id'])
-                    retcode, stdout, stderr = pvc_common.run_os_command("rbd unmap {}".format(rbd_volume))
-                    if retcode:
-                        print('Failed to unmap volume "{}": {}'.format(rbd_volume, stderr))
+def create_vm_batch(self, name_pattern, vm_profile, count, start_index=1, define_vm=True, start_vm=True, script_run_args=[], concurrency=None, pool_concurrency=None, node_concurrency=None):
+    if concurrency is None:
+        concurrency = batch_workers
+    if pool_concurrency is None:
+        pool_concurrency = batch_pool_concurrency
+    if node_concurrency is None:
+        node_concurrency = batch_node_concurrency
 
-        print("Cleaning up temporary directories and files")
+    vm_names = [name_pattern.format(index) for index in range(start_index, start_index + count)]
 
-        if is_script_install:
-            # Remove temporary mount directory (don't fail if not removed)
-            retcode, stdout, stderr = pvc_common.run_os_command("rmdir {}".format(temp_dir))
-            if retcode:
-                print('Failed to delete temporary directory "{}": {}'.format(temp_dir, stderr))
+    print("Starting batch provisioning of {} VMs with profile '{}'".format(count, vm_profile))
 
-            # Remote temporary script (don't fail if not removed)
-            retcode, stdout, stderr = pvc_common.run_os_command("rm -f {}".format(script_file))
-            if retcode:
-                print('Failed to delete temporary script file "{}": {}'.format(script_file, stderr))
+    try:
+        with database(config) as (db_conn, db_cur):
+            profile_data, vm_data = get_vm_configuration(db_cur, vm_profile)
+    except Exception as e:
+        raise ClusterError('Failed to collect the configuration of profile "{}": {}'.format(vm_profile, e))
 
-        # Phase 10 - startup
-        #  * Start the VM in the PVC cluster
-        if start_vm:
-            self.update_state(state='RUNNING', meta={'current': 10, 'total': 10, 'status': 'Starting VM'})
-            time.sleep(1)
-            retcode, retmsg = pvc_vm.start_vm(zk_conn, vm_name)
-            print(retmsg)
+    try:
+        zk_conn = pvc_common.startZKConnection(config['coordinators'])
+    except Exception:
+        print('FATAL - failed to connect to Zookeeper')
+        raise Exception
+
+    # Snapshot the free memory of the ready nodes once; VMs started by the batch are then accounted for by the batch
+    _discard, nodes = pvc_node.get_list(zk_conn, None)
+    node_free = dict()
+    for node in nodes:
+        if node['daemon_state'] == "run" and node['domain_state'] == "ready":
+            node_free[node['name']] = node['memory']['free']
+
+    # Look up the cached image once, since every VM of the batch shares the same script, arguments, and layout
+    image_cache_key = None
+    image_cached = False
+    if profile_data.get('image_cache') and vm_data['script'] and profile_data.get('profile_type') != 'ova':
+        try:
+            image_cache_key = get_image_cache_key(vm_data['script'], get_script_arguments(vm_data, script_run_args), vm_data['volumes'], vm_data['networks'])
+            image_cached = get_image_cache_entry(zk_conn, image_cache_key) is not None
+        except Exception as e:
+            pvc_common.stopZKConnection(zk_conn)
+            raise ClusterError('Failed to look up the cached image of profile "{}": {}'.format(vm_profile, e))
+
+    batch = ProvisioningBatch(self, zk_conn, profile_data, vm_data, vm_names, node_free, pool_concurrency, node_concurrency, image_cache_key=image_cache_key, image_cached=image_cached)
+
+    def provision_vm(vm_name):
+        batch.gate.hold('shared')
+        try:
+            result = create_vm(BatchTaskState(batch, vm_name), vm_name, vm_profile, define_vm=define_vm, start_vm=start_vm, script_run_args=script_run_args, batch=batch)
+            batch.update_vm(vm_name, 'COMPLETED', result)
+        except Exception as e:
+            print('Failed to provision VM "{}": {}'.format(vm_name, e))
+            batch.update_vm(vm_name, 'FAILED', {'status': str(e)})
+        finally:
+            batch.end_image_capture(vm_name)
+            batch.gate.hold(None)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for vm_name in vm_names:
+            executor.submit(provision_vm, vm_name)
 
     pvc_common.stopZKConnection(zk_conn)
-    return {'status': 'VM "{}" with profile "{}" has been provisioned and started successfully'.format(vm_name, vm_profile), 'current': 10, 'total': 10}
+
+    progress = batch.get_progress()
+    failed = [vm_name for vm_name in batch.vms if batch.vms[vm_name]['state'] == 'FAILED']
+    if failed:
+        raise ProvisioningError('Failed to provision {} of {} VMs: {}'.format(len(failed), count, ', '.join(failed)))
+    progress['status'] = 'All {} VMs with profile "{}" have been provisioned successfully'.format(count, vm_profile)
+    return progress
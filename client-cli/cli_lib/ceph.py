@@ -23,10 +23,10 @@
 import json
 import math
 
-from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import cli_lib.ansiprint as ansiprint
-from cli_lib.common import UploadProgressBar, call_api
+from cli_lib.common import call_api, format_bytes
 
 #
 # Supplemental functions
@@ -906,40 +906,108 @@ def ceph_volume_add(config, pool, volume, size):
     return retstatus, response.json().get('message', '')
 
 
-def ceph_volume_upload(config, pool, volume, image_format, image_file):
+def ceph_volume_upload(config, pool, volume, image_format, image_file, chunk_size=64 * 1024 * 1024, parallel=4, session=None):
     """
-    Upload a disk image to a Ceph volume
+    Upload a disk image to a Ceph volume in resumable, checksummed chunks
 
-    API endpoint: POST /api/v1/storage/ceph/volume/{pool}/{volume}/upload
-    API arguments: image_format={image_format}
+    API endpoint: POST /api/v1/storage/ceph/volume/{pool}/{volume}/upload/session
+    API arguments: image_format={image_format}, size={size}
+    API schema: {"session":"{session}","image_format":"{image_format}","size":{size},"chunks":[[{offset},{length}],...],"received":{received}}
+
+    API endpoint: GET /api/v1/storage/ceph/volume/{pool}/{volume}/upload/session/{session}
+    API endpoint: PUT /api/v1/storage/ceph/volume/{pool}/{volume}/upload/session/{session}
+    API arguments: offset={offset}
+    API schema: {"message":"{data}"}
+
+    API endpoint: POST /api/v1/storage/ceph/volume/{pool}/{volume}/upload/session/{session}/finalize
+    API arguments: checksum={checksum}
+    API schema: {"message":"{data}"}
+
+    API endpoint: DELETE /api/v1/storage/ceph/volume/{pool}/{volume}/upload/session/{session}
     API schema: {"message":"{data}"}
     """
+    import os
     import click
+    import hashlib
 
-    bar = UploadProgressBar(image_file, end_message="Parsing file on remote side...", end_nl=False)
-    upload_data = MultipartEncoder(
-        fields={'file': ('filename', open(image_file, 'rb'), 'application/octet-stream')}
+    file_size = os.path.getsize(image_file)
+
+    # Create a new upload session, or find the chunks already received by an existing one
+    if session is None:
+        params = {
+            'image_format': image_format,
+            'size': file_size
+        }
+        response = call_api(config, 'post', '/storage/ceph/volume/{}/{}/upload/session'.format(pool, volume), params=params)
+    else:
+        response = call_api(config, 'get', '/storage/ceph/volume/{}/{}/upload/session/{}'.format(pool, volume, session))
+    if response.status_code != 200:
+        return False, response.json().get('message', '')
+    session_data = response.json()
+    session = session_data['session']
+    if session_data['size'] != file_size:
+        return False, 'Upload session "{}" is for an image of {} bytes, not {} bytes.'.format(session, session_data['size'], file_size)
+
+    received_chunks = set((offset, length) for offset, length in session_data['chunks'])
+    chunks = [
+        (offset, min(chunk_size, file_size - offset)) for offset in range(0, file_size, chunk_size)
+        if (offset, min(chunk_size, file_size - offset)) not in received_chunks
+    ]
+
+    click.echo("Computing checksum of file...")
+    image_hash = hashlib.sha256()
+    with open(image_file, 'rb') as fh:
+        for data in iter(lambda: fh.read(chunk_size), b''):
+            image_hash.update(data)
+
+    # How to continue or abandon the session after a failure; abandoned sessions otherwise expire after a day idle
+    upload_session_hint = 'Resume the upload with "--resume {session}", or discard it with DELETE /api/v1/storage/ceph/volume/{pool}/{volume}/upload/session/{session}.'.format(
+        session=session,
+        pool=pool,
+        volume=volume
     )
-    upload_monitor = MultipartEncoderMonitor(upload_data, bar.update)
 
-    headers = {
-        "Content-Type": upload_monitor.content_type
-    }
-    params = {
-        'image_format': image_format
-    }
+    # Upload a single chunk, retrying it a few times before giving up
+    def upload_chunk(offset, length):
+        with open(image_file, 'rb') as fh:
+            fh.seek(offset)
+            data = fh.read(length)
+        for attempt in range(3):
+            response = call_api(config, 'put', '/storage/ceph/volume/{}/{}/upload/session/{}'.format(pool, volume, session), params={'offset': offset}, data=data)
+            if response.status_code == 200:
+                return length
+        raise IOError(response.json().get('message', ''))
+
+    click.echo("Uploading file (total size {}, {} remaining) in session {}...".format(
+        format_bytes(file_size),
+        format_bytes(sum(length for offset, length in chunks)),
+        session
+    ))
+    failed_chunks = list()
+    with click.progressbar(length=file_size, show_eta=True) as bar:
+        bar.update(file_size - sum(length for offset, length in chunks))
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            chunk_jobs = {executor.submit(upload_chunk, offset, length): offset for offset, length in chunks}
+            for chunk_job in as_completed(chunk_jobs):
+                try:
+                    bar.update(chunk_job.result())
+                except Exception as e:
+                    failed_chunks.append((chunk_jobs[chunk_job], e))
+    click.echo()
 
-    response = call_api(config, 'post', '/storage/ceph/volume/{}/{}/upload'.format(pool, volume), headers=headers, params=params, data=upload_monitor)
+    if failed_chunks:
+        offset, error = sorted(failed_chunks)[0]
+        return False, 'Failed to upload {} chunk(s), first at offset {}: {}\n{}'.format(len(failed_chunks), offset, error, upload_session_hint)
 
-    click.echo("done.")
+    click.echo("Verifying file on remote side...", nl=False)
+    response = call_api(config, 'post', '/storage/ceph/volume/{}/{}/upload/session/{}/finalize'.format(pool, volume, session), params={'checksum': image_hash.hexdigest()})
+    click.echo(" done.")
     click.echo()
 
-    if response.status_code == 200:
-        retstatus = True
-    else:
-        retstatus = False
+    if response.status_code != 200:
+        return False, '{}\n{}'.format(response.json().get('message', ''), upload_session_hint)
 
-    return retstatus, response.json().get('message', '')
+    return True, response.json().get('message', '')
 
 
 def ceph_volume_remove(config, pool, volume):
@@ -985,16 +1053,18 @@ def ceph_volume_modify(config, pool, volume, new_name=None, new_size=None):
     return retstatus, response.json().get('message', '')
 
 
-def ceph_volume_clone(config, pool, volume, new_volume):
+def ceph_volume_clone(config, pool, volume, new_volume, cow=False, flatten=False):
     """
     Clone Ceph volume
 
     API endpoint: POST /api/v1/storage/ceph/volume/{pool}/{volume}
-    API arguments: new_volume={new_volume
+    API arguments: new_volume={new_volume}, cow={cow}, flatten={flatten}
     API schema: {"message":"{data}"}
     """
     params = {
-        'new_volume': new_volume
+        'new_volume': new_volume,
+        'cow': cow,
+        'flatten': flatten
     }
     response = call_api(config, 'post', '/storage/ceph/volume/{pool}/{volume}/clone'.format(volume=volume, pool=pool), params=params)
 
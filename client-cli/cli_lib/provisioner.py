@@ -659,6 +659,41 @@ def vm_create(config, name, profile, wait_flag, define_flag, start_flag, script_
     return retvalue, retdata
 
 
+def vm_create_batch(config, name, profile, count, start_index, define_flag, start_flag, script_args, concurrency, pool_concurrency, node_concurrency):
+    """
+    Create {count} new VMs named from pattern {name} with profile {profile}
+
+    API endpoint: POST /api/v1/provisioner/create/batch
+    API_arguments: name={name}, profile={profile}, count={count}, start_index={start_index}, arg={script_args}
+    API schema: {message}
+    """
+    params = {
+        'name': name,
+        'profile': profile,
+        'count': count,
+        'start_index': start_index,
+        'start_vm': start_flag,
+        'define_vm': define_flag,
+        'arg': script_args
+    }
+    if concurrency is not None:
+        params['concurrency'] = concurrency
+    if pool_concurrency is not None:
+        params['pool_concurrency'] = pool_concurrency
+    if node_concurrency is not None:
+        params['node_concurrency'] = node_concurrency
+    response = call_api(config, 'post', '/provisioner/create/batch', params=params)
+
+    if response.status_code == 202:
+        retvalue = True
+        retdata = 'Task ID: {}'.format(response.json()['task_id'])
+    else:
+        retvalue = False
+        retdata = response.json().get('message', '')
+
+    return retvalue, retdata
+
+
 def task_status(config, task_id=None, is_watching=False):
     """
     Get information about provisioner job {task_id} or all tasks if None
@@ -701,6 +736,18 @@ def task_status(config, task_id=None, is_watching=False):
                     respjson['state'],
                     respjson['status']
                 )
+            # Batch jobs also report the state of each VM
+            if respjson.get('vms'):
+                retdata += '\nVMs:'
+                for vm_name in sorted(respjson['vms']):
+                    vm_status = respjson['vms'][vm_name]
+                    retdata += '\n  {}: {} {}/{} {}'.format(
+                        vm_name,
+                        vm_status.get('state'),
+                        vm_status.get('current'),
+                        vm_status.get('total'),
+                        vm_status.get('status')
+                    )
         else:
             retvalue = False
             retdata = response.json().get('message', '')
@@ -1463,6 +1510,7 @@ Templates: {profile_system_template: <{profile_system_template_length}} \
 {profile_storage_template: <{profile_storage_template_length}} \
 Data: {profile_userdata: <{profile_userdata_length}} \
 {profile_script: <{profile_script_length}} \
+{profile_image_cache: <6} \
 {profile_arguments}{end_bold}'.format(
         profile_name_length=profile_name_length,
         profile_id_length=profile_id_length,
@@ -1482,6 +1530,7 @@ Data: {profile_userdata: <{profile_userdata_length}} \
         profile_storage_template='Storage',
         profile_userdata='Userdata',
         profile_script='Script',
+        profile_image_cache='Cache',
         profile_arguments='Script Arguments')
 
     # Format the string (elements)
@@ -1493,6 +1542,7 @@ Data: {profile_userdata: <{profile_userdata_length}} \
 {profile_storage_template: <{profile_storage_template_length}} \
       {profile_userdata: <{profile_userdata_length}} \
 {profile_script: <{profile_script_length}} \
+{profile_image_cache: <6} \
 {profile_arguments}{end_bold}'.format(
                 profile_name_length=profile_name_length,
                 profile_id_length=profile_id_length,
@@ -1512,6 +1562,7 @@ Data: {profile_userdata: <{profile_userdata_length}} \
                 profile_storage_template=profile['storage_template'],
                 profile_userdata=profile['userdata'],
                 profile_script=profile['script'],
+                profile_image_cache='Yes' if profile.get('image_cache') else 'No',
                 profile_arguments=', '.join(profile['arguments'])
             )
         )
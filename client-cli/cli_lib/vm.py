@@ -131,12 +131,12 @@ def vm_modify(config, vm, xml, restart):
     return retstatus, response.json().get('message', '')
 
 
-def vm_metadata(config, vm, node_limit, node_selector, node_autostart, migration_method, provisioner_profile):
+def vm_metadata(config, vm, node_limit, node_selector, node_autostart, migration_method, provisioner_profile, recovery_priority=None):
     """
     Modify PVC metadata of a VM
 
     API endpoint: GET /vm/{vm}/meta,  POST /vm/{vm}/meta
-    API arguments: limit={node_limit}, selector={node_selector}, autostart={node_autostart}, migration_method={migration_method} profile={provisioner_profile}
+    API arguments: limit={node_limit}, selector={node_selector}, autostart={node_autostart}, migration_method={migration_method} profile={provisioner_profile}, recovery_priority={recovery_priority}
     API schema: {"message":"{data}"}
     """
     params = dict()
@@ -157,6 +157,9 @@ def vm_metadata(config, vm, node_limit, node_selector, node_autostart, migration
     if provisioner_profile is not None:
         params['profile'] = provisioner_profile
 
+    if recovery_priority is not None:
+        params['recovery_priority'] = recovery_priority
+
     # Write the new metadata
     response = call_api(config, 'post', '/vm/{vm}/meta'.format(vm=vm), params=params)
 
@@ -1151,6 +1154,7 @@ def format_info(config, domain_information, long_output):
     ainformation.append('{}Node limit:{}         {}'.format(ansiprint.purple(), ansiprint.end(), formatted_node_limit))
     ainformation.append('{}Autostart:{}          {}'.format(ansiprint.purple(), ansiprint.end(), formatted_node_autostart))
     ainformation.append('{}Migration Method:{}   {}'.format(ansiprint.purple(), ansiprint.end(), formatted_migration_method))
+    ainformation.append('{}Recovery Priority:{}  {}'.format(ansiprint.purple(), ansiprint.end(), domain_information.get('recovery_priority', 0)))
 
     # Network list
     net_list = []
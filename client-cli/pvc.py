@@ -663,6 +663,10 @@ def vm_define(vmconfig, target_node, node_limit, node_selector, node_autostart,
     type=click.Choice(['none', 'live', 'shutdown']),
     help='The preferred migration method of the VM between nodes; saved with VM.'
 )
+@click.option(
+    '-r', '--recovery-priority', 'recovery_priority', default=None, show_default=False, type=int,
+    help='Priority of the VM when recovering from a fenced node; higher values are restarted first.'
+)
 @click.option(
     '-p', '--profile', 'provisioner_profile', default=None, show_default=False,
     help='PVC provisioner profile name for VM.'
@@ -671,15 +675,15 @@ def vm_define(vmconfig, target_node, node_limit, node_selector, node_autostart,
     'domain'
 )
 @cluster_req
-def vm_meta(domain, node_limit, node_selector, node_autostart, migration_method, provisioner_profile):
+def vm_meta(domain, node_limit, node_selector, node_autostart, migration_method, recovery_priority, provisioner_profile):
     """
     Modify the PVC metadata of existing virtual machine DOMAIN. At least one option to update must be specified. DOMAIN may be a UUID or name.
     """
 
-    if node_limit is None and node_selector is None and node_autostart is None and migration_method is None and provisioner_profile is None:
+    if node_limit is None and node_selector is None and node_autostart is None and migration_method is None and recovery_priority is None and provisioner_profile is None:
         cleanup(False, 'At least one metadata option must be specified to update.')
 
-    retcode, retmsg = pvc_vm.vm_metadata(config, domain, node_limit, node_selector, node_autostart, migration_method, provisioner_profile)
+    retcode, retmsg = pvc_vm.vm_metadata(config, domain, node_limit, node_selector, node_autostart, migration_method, provisioner_profile, recovery_priority)
     cleanup(retcode, retmsg)
 
 
@@ -2371,21 +2375,42 @@ def ceph_volume_add(pool, name, size):
     default='raw', show_default=True,
     help='The format of the source image.'
 )
+@click.option(
+    '-c', '--chunk-size', 'chunk_size',
+    default=64, show_default=True, type=int,
+    help='The size of each uploaded chunk in MiB.'
+)
+@click.option(
+    '-p', '--parallel', 'parallel',
+    default=4, show_default=True, type=int,
+    help='The number of chunks to upload at once.'
+)
+@click.option(
+    '-r', '--resume', 'session',
+    default=None,
+    help='Resume the interrupted upload session SESSION.'
+)
 @cluster_req
-def ceph_volume_upload(pool, name, image_format, image_file):
+def ceph_volume_upload(pool, name, image_format, image_file, chunk_size, parallel, session):
     """
     Upload a disk image file IMAGE_FILE to the RBD volume NAME in pool POOL.
 
     The volume NAME must exist in the pool before uploading to it, and must be large enough to fit the disk image in raw format.
 
     If the image format is "raw", the image is uploaded directly to the target volume without modification. Otherwise, it will be converted into raw format by "qemu-img convert" on the remote side before writing using a temporary volume. The image format must be a valid format recognized by "qemu-img", such as "vmdk" or "qcow2".
+
+    The image is uploaded in chunks, several at once, and verified by checksum once complete. If the upload is interrupted, it can be continued by passing the session ID shown at the start of the upload to "--resume"; sessions left idle for a day are removed by the cluster.
     """
 
     if not os.path.exists(image_file):
         click.echo("ERROR: File '{}' does not exist!".format(image_file))
         exit(1)
 
-    retcode, retmsg = pvc_ceph.ceph_volume_upload(config, pool, name, image_format, image_file)
+    if chunk_size < 1 or parallel < 1:
+        click.echo("ERROR: The chunk size and parallelism must be at least 1.")
+        exit(1)
+
+    retcode, retmsg = pvc_ceph.ceph_volume_upload(config, pool, name, image_format, image_file, chunk_size=chunk_size * 1024 * 1024, parallel=parallel, session=session)
     cleanup(retcode, retmsg)
 
 
@@ -2478,12 +2503,25 @@ def ceph_volume_rename(pool, name, new_name):
 @click.argument(
     'new_name'
 )
+@click.option(
+    '-c', '--cow', 'cow', is_flag=True, default=False,
+    help='Create a copy-on-write clone from a snapshot of the volume instead of a full copy.'
+)
+@click.option(
+    '-f', '--flatten', 'flatten', is_flag=True, default=False,
+    help='Flatten the copy-on-write clone in the background, detaching it from NAME.'
+)
 @cluster_req
-def ceph_volume_clone(pool, name, new_name):
+def ceph_volume_clone(pool, name, new_name, cow, flatten):
     """
     Clone a Ceph RBD volume with name NAME in pool POOL to name NEW_NAME in pool POOL.
+
+    With "--cow", the clone is created instantly as a child of a protected snapshot of NAME, which is kept until the clone is removed or flattened. With "--flatten", the clone's data is then copied in a background job.
     """
-    retcode, retmsg = pvc_ceph.ceph_volume_clone(config, pool, name, new_name)
+    if flatten and not cow:
+        cleanup(False, 'The "--flatten" option requires "--cow".')
+
+    retcode, retmsg = pvc_ceph.ceph_volume_clone(config, pool, name, new_name, cow=cow, flatten=flatten)
     cleanup(retcode, retmsg)
 
 
@@ -3782,8 +3820,13 @@ def provisioner_profile_list(limit):
     default=[], multiple=True,
     help='Additional argument to the script install() function in key=value format.'
 )
+@click.option(
+    '-c/-C', '--image-cache/--no-image-cache', 'image_cache',
+    is_flag=True, default=False, show_default=True,
+    help='Cache the script output and clone it for later VMs with the same script, arguments, and storage layout.'
+)
 @cluster_req
-def provisioner_profile_add(name, profile_type, system_template, network_template, storage_template, userdata, script, ova, script_args):
+def provisioner_profile_add(name, profile_type, system_template, network_template, storage_template, userdata, script, ova, script_args, image_cache):
     """
     Add a new provisioner profile NAME.
     """
@@ -3797,6 +3840,7 @@ def provisioner_profile_add(name, profile_type, system_template, network_templat
     params['script'] = script
     params['ova'] = ova
     params['arg'] = script_args
+    params['image_cache'] = image_cache
 
     retcode, retdata = pvc_provisioner.profile_add(config, params)
     cleanup(retcode, retdata)
@@ -3844,8 +3888,13 @@ def provisioner_profile_add(name, profile_type, system_template, network_templat
     default=None, multiple=True,
     help='Additional argument to the script install() function in key=value format.'
 )
+@click.option(
+    '-c/-C', '--image-cache/--no-image-cache', 'image_cache',
+    default=None,
+    help='Enable or disable caching of the script output for later VMs.'
+)
 @cluster_req
-def provisioner_profile_modify(name, system_template, network_template, storage_template, userdata, script, delete_script_args, script_args):
+def provisioner_profile_modify(name, system_template, network_template, storage_template, userdata, script, delete_script_args, script_args, image_cache):
     """
     Modify existing provisioner profile NAME.
     """
@@ -3864,6 +3913,8 @@ def provisioner_profile_modify(name, system_template, network_template, storage_
         params['arg'] = []
     if script_args is not None:
         params['arg'] = script_args
+    if image_cache is not None:
+        params['image_cache'] = image_cache
 
     retcode, retdata = pvc_provisioner.profile_modify(config, name, params)
     cleanup(retcode, retdata)
@@ -3996,6 +4047,73 @@ def provisioner_create(name, profile, wait_flag, define_flag, start_flag, script
     cleanup(retcode, retdata)
 
 
+###############################################################################
+# pvc provisioner create-batch
+###############################################################################
+@click.command(name='create-batch', short_help='Create a batch of new VMs.')
+@click.argument(
+    'name'
+)
+@click.argument(
+    'profile'
+)
+@click.argument(
+    'count', type=int
+)
+@click.option(
+    '-i', '--start-index', 'start_index',
+    default=1, show_default=True, type=int,
+    help='The index of the first VM.'
+)
+@click.option(
+    '-a', '--script-arg', 'script_args',
+    default=[], multiple=True,
+    help='Additional argument to the script install() function in key=value format.'
+)
+@click.option(
+    '-d/-D', '--define/--no-define', 'define_flag',
+    is_flag=True, default=True, show_default=True,
+    help='Define the VMs automatically during provisioning.'
+)
+@click.option(
+    '-s/-S', '--start/--no-start', 'start_flag',
+    is_flag=True, default=True, show_default=True,
+    help='Start the VMs automatically upon completion of provisioning.'
+)
+@click.option(
+    '-c', '--concurrency', 'concurrency',
+    default=None, type=int,
+    help='The maximum number of VMs to provision at once.'
+)
+@click.option(
+    '-p', '--pool-concurrency', 'pool_concurrency',
+    default=None, type=int,
+    help='The maximum number of VMs to provision at once on any one storage pool.'
+)
+@click.option(
+    '-n', '--node-concurrency', 'node_concurrency',
+    default=None, type=int,
+    help='The maximum number of VMs to provision at once for any one target node.'
+)
+@cluster_req
+def provisioner_create_batch(name, profile, count, start_index, script_args, define_flag, start_flag, concurrency, pool_concurrency, node_concurrency):
+    """
+    Create COUNT new VMs with profile PROFILE, named from the pattern NAME.
+
+    NAME must contain a "{}" field, which is replaced by the index of each VM; a format spec
+    may be used to pad the index, e.g. "web{:02d}" creates "web01", "web02", etc.
+
+    The profile and its templates are read once for the whole batch, and the VMs are provisioned
+    in parallel within the concurrency limits. Use "pvc provisioner status" with the returned task
+    ID to view the progress of the batch and of each VM.
+    """
+    if not define_flag:
+        start_flag = False
+
+    retcode, retdata = pvc_provisioner.vm_create_batch(config, name, profile, count, start_index, define_flag, start_flag, script_args, concurrency, pool_concurrency, node_concurrency)
+    cleanup(retcode, retdata)
+
+
 ###############################################################################
 # pvc provisioner status
 ###############################################################################
@@ -4383,6 +4501,7 @@ cli_provisioner.add_command(provisioner_script)
 cli_provisioner.add_command(provisioner_ova)
 cli_provisioner.add_command(provisioner_profile)
 cli_provisioner.add_command(provisioner_create)
+cli_provisioner.add_command(provisioner_create_batch)
 cli_provisioner.add_command(provisioner_status)
 
 cli_maintenance.add_command(maintenance_on)
@@ -23,13 +23,25 @@
 import os
 import re
 import json
-import time
 import math
+import time
+import uuid
+import tempfile
+import subprocess
 
 import daemon_lib.vm as vm
 import daemon_lib.zkhandler as zkhandler
 import daemon_lib.common as common
 
+# The number of parallel coroutines used by qemu-img when converting volume images
+qemu_img_coroutines = 16
+
+# Upload sessions idle for longer than this many seconds are removed when a new session is created
+upload_session_timeout = 24 * 60 * 60
+
+# The minimum number of seconds between updates of an upload session's activity time
+upload_session_touch_interval = 60
+
 
 #
 # Supplemental functions
@@ -204,7 +216,7 @@ def getOSDInformation(zk_conn, osd_id):
     return osd_information
 
 
-# OSD addition and removal uses the /cmd/ceph pipe
+# OSD addition and removal uses the /cmd/ceph queue
 # These actions must occur on the specific node they reference
 def add_osd(zk_conn, node, device, weight):
     # Verify the target node exists
@@ -218,29 +230,16 @@ def add_osd(zk_conn, node, device, weight):
 
     # Tell the cluster to create a new OSD for the host
     add_osd_string = 'osd_add {},{},{}'.format(node, device, weight)
-    zkhandler.writedata(zk_conn, {'/cmd/ceph': add_osd_string})
-    # Wait 1/2 second for the cluster to get the message and start working
-    time.sleep(0.5)
-    # Acquire a read lock, so we get the return exclusively
-    lock = zkhandler.readlock(zk_conn, '/cmd/ceph')
-    with lock:
-        try:
-            result = zkhandler.readdata(zk_conn, '/cmd/ceph').split()[0]
-            if result == 'success-osd_add':
-                message = 'Created new OSD with block device "{}" on node "{}".'.format(device, node)
-                success = True
-            else:
-                message = 'ERROR: Failed to create new OSD; check node logs for details.'
-                success = False
-        except Exception:
-            message = 'ERROR: Command ignored by node.'
-            success = False
-
-    # Acquire a write lock to ensure things go smoothly
-    lock = zkhandler.writelock(zk_conn, '/cmd/ceph')
-    with lock:
-        time.sleep(0.5)
-        zkhandler.writedata(zk_conn, {'/cmd/ceph': ''})
+    result = common.runQueuedCommand(zk_conn, 'ceph', add_osd_string)
+    if result == 'success':
+        message = 'Created new OSD with block device "{}" on node "{}".'.format(device, node)
+        success = True
+    elif result == 'failure':
+        message = 'ERROR: Failed to create new OSD; check node logs for details.'
+        success = False
+    else:
+        message = 'ERROR: Command ignored by node.'
+        success = False
 
     return success, message
 
@@ -251,29 +250,16 @@ def remove_osd(zk_conn, osd_id):
 
     # Tell the cluster to remove an OSD
     remove_osd_string = 'osd_remove {}'.format(osd_id)
-    zkhandler.writedata(zk_conn, {'/cmd/ceph': remove_osd_string})
-    # Wait 1/2 second for the cluster to get the message and start working
-    time.sleep(0.5)
-    # Acquire a read lock, so we get the return exclusively
-    lock = zkhandler.readlock(zk_conn, '/cmd/ceph')
-    with lock:
-        try:
-            result = zkhandler.readdata(zk_conn, '/cmd/ceph').split()[0]
-            if result == 'success-osd_remove':
-                message = 'Removed OSD "{}" from the cluster.'.format(osd_id)
-                success = True
-            else:
-                message = 'ERROR: Failed to remove OSD; check node logs for details.'
-                success = False
-        except Exception:
-            success = False
-            message = 'ERROR Command ignored by node.'
-
-    # Acquire a write lock to ensure things go smoothly
-    lock = zkhandler.writelock(zk_conn, '/cmd/ceph')
-    with lock:
-        time.sleep(0.5)
-        zkhandler.writedata(zk_conn, {'/cmd/ceph': ''})
+    result = common.runQueuedCommand(zk_conn, 'ceph', remove_osd_string)
+    if result == 'success':
+        message = 'Removed OSD "{}" from the cluster.'.format(osd_id)
+        success = True
+    elif result == 'failure':
+        message = 'ERROR: Failed to remove OSD; check node logs for details.'
+        success = False
+    else:
+        success = False
+        message = 'ERROR Command ignored by node.'
 
     return success, message
 
@@ -494,14 +480,30 @@ def add_volume(zk_conn, pool, name, size):
     return True, 'Created RBD volume "{}/{}" ({}).'.format(pool, name, size)
 
 
-def clone_volume(zk_conn, pool, name_src, name_new):
+def clone_volume(zk_conn, pool, name_src, name_new, cow=False):
     if not verifyVolume(zk_conn, pool, name_src):
         return False, 'ERROR: No volume with name "{}" is present in pool "{}".'.format(name_src, pool)
 
     # 1. Clone the volume
-    retcode, stdout, stderr = common.run_os_command('rbd copy {}/{} {}/{}'.format(pool, name_src, pool, name_new))
-    if retcode:
-        return False, 'ERROR: Failed to clone RBD volume "{}" to "{}" in pool "{}": {}'.format(name_src, name_new, pool, stderr)
+    if cow:
+        # Copy-on-write clones are children of a protected snapshot of the source volume, which
+        # is kept until the clone is removed or flattened
+        clone_snapshot = 'clone_{}'.format(name_new)
+        retflag, retdata = add_snapshot(zk_conn, pool, name_src, clone_snapshot)
+        if not retflag:
+            return False, retdata
+
+        retcode, stdout, stderr = common.run_os_command('rbd snap protect {}/{}@{}'.format(pool, name_src, clone_snapshot))
+        if not retcode:
+            retcode, stdout, stderr = common.run_os_command('rbd clone {}/{}@{} {}/{}'.format(pool, name_src, clone_snapshot, pool, name_new))
+        if retcode:
+            common.run_os_command('rbd snap unprotect {}/{}@{}'.format(pool, name_src, clone_snapshot))
+            remove_snapshot(zk_conn, pool, name_src, clone_snapshot)
+            return False, 'ERROR: Failed to clone RBD volume "{}" to "{}" in pool "{}": {}'.format(name_src, name_new, pool, stderr)
+    else:
+        retcode, stdout, stderr = common.run_os_command('rbd copy {}/{} {}/{}'.format(pool, name_src, pool, name_new))
+        if retcode:
+            return False, 'ERROR: Failed to clone RBD volume "{}" to "{}" in pool "{}": {}'.format(name_src, name_new, pool, stderr)
 
     # 2. Get volume stats
     retcode, stdout, stderr = common.run_os_command('rbd info --format json {}/{}'.format(pool, name_new))
@@ -513,10 +515,70 @@ def clone_volume(zk_conn, pool, name_src, name_new):
         '/ceph/volumes/{}/{}/stats'.format(pool, name_new): volstats,
         '/ceph/snapshots/{}/{}'.format(pool, name_new): '',
     })
+    if cow:
+        zkhandler.writedata(zk_conn, {
+            '/ceph/volumes/{}/{}/parent'.format(pool, name_new): '{}@{}'.format(name_src, clone_snapshot)
+        })
+        return True, 'Cloned RBD volume "{}" to "{}" in pool "{}" (copy-on-write)'.format(name_src, name_new, pool)
 
     return True, 'Cloned RBD volume "{}" to "{}" in pool "{}"'.format(name_src, name_new, pool)
 
 
+# Release the source snapshot of a copy-on-write clone which no longer depends on it
+def release_clone_parent(zk_conn, pool, name):
+    parent_key = '/ceph/volumes/{}/{}/parent'.format(pool, name)
+    if not zkhandler.exists(zk_conn, parent_key):
+        return True, ''
+    parent = zkhandler.readdata(zk_conn, parent_key)
+    if parent:
+        parent_volume, parent_snapshot = parent.split('@')
+        # Keep the parent key on any failure, so the protected snapshot stays tracked and the release can be retried
+        retcode, stdout, stderr = common.run_os_command('rbd snap unprotect {}/{}@{}'.format(pool, parent_volume, parent_snapshot))
+        if retcode and 'snap is already unprotected' not in stderr:
+            return False, 'ERROR: Failed to unprotect parent snapshot "{}" of volume "{}" in pool "{}": {}'.format(parent_snapshot, parent_volume, pool, stderr)
+        if verifySnapshot(zk_conn, pool, parent_volume, parent_snapshot):
+            retflag, retmsg = remove_snapshot(zk_conn, pool, parent_volume, parent_snapshot)
+            if not retflag:
+                return False, 'ERROR: Failed to remove parent snapshot "{}" of volume "{}" in pool "{}": {}'.format(parent_snapshot, parent_volume, pool, retmsg)
+    zkhandler.deletekey(zk_conn, parent_key)
+    return True, ''
+
+
+def flatten_volume(zk_conn, pool, name):
+    if not verifyVolume(zk_conn, pool, name):
+        return False, 'ERROR: No volume with name "{}" is present in pool "{}".'.format(name, pool)
+
+    flatten_key = '/ceph/volumes/{}/{}/flatten'.format(pool, name)
+    zkhandler.writedata(zk_conn, {flatten_key: 'running'})
+
+    # 1. Copy the remaining parent data into the volume, unless a previous attempt already did and only failed
+    #    to release the parent snapshot
+    retcode, stdout, stderr = common.run_os_command('rbd info --format json {}/{}'.format(pool, name))
+    if retcode or 'parent' in json.loads(stdout):
+        retcode, stdout, stderr = common.run_os_command('rbd flatten --no-progress {}/{}'.format(pool, name))
+    if retcode:
+        zkhandler.writedata(zk_conn, {flatten_key: 'failed'})
+        return False, 'ERROR: Failed to flatten RBD volume "{}" in pool "{}": {}'.format(name, pool, stderr)
+
+    # 2. Release the parent snapshot
+    retflag, retmsg = release_clone_parent(zk_conn, pool, name)
+    if not retflag:
+        zkhandler.writedata(zk_conn, {flatten_key: 'failed'})
+        return False, retmsg
+
+    # 3. Get volume stats
+    retcode, stdout, stderr = common.run_os_command('rbd info --format json {}/{}'.format(pool, name))
+    volstats = stdout
+
+    # 4. Update the volume in Zookeeper
+    zkhandler.writedata(zk_conn, {
+        '/ceph/volumes/{}/{}/stats'.format(pool, name): volstats,
+        flatten_key: 'done'
+    })
+
+    return True, 'Flattened RBD volume "{}" in pool "{}".'.format(name, pool)
+
+
 def resize_volume(zk_conn, pool, name, size):
     if not verifyVolume(zk_conn, pool, name):
         return False, 'ERROR: No volume with name "{}" is present in pool "{}".'.format(name, pool)
@@ -579,11 +641,23 @@ def rename_volume(zk_conn, pool, name, new_name):
         '/ceph/snapshots/{}/{}'.format(pool, name): '/ceph/snapshots/{}/{}'.format(pool, new_name)
     })
 
-    # 3. Get volume stats
+    # 3. Point any copy-on-write clones of the volume at its new name
+    clone_parents = dict()
+    for volume in zkhandler.listchildren(zk_conn, '/ceph/volumes/{}'.format(pool)):
+        parent_key = '/ceph/volumes/{}/{}/parent'.format(pool, volume)
+        if not zkhandler.exists(zk_conn, parent_key):
+            continue
+        parent = zkhandler.readdata(zk_conn, parent_key)
+        if parent and parent.split('@')[0] == name:
+            clone_parents[parent_key] = '{}@{}'.format(new_name, parent.split('@')[1])
+    if clone_parents:
+        zkhandler.writedata(zk_conn, clone_parents)
+
+    # 4. Get volume stats
     retcode, stdout, stderr = common.run_os_command('rbd info --format json {}/{}'.format(pool, new_name))
     volstats = stdout
 
-    # 4. Update the volume stats in Zookeeper
+    # 5. Update the volume stats in Zookeeper
     zkhandler.writedata(zk_conn, {
         '/ceph/volumes/{}/{}/stats'.format(pool, new_name): volstats,
     })
@@ -599,12 +673,20 @@ def remove_volume(zk_conn, pool, name):
     for snapshot in zkhandler.listchildren(zk_conn, '/ceph/snapshots/{}/{}'.format(pool, name)):
         remove_snapshot(zk_conn, pool, name, snapshot)
 
-    # 2. Remove the volume
-    retcode, stdout, stderr = common.run_os_command('rbd rm {}/{}'.format(pool, name))
-    if retcode:
-        return False, 'ERROR: Failed to remove RBD volume "{}" in pool "{}": {}'.format(name, pool, stderr)
+    # 2. Remove the volume, unless a previous attempt already did and only failed to release its parent
+    retcode, stdout, stderr = common.run_os_command('rbd info {}/{}'.format(pool, name))
+    if not retcode:
+        retcode, stdout, stderr = common.run_os_command('rbd rm {}/{}'.format(pool, name))
+        if retcode:
+            return False, 'ERROR: Failed to remove RBD volume "{}" in pool "{}": {}'.format(name, pool, stderr)
+
+    # 3. Release the source snapshot if this was a copy-on-write clone; on failure the volume stays in
+    #    Zookeeper so the leftover snapshot remains tracked and the removal can be retried
+    retflag, retmsg = release_clone_parent(zk_conn, pool, name)
+    if not retflag:
+        return False, retmsg
 
-    # 3. Delete volume from Zookeeper
+    # 4. Delete volume from Zookeeper
     zkhandler.deletekey(zk_conn, '/ceph/volumes/{}/{}'.format(pool, name))
     zkhandler.deletekey(zk_conn, '/ceph/snapshots/{}/{}'.format(pool, name))
 
@@ -648,6 +730,61 @@ def unmap_volume(zk_conn, pool, name):
     return True, 'Unmapped RBD volume at "{}".'.format(mapped_volume)
 
 
+def convert_volume(zk_conn, pool, name_src, src_format, name_dst, progress_callback=None):
+    if not verifyVolume(zk_conn, pool, name_dst):
+        return False, 'ERROR: No volume with name "{}" is present in pool "{}".'.format(name_dst, pool)
+
+    # 1. Get the size of the destination volume, for throughput reporting
+    retcode, stdout, stderr = common.run_os_command('rbd info --format json {}/{}'.format(pool, name_dst))
+    try:
+        dst_size = int(json.loads(stdout)['size'])
+    except Exception:
+        dst_size = 0
+
+    # 2. Convert the image through qemu's native RBD driver rather than kernel mappings, with
+    #    parallel out-of-order writes, and zero detection to keep the destination sparse
+    convert_command = [
+        'qemu-img', 'convert', '-p', '-n',
+        '-m', str(qemu_img_coroutines), '-W', '-S', '4k',
+        '-f', src_format, '-O', 'raw',
+        'rbd:{}/{}'.format(pool, name_src),
+        'rbd:{}/{}'.format(pool, name_dst)
+    ]
+
+    # Errors go to a temporary file rather than a pipe, since a pipe left unread while progress is read from
+    # stdout would block qemu-img once it filled
+    stderr_file = tempfile.TemporaryFile()
+    start_time = time.time()
+    convert_process = subprocess.Popen(convert_command, stdout=subprocess.PIPE, stderr=stderr_file)
+
+    # 3. Report progress; qemu-img writes it to stdout as "(NN.NN/100%)" separated by carriage returns
+    last_percent = -1
+    while True:
+        progress_data = os.read(convert_process.stdout.fileno(), 4096)
+        if not progress_data:
+            break
+        if progress_callback is None:
+            continue
+        for percent in re.findall(r'\((\d+)\.\d+/100%\)', progress_data.decode('ascii', errors='ignore')):
+            percent = int(percent)
+            if percent == last_percent:
+                continue
+            last_percent = percent
+            elapsed_time = max(time.time() - start_time, 1)
+            progress_callback(percent, int(dst_size * percent / 100 / elapsed_time))
+
+    retcode = convert_process.wait()
+    convert_process.stdout.close()
+    stderr_file.seek(0)
+    stderr = stderr_file.read().decode('ascii', errors='ignore')
+    stderr_file.close()
+    if retcode:
+        return False, 'ERROR: Failed to convert {} volume "{}" to raw volume "{}" in pool "{}": {}'.format(src_format, name_src, name_dst, pool, stderr)
+
+    elapsed_time = max(time.time() - start_time, 1)
+    return True, 'Converted {} volume "{}" to raw volume "{}" in pool "{}" ({}/s).'.format(src_format, name_src, name_dst, pool, format_bytes_tohuman(dst_size / elapsed_time))
+
+
 def get_list_volume(zk_conn, pool, limit, is_fuzzy=True):
     volume_list = []
     if pool and not verifyPool(zk_conn, pool):
@@ -679,6 +816,134 @@ def get_list_volume(zk_conn, pool, limit, is_fuzzy=True):
     return True, sorted(volume_list, key=lambda x: str(x['name']))
 
 
+#
+# Chunked volume upload functions
+#
+# Read only the session record, without scanning the chunks recorded so far
+def getUploadSessionInfo(zk_conn, session):
+    try:
+        return json.loads(zkhandler.readdata(zk_conn, '/ceph/uploads/{}'.format(session)))
+    except Exception:
+        return None
+
+
+def getUploadSession(zk_conn, session):
+    session_data = getUploadSessionInfo(zk_conn, session)
+    if session_data is None:
+        return None
+
+    chunk_data = zkhandler.readdatamany(zk_conn, [
+        '/ceph/uploads/{}/{}'.format(session, offset) for offset in zkhandler.listchildren(zk_conn, '/ceph/uploads/{}'.format(session))
+    ])
+    session_data['chunks'] = sorted(
+        [int(key.split('/')[-1]), int(length)] for key, length in chunk_data.items() if length is not None
+    )
+    return session_data
+
+
+def expire_upload_sessions(zk_conn):
+    # Remove abandoned sessions, which otherwise keep their volumes mapped (and any temporary volume) forever
+    if not zkhandler.exists(zk_conn, '/ceph/uploads'):
+        return
+    now = int(time.time())
+    for session in zkhandler.listchildren(zk_conn, '/ceph/uploads'):
+        session_data = getUploadSessionInfo(zk_conn, session)
+        if session_data is None:
+            continue
+        updated = session_data.get('updated')
+        if updated is None:
+            # Sessions created before activity was recorded fall back to the time their record was written
+            try:
+                updated = int(zk_conn.exists('/ceph/uploads/{}'.format(session)).mtime / 1000)
+            except Exception:
+                continue
+        if now - updated > upload_session_timeout:
+            print('Removing upload session "{}", idle since {}'.format(session, time.ctime(updated)))
+            remove_upload_session(zk_conn, session)
+
+
+def add_upload_session(zk_conn, pool, volume, image_format, size):
+    if not verifyVolume(zk_conn, pool, volume):
+        return False, 'ERROR: No volume with name "{}" is present in pool "{}".'.format(volume, pool)
+
+    expire_upload_sessions(zk_conn)
+
+    session = str(uuid.uuid4())
+
+    # 1. Determine the volume the chunks are written to; raw images go straight into the volume,
+    #    while other formats are collected in a temporary volume and converted when finished
+    if image_format == 'raw':
+        volume_stats = json.loads(zkhandler.readdata(zk_conn, '/ceph/volumes/{}/{}/stats'.format(pool, volume)))
+        if int(volume_stats['size']) < size:
+            return False, 'ERROR: Volume "{}" in pool "{}" is too small for an image of {} bytes.'.format(volume, pool, size)
+        target = volume
+    else:
+        target = '{}_upload_{}'.format(volume, session.split('-')[0])
+        retflag, retdata = add_volume(zk_conn, pool, target, format_bytes_fromhuman(size))
+        if not retflag:
+            return False, retdata
+
+    # 2. Map the target volume
+    retflag, retdata = map_volume(zk_conn, pool, target)
+    if not retflag:
+        if target != volume:
+            remove_volume(zk_conn, pool, target)
+        return False, retdata
+    blockdev = retdata
+
+    # 3. Add the session to Zookeeper
+    zk_conn.ensure_path('/ceph/uploads')
+    session_data = {
+        'session': session,
+        'pool': pool,
+        'volume': volume,
+        'image_format': image_format,
+        'size': size,
+        'target': target,
+        'blockdev': blockdev,
+        'updated': int(time.time())
+    }
+    zkhandler.writedata(zk_conn, {
+        '/ceph/uploads/{}'.format(session): json.dumps(session_data)
+    })
+
+    session_data['chunks'] = list()
+    return True, session_data
+
+
+def add_upload_chunk(zk_conn, session_data, offset, length):
+    session = session_data['session']
+    zkhandler.writedata(zk_conn, {
+        '/ceph/uploads/{}/{}'.format(session, offset): str(length)
+    })
+
+    # Refresh the session's activity time, at most once per touch interval so chunks rarely rewrite the session;
+    # this only updates an existing session, so it cannot recreate one that was removed in the meantime
+    now = int(time.time())
+    if now - session_data.get('updated', 0) >= upload_session_touch_interval:
+        session_data['updated'] = now
+        try:
+            zk_conn.set('/ceph/uploads/{}'.format(session), json.dumps(session_data).encode('utf8'))
+        except Exception:
+            pass
+
+
+def remove_upload_session(zk_conn, session):
+    session_data = getUploadSessionInfo(zk_conn, session)
+    if session_data is None:
+        return False, 'ERROR: No upload session "{}" exists.'.format(session)
+
+    # 1. Unmap the target volume, and remove it if it is temporary
+    unmap_volume(zk_conn, session_data['pool'], session_data['target'])
+    if session_data['target'] != session_data['volume']:
+        remove_volume(zk_conn, session_data['pool'], session_data['target'])
+
+    # 2. Delete the session from Zookeeper
+    zkhandler.deletekey(zk_conn, '/ceph/uploads/{}'.format(session))
+
+    return True, 'Removed upload session "{}".'.format(session)
+
+
 #
 # Snapshot functions
 #
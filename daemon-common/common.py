@@ -30,6 +30,7 @@ from json import loads
 from re import match as re_match
 
 from distutils.util import strtobool
+from threading import Event
 
 import daemon_lib.zkhandler as zkhandler
 
@@ -253,6 +254,10 @@ def getInformationFromXML(zk_conn, uuid):
         domain_migration_method = zkhandler.readdata(zk_conn, '/domains/{}/migration_method'.format(uuid))
     except Exception:
         domain_migration_method = None
+    try:
+        domain_recovery_priority = int(zkhandler.readdata(zk_conn, '/domains/{}/recovery_priority'.format(uuid)))
+    except Exception:
+        domain_recovery_priority = 0
 
     if not domain_node_limit:
         domain_node_limit = None
@@ -307,6 +312,7 @@ def getInformationFromXML(zk_conn, uuid):
         'node_selector': domain_node_selector,
         'node_autostart': bool(strtobool(domain_node_autostart)),
         'migration_method': domain_migration_method,
+        'recovery_priority': domain_recovery_priority,
         'description': domain_description,
         'profile': domain_profile,
         'memory': int(domain_memory),
@@ -442,6 +448,46 @@ def getPrimaryNode(zk_conn):
     return primary_node
 
 
+#
+# Wait for a key to be created, returning whether it exists
+#
+def waitForKey(zk_conn, key, timeout=None):
+    key_event = Event()
+
+    def watch_key(event):
+        key_event.set()
+
+    if zk_conn.exists(key, watch=watch_key):
+        return True
+    key_event.wait(timeout)
+    return zk_conn.exists(key) is not None
+
+
+#
+# Send a command through a node command queue and wait for its result
+#
+# Each request is a sequential key under /cmd/<queue>; the node the command targets claims it
+# by creating an ephemeral "node" child, then writes a "result" child when finished. Returns
+# 'success' or 'failure', or None if no node claimed the request or the claiming node went away.
+#
+def runQueuedCommand(zk_conn, queue, command, claim_timeout=5):
+    request_key = zk_conn.create('/cmd/{}/request-'.format(queue), command.encode('ascii'), sequence=True)
+    claim_key = '{}/node'.format(request_key)
+    result_key = '{}/result'.format(request_key)
+    try:
+        if not waitForKey(zk_conn, claim_key, timeout=claim_timeout):
+            return None
+        while not waitForKey(zk_conn, result_key, timeout=1):
+            if not zk_conn.exists(claim_key):
+                return None
+        return zkhandler.readdata(zk_conn, result_key)
+    finally:
+        try:
+            zkhandler.deletekey(zk_conn, request_key)
+        except Exception:
+            pass
+
+
 #
 # Find a migration target
 #
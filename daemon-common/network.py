@@ -21,6 +21,7 @@
 ###############################################################################
 
 import re
+import json
 
 from kazoo.exceptions import NoNodeError
 
@@ -106,6 +107,56 @@ def getNetworkDHCPReservations(zk_conn, vni):
     return sorted(dhcp4_reservations)
 
 
+# DHCP leases and reservations are stored as a single key per MAC address, containing a JSON
+# object of the 'ipaddr' and 'hostname' (and for leases, 'expiry' and 'clientid'); older leases
+# and reservations instead have an empty (or 'static') key with one child key for each field
+def encodeDHCPLeaseData(ipaddr, hostname, expiry=None, clientid=None):
+    lease_data = {
+        'ipaddr': ipaddr,
+        'hostname': hostname
+    }
+    if expiry is not None:
+        lease_data['expiry'] = expiry
+    if clientid is not None:
+        lease_data['clientid'] = clientid
+    return json.dumps(lease_data)
+
+
+def decodeDHCPLeaseData(zk_conn, vni, type_key, mac_address, data):
+    if data and data.startswith('{'):
+        return json.loads(data)
+
+    # Fall back to reading the child keys of an old-format lease or reservation
+    lease_data = dict()
+    for field in ['ipaddr', 'hostname', 'expiry', 'clientid']:
+        try:
+            lease_data[field] = zkhandler.readdata(zk_conn, '/networks/{}/{}/{}/{}'.format(vni, type_key, mac_address, field))
+        except NoNodeError:
+            pass
+    return lease_data
+
+
+def getDHCPLeaseData(zk_conn, vni, type_key, mac_address):
+    data = zkhandler.readdata(zk_conn, '/networks/{}/{}/{}'.format(vni, type_key, mac_address))
+    return decodeDHCPLeaseData(zk_conn, vni, type_key, mac_address, data)
+
+
+def getNetworkDHCPLeaseData(zk_conn, vni, type_key):
+    # Get the data of all leases (or reservations) of a network in one batched read
+    key = '/networks/{}/{}'.format(vni, type_key)
+    mac_addresses = sorted(zkhandler.listchildren(zk_conn, key))
+    data = zkhandler.readdatamany(zk_conn, ['{}/{}'.format(key, mac_address) for mac_address in mac_addresses])
+
+    network_lease_data = dict()
+    for mac_address in mac_addresses:
+        mac_data = data['{}/{}'.format(key, mac_address)]
+        # Skip any leases removed since we listed them
+        if mac_data is None:
+            continue
+        network_lease_data[mac_address] = decodeDHCPLeaseData(zk_conn, vni, type_key, mac_address, mac_data)
+    return network_lease_data
+
+
 def getNetworkACLs(zk_conn, vni, _direction):
     # Get the (sorted) list of active ACLs
     if _direction == 'both':
@@ -128,19 +179,53 @@ def getNetworkACLs(zk_conn, vni, _direction):
     return full_acl_list
 
 
+# Network configuration fields, stored both as individual keys and together in the
+# /networks/<vni>/config key; the description is stored in /networks/<vni> itself
+network_config_fields = [
+    'description', 'nettype', 'domain', 'name_servers',
+    'ip6_network', 'ip6_gateway', 'dhcp6_flag',
+    'ip4_network', 'ip4_gateway', 'dhcp4_flag', 'dhcp4_start', 'dhcp4_end'
+]
+
+
+def getNetworkConfigKey(vni, field):
+    if field == 'description':
+        return '/networks/{}'.format(vni)
+    return '/networks/{}/{}'.format(vni, field)
+
+
+def getNetworkConfig(zk_conn, vni):
+    # Read the combined configuration key, falling back to the individual keys for
+    # networks created before it existed
+    try:
+        network_config = json.loads(zkhandler.readdata(zk_conn, '/networks/{}/config'.format(vni)))
+        if isinstance(network_config, dict):
+            return network_config
+    except Exception:
+        pass
+
+    config_keys = [getNetworkConfigKey(vni, field) for field in network_config_fields]
+    config_data = zkhandler.readdatamany(zk_conn, config_keys)
+    network_config = dict()
+    for field, key in zip(network_config_fields, config_keys):
+        network_config[field] = config_data[key]
+    return network_config
+
+
 def getNetworkInformation(zk_conn, vni):
-    description = zkhandler.readdata(zk_conn, '/networks/{}'.format(vni))
-    nettype = zkhandler.readdata(zk_conn, '/networks/{}/nettype'.format(vni))
-    domain = zkhandler.readdata(zk_conn, '/networks/{}/domain'.format(vni))
-    name_servers = zkhandler.readdata(zk_conn, '/networks/{}/name_servers'.format(vni))
-    ip6_network = zkhandler.readdata(zk_conn, '/networks/{}/ip6_network'.format(vni))
-    ip6_gateway = zkhandler.readdata(zk_conn, '/networks/{}/ip6_gateway'.format(vni))
-    dhcp6_flag = zkhandler.readdata(zk_conn, '/networks/{}/dhcp6_flag'.format(vni))
-    ip4_network = zkhandler.readdata(zk_conn, '/networks/{}/ip4_network'.format(vni))
-    ip4_gateway = zkhandler.readdata(zk_conn, '/networks/{}/ip4_gateway'.format(vni))
-    dhcp4_flag = zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_flag'.format(vni))
-    dhcp4_start = zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_start'.format(vni))
-    dhcp4_end = zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_end'.format(vni))
+    network_config = getNetworkConfig(zk_conn, vni)
+    description = network_config['description']
+    nettype = network_config['nettype']
+    domain = network_config['domain']
+    name_servers = network_config['name_servers']
+    ip6_network = network_config['ip6_network']
+    ip6_gateway = network_config['ip6_gateway']
+    dhcp6_flag = network_config['dhcp6_flag']
+    ip4_network = network_config['ip4_network']
+    ip4_gateway = network_config['ip4_gateway']
+    dhcp4_flag = network_config['dhcp4_flag']
+    dhcp4_start = network_config['dhcp4_start']
+    dhcp4_end = network_config['dhcp4_end']
 
     # Construct a data structure to represent the data
     network_information = {
@@ -165,19 +250,21 @@ def getNetworkInformation(zk_conn, vni):
     return network_information
 
 
-def getDHCPLeaseInformation(zk_conn, vni, mac_address):
+def getDHCPLeaseInformation(zk_conn, vni, mac_address, type_key=None, lease_data=None):
     # Check whether this is a dynamic or static lease
-    try:
-        zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_leases/{}'.format(vni, mac_address))
-        type_key = 'dhcp4_leases'
-    except NoNodeError:
-        zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_reservations/{}'.format(vni, mac_address))
-        type_key = 'dhcp4_reservations'
-
-    hostname = zkhandler.readdata(zk_conn, '/networks/{}/{}/{}/hostname'.format(vni, type_key, mac_address))
-    ip4_address = zkhandler.readdata(zk_conn, '/networks/{}/{}/{}/ipaddr'.format(vni, type_key, mac_address))
+    if type_key is None:
+        if zkhandler.exists(zk_conn, '/networks/{}/dhcp4_leases/{}'.format(vni, mac_address)):
+            type_key = 'dhcp4_leases'
+        else:
+            type_key = 'dhcp4_reservations'
+
+    if lease_data is None:
+        lease_data = getDHCPLeaseData(zk_conn, vni, type_key, mac_address)
+
+    hostname = lease_data.get('hostname')
+    ip4_address = lease_data.get('ipaddr')
     if type_key == 'dhcp4_leases':
-        timestamp = zkhandler.readdata(zk_conn, '/networks/{}/{}/{}/expiry'.format(vni, type_key, mac_address))
+        timestamp = lease_data.get('expiry')
     else:
         timestamp = 'static'
 
@@ -263,26 +350,34 @@ def add_network(zk_conn, vni, description, nettype,
     if nettype == 'managed' and not domain:
         domain = '{}.local'.format(description)
 
+    network_config = {
+        'description': description,
+        'nettype': nettype,
+        'domain': domain,
+        'name_servers': name_servers,
+        'ip6_network': ip6_network,
+        'ip6_gateway': ip6_gateway,
+        'dhcp6_flag': dhcp6_flag,
+        'ip4_network': ip4_network,
+        'ip4_gateway': ip4_gateway,
+        'dhcp4_flag': dhcp4_flag,
+        'dhcp4_start': dhcp4_start,
+        'dhcp4_end': dhcp4_end
+    }
+    # Store values exactly as the individual keys hold them
+    network_config = {field: str(value) for field, value in network_config.items()}
+
     # Add the new network to Zookeeper
-    zkhandler.writedata(zk_conn, {
-        '/networks/{}'.format(vni): description,
-        '/networks/{}/nettype'.format(vni): nettype,
-        '/networks/{}/domain'.format(vni): domain,
-        '/networks/{}/name_servers'.format(vni): name_servers,
-        '/networks/{}/ip6_network'.format(vni): ip6_network,
-        '/networks/{}/ip6_gateway'.format(vni): ip6_gateway,
-        '/networks/{}/dhcp6_flag'.format(vni): dhcp6_flag,
-        '/networks/{}/ip4_network'.format(vni): ip4_network,
-        '/networks/{}/ip4_gateway'.format(vni): ip4_gateway,
-        '/networks/{}/dhcp4_flag'.format(vni): dhcp4_flag,
-        '/networks/{}/dhcp4_start'.format(vni): dhcp4_start,
-        '/networks/{}/dhcp4_end'.format(vni): dhcp4_end,
+    zk_data = {getNetworkConfigKey(vni, field): value for field, value in network_config.items()}
+    zk_data.update({
+        '/networks/{}/config'.format(vni): json.dumps(network_config),
         '/networks/{}/dhcp4_leases'.format(vni): '',
         '/networks/{}/dhcp4_reservations'.format(vni): '',
         '/networks/{}/firewall_rules'.format(vni): '',
         '/networks/{}/firewall_rules/in'.format(vni): '',
         '/networks/{}/firewall_rules/out'.format(vni): ''
     })
+    zkhandler.writedata(zk_conn, zk_data)
 
     return True, 'Network "{}" added successfully!'.format(description)
 
@@ -290,40 +385,46 @@ def add_network(zk_conn, vni, description, nettype,
 def modify_network(zk_conn, vni, description=None, domain=None, name_servers=None,
                    ip4_network=None, ip4_gateway=None, ip6_network=None, ip6_gateway=None,
                    dhcp4_flag=None, dhcp4_start=None, dhcp4_end=None):
-    # Add the modified parameters to Zookeeper
-    zk_data = dict()
+    # Add the modified parameters to the network configuration
+    network_config = getNetworkConfig(zk_conn, vni)
+    config_data = dict()
     if description is not None:
-        zk_data.update({'/networks/{}'.format(vni): description})
+        config_data.update({'description': description})
     if domain is not None:
-        zk_data.update({'/networks/{}/domain'.format(vni): domain})
+        config_data.update({'domain': domain})
     if name_servers is not None:
-        zk_data.update({'/networks/{}/name_servers'.format(vni): name_servers})
+        config_data.update({'name_servers': name_servers})
     if ip4_network is not None:
-        zk_data.update({'/networks/{}/ip4_network'.format(vni): ip4_network})
+        config_data.update({'ip4_network': ip4_network})
     if ip4_gateway is not None:
-        zk_data.update({'/networks/{}/ip4_gateway'.format(vni): ip4_gateway})
+        config_data.update({'ip4_gateway': ip4_gateway})
     if ip6_network is not None:
-        zk_data.update({'/networks/{}/ip6_network'.format(vni): ip6_network})
+        config_data.update({'ip6_network': ip6_network})
         if ip6_network:
-            zk_data.update({'/networks/{}/dhcp6_flag'.format(vni): 'True'})
+            config_data.update({'dhcp6_flag': 'True'})
         else:
-            zk_data.update({'/networks/{}/dhcp6_flag'.format(vni): 'False'})
+            config_data.update({'dhcp6_flag': 'False'})
     if ip6_gateway is not None:
-        zk_data.update({'/networks/{}/ip6_gateway'.format(vni): ip6_gateway})
+        config_data.update({'ip6_gateway': ip6_gateway})
     else:
         # If we're changing the network, but don't also specify the gateway,
         # generate a new one automatically
         if ip6_network:
             ip6_netpart, ip6_maskpart = ip6_network.split('/')
             ip6_gateway = '{}1'.format(ip6_netpart)
-            zk_data.update({'/networks/{}/ip6_gateway'.format(vni): ip6_gateway})
+            config_data.update({'ip6_gateway': ip6_gateway})
     if dhcp4_flag is not None:
-        zk_data.update({'/networks/{}/dhcp4_flag'.format(vni): dhcp4_flag})
+        config_data.update({'dhcp4_flag': dhcp4_flag})
     if dhcp4_start is not None:
-        zk_data.update({'/networks/{}/dhcp4_start'.format(vni): dhcp4_start})
+        config_data.update({'dhcp4_start': dhcp4_start})
     if dhcp4_end is not None:
-        zk_data.update({'/networks/{}/dhcp4_end'.format(vni): dhcp4_end})
+        config_data.update({'dhcp4_end': dhcp4_end})
+    config_data = {field: str(value) for field, value in config_data.items()}
+    network_config.update(config_data)
 
+    # Write the individual keys and the combined configuration key in one transaction
+    zk_data = {getNetworkConfigKey(vni, field): value for field, value in config_data.items()}
+    zk_data.update({'/networks/{}/config'.format(vni): json.dumps(network_config)})
     zkhandler.writedata(zk_conn, zk_data)
 
     return True, 'Network "{}" modified successfully!'.format(vni)
@@ -363,9 +464,7 @@ def add_dhcp_reservation(zk_conn, network, ipaddress, macaddress, hostname):
     # Add the new static lease to ZK
     try:
         zkhandler.writedata(zk_conn, {
-            '/networks/{}/dhcp4_reservations/{}'.format(net_vni, macaddress): 'static',
-            '/networks/{}/dhcp4_reservations/{}/hostname'.format(net_vni, macaddress): hostname,
-            '/networks/{}/dhcp4_reservations/{}/ipaddr'.format(net_vni, macaddress): ipaddress
+            '/networks/{}/dhcp4_reservations/{}'.format(net_vni, macaddress): encodeDHCPLeaseData(ipaddress, hostname)
         })
     except Exception as e:
         return False, 'ERROR: Failed to write to Zookeeper! Exception: "{}".'.format(e)
@@ -382,20 +481,20 @@ def remove_dhcp_reservation(zk_conn, network, reservation):
     match_description = ''
 
     # Check if the reservation matches a static reservation description, a mac, or an IP address currently in the database
-    dhcp4_reservations_list = getNetworkDHCPReservations(zk_conn, net_vni)
-    for macaddr in dhcp4_reservations_list:
-        hostname = zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_reservations/{}/hostname'.format(net_vni, macaddr))
-        ipaddress = zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_reservations/{}/ipaddr'.format(net_vni, macaddr))
+    dhcp4_reservations_data = getNetworkDHCPLeaseData(zk_conn, net_vni, 'dhcp4_reservations')
+    for macaddr, lease_data in dhcp4_reservations_data.items():
+        hostname = lease_data.get('hostname')
+        ipaddress = lease_data.get('ipaddr')
         if reservation == macaddr or reservation == hostname or reservation == ipaddress:
             match_description = macaddr
             lease_type_zk = 'reservations'
             lease_type_human = 'static reservation'
 
     # Check if the reservation matches a dynamic reservation description, a mac, or an IP address currently in the database
-    dhcp4_leases_list = getNetworkDHCPLeases(zk_conn, net_vni)
-    for macaddr in dhcp4_leases_list:
-        hostname = zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_leases/{}/hostname'.format(net_vni, macaddr))
-        ipaddress = zkhandler.readdata(zk_conn, '/networks/{}/dhcp4_leases/{}/ipaddr'.format(net_vni, macaddr))
+    dhcp4_leases_data = getNetworkDHCPLeaseData(zk_conn, net_vni, 'dhcp4_leases')
+    for macaddr, lease_data in dhcp4_leases_data.items():
+        hostname = lease_data.get('hostname')
+        ipaddress = lease_data.get('ipaddr')
         if reservation == macaddr or reservation == hostname or reservation == ipaddress:
             match_description = macaddr
             lease_type_zk = 'leases'
@@ -562,11 +661,15 @@ def get_list_dhcp(zk_conn, network, limit, only_static=False, is_fuzzy=True):
 
     dhcp_list = []
 
+    # Read each type of lease in one batched read
     if only_static:
-        full_dhcp_list = getNetworkDHCPReservations(zk_conn, net_vni)
+        type_keys = ['dhcp4_reservations']
     else:
-        full_dhcp_list = getNetworkDHCPReservations(zk_conn, net_vni)
-        full_dhcp_list += getNetworkDHCPLeases(zk_conn, net_vni)
+        type_keys = ['dhcp4_reservations', 'dhcp4_leases']
+    full_dhcp_list = list()
+    for type_key in type_keys:
+        for lease, lease_data in getNetworkDHCPLeaseData(zk_conn, net_vni, type_key).items():
+            full_dhcp_list.append((lease, type_key, lease_data))
 
     if limit:
         try:
@@ -581,7 +684,7 @@ def get_list_dhcp(zk_conn, network, limit, only_static=False, is_fuzzy=True):
         except Exception as e:
             return False, 'Regex Error: {}'.format(e)
 
-    for lease in full_dhcp_list:
+    for lease, type_key, lease_data in full_dhcp_list:
         valid_lease = False
         if limit:
             if re.match(limit, lease):
@@ -592,7 +695,7 @@ def get_list_dhcp(zk_conn, network, limit, only_static=False, is_fuzzy=True):
             valid_lease = True
 
         if valid_lease:
-            dhcp_list.append(getDHCPLeaseInformation(zk_conn, net_vni, lease))
+            dhcp_list.append(getDHCPLeaseInformation(zk_conn, net_vni, lease, type_key=type_key, lease_data=lease_data))
 
     return True, dhcp_list
 
@@ -124,31 +124,18 @@ def flush_locks(zk_conn, domain):
     if state != 'stop':
         return False, 'ERROR: VM "{}" is not in stopped state; flushing RBD locks on a running VM is dangerous.'.format(domain)
 
-    # Tell the cluster to create a new OSD for the host
+    # Tell the node running the VM to flush its locks
     flush_locks_string = 'flush_locks {}'.format(dom_uuid)
-    zkhandler.writedata(zk_conn, {'/cmd/domains': flush_locks_string})
-    # Wait 1/2 second for the cluster to get the message and start working
-    time.sleep(0.5)
-    # Acquire a read lock, so we get the return exclusively
-    lock = zkhandler.readlock(zk_conn, '/cmd/domains')
-    with lock:
-        try:
-            result = zkhandler.readdata(zk_conn, '/cmd/domains').split()[0]
-            if result == 'success-flush_locks':
-                message = 'Flushed locks on VM "{}"'.format(domain)
-                success = True
-            else:
-                message = 'ERROR: Failed to flush locks on VM "{}"; check node logs for details.'.format(domain)
-                success = False
-        except Exception:
-            message = 'ERROR: Command ignored by node.'
-            success = False
-
-    # Acquire a write lock to ensure things go smoothly
-    lock = zkhandler.writelock(zk_conn, '/cmd/domains')
-    with lock:
-        time.sleep(0.5)
-        zkhandler.writedata(zk_conn, {'/cmd/domains': ''})
+    result = common.runQueuedCommand(zk_conn, 'domains', flush_locks_string)
+    if result == 'success':
+        message = 'Flushed locks on VM "{}"'.format(domain)
+        success = True
+    elif result == 'failure':
+        message = 'ERROR: Failed to flush locks on VM "{}"; check node logs for details.'.format(domain)
+        success = False
+    else:
+        message = 'ERROR: Command ignored by node.'
+        success = False
 
     return success, message
 
@@ -203,6 +190,7 @@ def define_vm(zk_conn, config_data, target_node, node_limit, node_selector, node
         '/domains/{}/node_selector'.format(dom_uuid): node_selector,
         '/domains/{}/node_autostart'.format(dom_uuid): node_autostart,
         '/domains/{}/migration_method'.format(dom_uuid): migration_method,
+        '/domains/{}/recovery_priority'.format(dom_uuid): '0',
         '/domains/{}/failedreason'.format(dom_uuid): '',
         '/domains/{}/consolelog'.format(dom_uuid): '',
         '/domains/{}/rbdlist'.format(dom_uuid): formatted_rbd_list,
@@ -214,7 +202,7 @@ def define_vm(zk_conn, config_data, target_node, node_limit, node_selector, node
     return True, 'Added new VM with Name "{}" and UUID "{}" to database.'.format(dom_name, dom_uuid)
 
 
-def modify_vm_metadata(zk_conn, domain, node_limit, node_selector, node_autostart, provisioner_profile, migration_method):
+def modify_vm_metadata(zk_conn, domain, node_limit, node_selector, node_autostart, provisioner_profile, migration_method, recovery_priority=None):
     dom_uuid = getDomainUUID(zk_conn, domain)
     if not dom_uuid:
         return False, 'ERROR: Could not find VM "{}" in the cluster!'.format(domain)
@@ -244,6 +232,15 @@ def modify_vm_metadata(zk_conn, domain, node_limit, node_selector, node_autostar
             '/domains/{}/migration_method'.format(dom_uuid): migration_method
         })
 
+    if recovery_priority is not None:
+        try:
+            recovery_priority = int(recovery_priority)
+        except ValueError:
+            return False, 'ERROR: Recovery priority must be an integer.'
+        zkhandler.writedata(zk_conn, {
+            '/domains/{}/recovery_priority'.format(dom_uuid): str(recovery_priority)
+        })
+
     return True, 'Successfully modified PVC metadata of VM "{}".'.format(domain)
 
 
@@ -23,6 +23,8 @@
 import time
 import uuid
 
+from kazoo.exceptions import NoNodeError
+
 
 # Exists function
 def exists(zk_conn, key):
@@ -92,6 +94,19 @@ def readdata(zk_conn, key):
     return data
 
 
+# Data read function for many keys; the reads are pipelined rather than done one at a time
+# Returns a dict of key: data, with None for any key that does not exist
+def readdatamany(zk_conn, keys):
+    async_results = [(key, zk_conn.get_async(key)) for key in keys]
+    data = dict()
+    for key, async_result in async_results:
+        try:
+            data[key] = async_result.get()[0].decode('utf8')
+        except NoNodeError:
+            data[key] = None
+    return data
+
+
 # Data write function
 def writedata(zk_conn, kv):
     # Start up a transaction
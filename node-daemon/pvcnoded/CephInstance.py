@@ -374,8 +374,8 @@ class CephSnapshotInstance(object):
 
 
 # Primary command function
-# This command pipe is only used for OSD adds and removes
-def run_command(zk_conn, logger, this_node, data, d_osd):
+# This command queue is only used for OSD adds and removes
+def run_command(zk_conn, logger, this_node, request_key, data, d_osd):
     # Get the command and args
     command, args = data.split()
 
@@ -383,21 +383,13 @@ def run_command(zk_conn, logger, this_node, data, d_osd):
     if command == 'osd_add':
         node, device, weight = args.split(',')
         if node == this_node.name:
-            # Lock the command queue
-            zk_lock = zkhandler.writelock(zk_conn, '/cmd/ceph')
-            with zk_lock:
-                # Add the OSD
-                result = add_osd(zk_conn, logger, node, device, weight)
-                # Command succeeded
-                if result:
-                    # Update the command queue
-                    zkhandler.writedata(zk_conn, {'/cmd/ceph': 'success-{}'.format(data)})
-                # Command failed
-                else:
-                    # Update the command queue
-                    zkhandler.writedata(zk_conn, {'/cmd/ceph': 'failure-{}'.format(data)})
-                # Wait 1 seconds before we free the lock, to ensure the client hits the lock
-                time.sleep(1)
+            # Claim the request
+            if not common.claim_command(zk_conn, request_key, this_node.name):
+                return
+            # Add the OSD
+            result = add_osd(zk_conn, logger, node, device, weight)
+            # Record the result
+            common.finish_command(zk_conn, request_key, result)
 
     # Removing an OSD
     elif command == 'osd_remove':
@@ -405,18 +397,10 @@ def run_command(zk_conn, logger, this_node, data, d_osd):
 
         # Verify osd_id is in the list
         if d_osd[osd_id] and d_osd[osd_id].node == this_node.name:
-            # Lock the command queue
-            zk_lock = zkhandler.writelock(zk_conn, '/cmd/ceph')
-            with zk_lock:
-                # Remove the OSD
-                result = remove_osd(zk_conn, logger, osd_id, d_osd[osd_id])
-                # Command succeeded
-                if result:
-                    # Update the command queue
-                    zkhandler.writedata(zk_conn, {'/cmd/ceph': 'success-{}'.format(data)})
-                # Command failed
-                else:
-                    # Update the command queue
-                    zkhandler.writedata(zk_conn, {'/cmd/ceph': 'failure-{}'.format(data)})
-                # Wait 1 seconds before we free the lock, to ensure the client hits the lock
-                time.sleep(1)
+            # Claim the request
+            if not common.claim_command(zk_conn, request_key, this_node.name):
+                return
+            # Remove the OSD
+            result = remove_osd(zk_conn, logger, osd_id, d_osd[osd_id])
+            # Record the result
+            common.finish_command(zk_conn, request_key, result)
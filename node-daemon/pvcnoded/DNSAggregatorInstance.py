@@ -23,9 +23,13 @@
 import time
 import dns.zone
 import dns.query
+import dns.message
+import dns.rdatatype
 import psycopg2
+import psycopg2.extras
 
-from threading import Thread, Event
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, Lock
 
 import pvcnoded.common as common
 
@@ -66,6 +70,11 @@ class DNSAggregatorInstance(object):
             del self.dns_networks[network]
             self.dns_axfr_daemon.update_networks(self.dns_networks)
 
+    # Request an immediate sync of a network, e.g. after its DHCP leases change
+    def sync_network(self, network):
+        if self.is_active and network in self.dns_networks:
+            self.dns_axfr_daemon.trigger_sync(network)
+
 
 class PowerDNSInstance(object):
     # Initialization function
@@ -274,6 +283,13 @@ class DNSNetworkInstance(object):
 
 
 class AXFRDaemonInstance(object):
+    # The maximum number of networks to AXFR concurrently
+    max_workers = 8
+    # The interval between periodic syncs of all networks, in seconds
+    sync_interval = 10
+    # The time to wait for further triggers before running a triggered sync, in seconds
+    trigger_delay = 0.25
+
     # Initialization function
     def __init__(self, aggregator):
         self.aggregator = aggregator
@@ -283,6 +299,13 @@ class AXFRDaemonInstance(object):
         self.thread_stopper = Event()
         self.thread = None
         self.sql_conn = None
+        self.sql_lock = Lock()
+        # The last-synced dnsmasq SOA serial of each domain
+        self.soa_serials = dict()
+        # Networks with a pending triggered sync
+        self.sync_pending = set()
+        self.sync_lock = Lock()
+        self.sync_event = Event()
 
     def update_networks(self, dns_networks):
         self.dns_networks = dns_networks
@@ -305,217 +328,295 @@ class AXFRDaemonInstance(object):
             )
         )
 
+        # Reset the serials so that the first pass is a full sync
+        self.soa_serials = dict()
+        self.sync_pending = set()
+        self.sync_event.clear()
+
         # Start the thread
         self.thread.start()
 
     def stop(self):
         self.thread_stopper.set()
+        # Wake the thread so it sees the stopper
+        self.sync_event.set()
         if self.sql_conn:
             self.sql_conn.close()
             self.sql_conn = None
 
+    # Queue a network for an immediate sync
+    def trigger_sync(self, network):
+        with self.sync_lock:
+            self.sync_pending.add(network)
+        self.sync_event.set()
+
     def run(self):
         # Wait for all the DNSMASQ instances to actually start
         time.sleep(5)
 
-        while not self.thread_stopper.is_set():
-            # We do this for each network
-            for network, instance in self.dns_networks.items():
-                # Set up our SQL cursor
-                try:
-                    sql_curs = self.sql_conn.cursor()
-                except Exception:
-                    time.sleep(0.5)
-                    continue
-
-                # Set up our basic variables
-                domain = network.domain
-                if network.ip4_gateway != 'None':
-                    dnsmasq_ip = network.ip4_gateway
+        sync_count = 0
+        next_sync = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while not self.thread_stopper.is_set():
+                if time.time() >= next_sync:
+                    # Periodic sync of all networks; force a full sync every 6th pass (1 minute)
+                    # regardless of serial, as a safety net
+                    force = (sync_count % 6 == 0)
+                    sync_count += 1
+                    networks = list(self.dns_networks.keys())
+                    with self.sync_lock:
+                        self.sync_pending = set()
+                    next_sync = time.time() + self.sync_interval
                 else:
-                    dnsmasq_ip = network.ip6_gateway
-
-                #
-                # Get an AXFR from the dnsmasq instance and list of records
-                #
-                try:
-                    axfr = dns.query.xfr(dnsmasq_ip, domain, lifetime=5.0)
-                    z = dns.zone.from_xfr(axfr)
-                    records_raw = [z[n].to_text(n) for n in z.nodes.keys()]
-                except Exception as e:
+                    # Wait for a triggered sync or the next periodic sync
+                    if not self.sync_event.wait(timeout=max(next_sync - time.time(), 0)):
+                        continue
+                    if self.thread_stopper.is_set():
+                        break
+                    # Coalesce bursts of triggers (e.g. many leases at once) into one pass
+                    time.sleep(self.trigger_delay)
+                    self.sync_event.clear()
+                    force = True
+                    with self.sync_lock:
+                        networks = [network for network in self.sync_pending if network in self.dns_networks]
+                        self.sync_pending = set()
+
+                # Sync the networks concurrently, so one slow or unreachable dnsmasq instance
+                # does not delay the others
+                list(executor.map(lambda network: self.sync_network(network, force=force), networks))
+
+    # Get the current SOA serial of the dnsmasq zone
+    def get_soa_serial(self, dnsmasq_ip, domain):
+        query = dns.message.make_query(domain, dns.rdatatype.SOA)
+        response = dns.query.udp(query, dnsmasq_ip, timeout=1.0)
+        for rrset in response.answer:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return rrset[0].serial
+        return None
+
+    # Synchronize the records of one network from the dnsmasq zone into the database
+    def sync_network(self, network, force=False):
+        try:
+            soa_serial, records_new = self.fetch_zone(network, force=force)
+        except Exception as e:
+            self.logger.out('ERROR: Failed to fetch DNS zone {}: {}'.format(network.domain, e), state='e')
+            return
+        if records_new is None:
+            return
+
+        # The database connection is shared, so apply one network's changes at a time
+        with self.sql_lock:
+            try:
+                self.apply_zone(network, soa_serial, records_new)
+            except Exception as e:
+                self.logger.out('ERROR: Failed to update DNS zone {}: {}'.format(network.domain, e), state='e')
+
+    # Get the records of the dnsmasq zone of a network; returns None for the records if the
+    # zone is unchanged or unavailable
+    def fetch_zone(self, network, force=False):
+        # Set up our basic variables
+        domain = network.domain
+        if network.ip4_gateway != 'None':
+            dnsmasq_ip = network.ip4_gateway
+        else:
+            dnsmasq_ip = network.ip6_gateway
+
+        #
+        # Skip this network if the dnsmasq zone serial hasn't changed since the last sync
+        #
+        try:
+            soa_serial = self.get_soa_serial(dnsmasq_ip, domain)
+        except Exception as e:
+            if self.config['debug']:
+                self.logger.out('{} {} ({})'.format(e, dnsmasq_ip, domain), state='d', prefix='dns-aggregator')
+            soa_serial = None
+        if not force and soa_serial is not None and self.soa_serials.get(domain) == soa_serial:
+            if self.config['debug']:
+                self.logger.out('Zone serial {} unchanged for {}, skipping'.format(soa_serial, domain), state='d', prefix='dns-aggregator')
+            return soa_serial, None
+
+        #
+        # Get an AXFR from the dnsmasq instance and list of records
+        #
+        try:
+            axfr = dns.query.xfr(dnsmasq_ip, domain, lifetime=5.0)
+            z = dns.zone.from_xfr(axfr)
+            records_raw = [z[n].to_text(n) for n in z.nodes.keys()]
+        except Exception as e:
+            if self.config['debug']:
+                self.logger.out('{} {} ({})'.format(e, dnsmasq_ip, domain), state='d', prefix='dns-aggregator')
+            return soa_serial, None
+
+        # Fix the formatting because it's useless
+        # reference: ['@ 600 IN SOA . . 4 1200 180 1209600 600\n@ 600 IN NS .', 'test3 600 IN A 10.1.1.203\ntest3 600 IN AAAA 2001:b23e:1113:0:5054:ff:fe5c:f131', etc.]
+        # We don't really care about dnsmasq's terrible SOA or NS records which are in [0]
+        string_records = '\n'.join(records_raw[1:])
+        # Split into individual records
+        records_new = set()
+        for element in string_records.split('\n'):
+            if element:
+                record = element.split()
+                # Handle space-containing data elements
+                if domain not in record[0]:
+                    name = '{}.{}'.format(record[0], domain)
+                else:
+                    name = record[0]
+                entry = '{} {} IN {} {}'.format(name, record[1], record[3], ' '.join(record[4:]))
+                records_new.add(entry)
+
+        return soa_serial, records_new
+
+    # Apply the changes between the dnsmasq zone records and the database records of a network
+    def apply_zone(self, network, soa_serial, records_new):
+        domain = network.domain
+
+        # Set up our SQL cursor
+        try:
+            sql_curs = self.sql_conn.cursor()
+        except Exception:
+            return
+
+        #
+        # Get the current zone from the database
+        #
+        try:
+            sql_curs.execute(
+                "SELECT id FROM domains WHERE name=%s",
+                (domain,)
+            )
+            domain_id = sql_curs.fetchone()
+            sql_curs.execute(
+                "SELECT * FROM records WHERE domain_id=%s",
+                (domain_id,)
+            )
+            results = list(sql_curs.fetchall())
+            if self.config['debug']:
+                self.logger.out('SQL query results: {}'.format(results), state='d', prefix='dns-aggregator')
+        except Exception as e:
+            self.logger.out('ERROR: Failed to obtain DNS records from database: {}'.format(e))
+            return
+
+        # Fix the formatting because it's useless for comparison
+        # reference: ((10, 28, 'testnet01.i.bonilan.net', 'SOA', 'nsX.pvc.local root.pvc.local 1 10800 1800 86400 86400', 86400, 0, None, 0, None, 1), etc.)
+        # Old records are indexed by entry, mapping to their database ID
+        records_old = dict()
+        if not results:
+            if self.config['debug']:
+                self.logger.out('No results found, skipping.', state='d', prefix='dns-aggregator')
+            return
+        for record in results:
+            # Skip the non-A
+            r_id = record[0]
+            r_name = record[2]
+            r_ttl = record[5]
+            r_type = record[3]
+            r_data = record[4]
+            # Assemble a list element in the same format as the AXFR data
+            entry = '{} {} IN {} {}'.format(r_name, r_ttl, r_type, r_data)
+            if self.config['debug']:
+                self.logger.out('Found record: {}'.format(entry), state='d', prefix='dns-aggregator')
+
+            # Skip non-A or AAAA records
+            if r_type != 'A' and r_type != 'AAAA':
+                if self.config['debug']:
+                    self.logger.out('Skipping record {}, not A or AAAA: "{}"'.format(entry, r_type), state='d', prefix='dns-aggregator')
+                continue
+
+            records_old[entry] = r_id
+
+        if self.config['debug']:
+            self.logger.out('New: {}'.format(sorted(records_new)), state='d', prefix='dns-aggregator')
+            self.logger.out('Old: {}'.format(sorted(records_old)), state='d', prefix='dns-aggregator')
+
+        # Find the differences between the sets
+        in_new_not_in_old = records_new - records_old.keys()
+        in_old_not_in_new = records_old.keys() - records_new
+
+        if in_new_not_in_old or in_old_not_in_new:
+            if self.config['debug']:
+                self.logger.out('New but not old: {}'.format(in_new_not_in_old), state='d', prefix='dns-aggregator')
+                self.logger.out('Old but not new: {}'.format(in_old_not_in_new), state='d', prefix='dns-aggregator')
+
+            # Index the changed records by (name, type); an old record with a name and type match
+            # to a new record with different content is replaced by it
+            # [NAME, TTL, 'IN', TYPE, DATA]
+            new_keys = set()
+            for record in in_new_not_in_old:
+                splitrecord = record.split()
+                new_keys.add((splitrecord[0], splitrecord[3]))
+
+            remove_records = set()  # set of database IDs
+            for record, record_id in records_old.items():
+                splitrecord = record.split()
+                # If the record is not in the new set or is being replaced, remove it
+                if record in in_old_not_in_new or (splitrecord[0], splitrecord[3]) in new_keys:
+                    remove_records.add(record_id)
+
+            add_records = list()
+            for record in in_new_not_in_old:
+                record = record.split()
+                r_name = record[0]
+                r_ttl = record[1]
+                r_type = record[3]
+                r_data = record[4]
+                add_records.append((domain_id, r_name, r_ttl, r_type, 0, r_data))
+
+            try:
+                if remove_records:
+                    # Remove the invalid old records
                     if self.config['debug']:
-                        self.logger.out('{} {} ({})'.format(e, dnsmasq_ip, domain), state='d', prefix='dns-aggregator')
-                    continue
-
-                # Fix the formatting because it's useless
-                # reference: ['@ 600 IN SOA . . 4 1200 180 1209600 600\n@ 600 IN NS .', 'test3 600 IN A 10.1.1.203\ntest3 600 IN AAAA 2001:b23e:1113:0:5054:ff:fe5c:f131', etc.]
-                # We don't really care about dnsmasq's terrible SOA or NS records which are in [0]
-                string_records = '\n'.join(records_raw[1:])
-                # Split into individual records
-                records_new = list()
-                for element in string_records.split('\n'):
-                    if element:
-                        record = element.split()
-                        # Handle space-containing data elements
-                        if domain not in record[0]:
-                            name = '{}.{}'.format(record[0], domain)
-                        else:
-                            name = record[0]
-                        entry = '{} {} IN {} {}'.format(name, record[1], record[3], ' '.join(record[4:]))
-                        records_new.append(entry)
-
-                #
-                # Get the current zone from the database
-                #
-                try:
-                    sql_curs.execute(
-                        "SELECT id FROM domains WHERE name=%s",
-                        (domain,)
-                    )
-                    domain_id = sql_curs.fetchone()
+                        self.logger.out('Removing records: {}'.format(sorted(remove_records)), state='d', prefix='dns-aggregator')
                     sql_curs.execute(
-                        "SELECT * FROM records WHERE domain_id=%s",
-                        (domain_id,)
+                        "DELETE FROM records WHERE id = ANY(%s)",
+                        (list(remove_records),)
                     )
-                    results = list(sql_curs.fetchall())
-                    if self.config['debug']:
-                        self.logger.out('SQL query results: {}'.format(results), state='d', prefix='dns-aggregator')
-                except Exception as e:
-                    self.logger.out('ERROR: Failed to obtain DNS records from database: {}'.format(e))
-
-                # Fix the formatting because it's useless for comparison
-                # reference: ((10, 28, 'testnet01.i.bonilan.net', 'SOA', 'nsX.pvc.local root.pvc.local 1 10800 1800 86400 86400', 86400, 0, None, 0, None, 1), etc.)
-                records_old = list()
-                records_old_ids = list()
-                if not results:
-                    if self.config['debug']:
-                        self.logger.out('No results found, skipping.', state='d', prefix='dns-aggregator')
-                    continue
-                for record in results:
-                    # Skip the non-A
-                    r_id = record[0]
-                    r_name = record[2]
-                    r_ttl = record[5]
-                    r_type = record[3]
-                    r_data = record[4]
-                    # Assemble a list element in the same format as the AXFR data
-                    entry = '{} {} IN {} {}'.format(r_name, r_ttl, r_type, r_data)
-                    if self.config['debug']:
-                        self.logger.out('Found record: {}'.format(entry), state='d', prefix='dns-aggregator')
-
-                    # Skip non-A or AAAA records
-                    if r_type != 'A' and r_type != 'AAAA':
-                        if self.config['debug']:
-                            self.logger.out('Skipping record {}, not A or AAAA: "{}"'.format(entry, r_type), state='d', prefix='dns-aggregator')
-                        continue
 
-                    records_old.append(entry)
-                    records_old_ids.append(r_id)
+                if add_records:
+                    # Add the new records
+                    if self.config['debug']:
+                        self.logger.out('Adding records: {}'.format(sorted(in_new_not_in_old)), state='d', prefix='dns-aggregator')
+                    psycopg2.extras.execute_values(
+                        sql_curs,
+                        "INSERT INTO records (domain_id, name, ttl, type, prio, content) VALUES %s",
+                        add_records
+                    )
 
-                records_new.sort()
-                records_old.sort()
+                # Increase SOA serial
+                sql_curs.execute(
+                    "SELECT content FROM records WHERE domain_id=%s AND type='SOA'",
+                    (domain_id,)
+                )
+                soa_record = list(sql_curs.fetchone())[0].split()
+                current_serial = int(soa_record[2])
+                new_serial = current_serial + 1
+                soa_record[2] = str(new_serial)
+                if self.config['debug']:
+                    self.logger.out('Records changed; bumping SOA: {}'.format(new_serial), state='d', prefix='dns-aggregator')
+                sql_curs.execute(
+                    "UPDATE records SET content=%s WHERE domain_id=%s AND type='SOA'",
+                    (' '.join(soa_record), domain_id)
+                )
 
+                # Commit all the previous changes
                 if self.config['debug']:
-                    self.logger.out('New: {}'.format(records_new), state='d', prefix='dns-aggregator')
-                    self.logger.out('Old: {}'.format(records_old), state='d', prefix='dns-aggregator')
-
-                # Find the differences between the lists
-                # Basic check one: are they completely equal
-                if records_new != records_old:
-                    # Get set elements
-                    in_new = set(records_new)
-                    in_old = set(records_old)
-                    in_new_not_in_old = in_new - in_old
-                    in_old_not_in_new = in_old - in_new
+                    self.logger.out('Committing database changes and reloading PDNS', state='d', prefix='dns-aggregator')
+                self.sql_conn.commit()
+            except Exception as e:
+                self.logger.out('ERROR: Failed to commit DNS aggregator changes: {}'.format(e), state='e')
+                try:
+                    self.sql_conn.rollback()
+                except Exception:
+                    pass
+                return
+
+            # Reload the domain
+            common.run_os_command(
+                '/usr/bin/pdns_control --socket-dir={} reload {}'.format(
+                    self.config['pdns_dynamic_directory'],
+                    domain
+                ),
+                background=False
+            )
 
-                    if self.config['debug']:
-                        self.logger.out('New but not old: {}'.format(in_new_not_in_old), state='d', prefix='dns-aggregator')
-                        self.logger.out('Old but not new: {}'.format(in_old_not_in_new), state='d', prefix='dns-aggregator')
-
-                    # Go through the old list
-                    remove_records = list()  # list of database IDs
-                    for i in range(len(records_old)):
-                        record_id = records_old_ids[i]
-                        record = records_old[i]
-                        splitrecord = records_old[i].split()
-
-                        # If the record is not in the new list, remove it
-                        if record in in_old_not_in_new:
-                            remove_records.append(record_id)
-
-                        # Go through the new elements
-                        for newrecord in in_new_not_in_old:
-                            splitnewrecord = newrecord.split()
-                            # If there's a name and type match with different content, remove the old one
-                            if splitrecord[0] == splitnewrecord[0] and splitrecord[3] == splitnewrecord[3]:
-                                remove_records.append(record_id)
-
-                    changed = False
-                    if len(remove_records) > 0:
-                        # Remove the invalid old records
-                        for record_id in remove_records:
-                            if self.config['debug']:
-                                self.logger.out('Removing record: {}'.format(record_id), state='d', prefix='dns-aggregator')
-                            sql_curs.execute(
-                                "DELETE FROM records WHERE id=%s",
-                                (record_id,)
-                            )
-                            changed = True
-
-                    if len(in_new_not_in_old) > 0:
-                        # Add the new records
-                        for record in in_new_not_in_old:
-                            # [NAME, TTL, 'IN', TYPE, DATA]
-                            record = record.split()
-                            r_name = record[0]
-                            r_ttl = record[1]
-                            r_type = record[3]
-                            r_data = record[4]
-                            if self.config['debug']:
-                                self.logger.out('Add record: {}'.format(name), state='d', prefix='dns-aggregator')
-                            try:
-                                sql_curs.execute(
-                                    "INSERT INTO records (domain_id, name, ttl, type, prio, content) VALUES (%s, %s, %s, %s, %s, %s)",
-                                    (domain_id, r_name, r_ttl, r_type, 0, r_data)
-                                )
-                                changed = True
-                            except psycopg2.IntegrityError as e:
-                                if self.config['debug']:
-                                    self.logger.out('Failed to add record due to {}: {}'.format(e, name), state='d', prefix='dns-aggregator')
-
-                    if changed:
-                        # Increase SOA serial
-                        sql_curs.execute(
-                            "SELECT content FROM records WHERE domain_id=%s AND type='SOA'",
-                            (domain_id,)
-                        )
-                        soa_record = list(sql_curs.fetchone())[0].split()
-                        current_serial = int(soa_record[2])
-                        new_serial = current_serial + 1
-                        soa_record[2] = str(new_serial)
-                        if self.config['debug']:
-                            self.logger.out('Records changed; bumping SOA: {}'.format(new_serial), state='d', prefix='dns-aggregator')
-                        sql_curs.execute(
-                            "UPDATE records SET content=%s WHERE domain_id=%s AND type='SOA'",
-                            (' '.join(soa_record), domain_id)
-                        )
-
-                        # Commit all the previous changes
-                        if self.config['debug']:
-                            self.logger.out('Committing database changes and reloading PDNS', state='d', prefix='dns-aggregator')
-                        try:
-                            self.sql_conn.commit()
-                        except Exception as e:
-                            self.logger.out('ERROR: Failed to commit DNS aggregator changes: {}'.format(e), state='e')
-
-                        # Reload the domain
-                        common.run_os_command(
-                            '/usr/bin/pdns_control --socket-dir={} reload {}'.format(
-                                self.config['pdns_dynamic_directory'],
-                                domain
-                            ),
-                            background=False
-                        )
-
-            # Wait for 10 seconds
-            time.sleep(10)
+        # Save the serial we synced so unchanged zones can be skipped next time
+        self.soa_serials[domain] = soa_serial
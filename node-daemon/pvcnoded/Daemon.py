@@ -38,6 +38,7 @@ from ipaddress import ip_address, ip_network
 from apscheduler.schedulers.background import BackgroundScheduler
 from distutils.util import strtobool
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 from xml.etree import ElementTree
 from rados import Rados
 
@@ -52,10 +53,14 @@ import pvcnoded.VXNetworkInstance as VXNetworkInstance
 import pvcnoded.DNSAggregatorInstance as DNSAggregatorInstance
 import pvcnoded.CephInstance as CephInstance
 import pvcnoded.MetadataAPIInstance as MetadataAPIInstance
+import pvcnoded.LeaseBrokerInstance as LeaseBrokerInstance
 
 # Version string for startup output
 version = '0.9.12'
 
+# Maximum number of object instances to construct concurrently
+instance_workers = 16
+
 ###############################################################################
 # PVCD - node daemon startup program
 ###############################################################################
@@ -96,6 +101,22 @@ def stopKeepaliveTimer():
         pass
 
 
+# Construct a set of object instances concurrently; each constructor's Zookeeper reads and
+# system commands then overlap with the others' instead of running one after another
+def create_instances(names, create_instance):
+    if len(names) < 2:
+        return {name: create_instance(name) for name in names}
+
+    with ThreadPoolExecutor(max_workers=instance_workers) as executor:
+        futures = {name: executor.submit(create_instance, name) for name in names}
+        return {name: future.result() for name, future in futures.items()}
+
+
+# Log the duration of a startup phase
+def log_phase_time(phase, start_time):
+    logger.out('{} completed in {:.2f}s'.format(phase, time.time() - start_time), state='i')
+
+
 ###############################################################################
 # PHASE 1a - Configuration parsing
 ###############################################################################
@@ -185,6 +206,20 @@ def readConfig(pvcnoded_config_file, myhostname):
         }
     config = {**config, **config_debug}
 
+    # Handle the optional logging config
+    o_config_logging = o_config['pvc']['system']['configuration']['logging']
+    config_logging = {
+        'log_async': o_config_logging.get('log_async', False),
+        'log_format': o_config_logging.get('log_format', 'text'),
+        'log_sampling': o_config_logging.get('log_sampling', dict())
+    }
+    if config_logging['log_format'] not in ['text', 'json']:
+        print('ERROR: Log format "{}" is not valid; must be one of "text" or "json"'.format(config_logging['log_format']))
+        exit(1)
+    if not isinstance(config_logging['log_sampling'], dict):
+        config_logging['log_sampling'] = dict()
+    config = {**config, **config_logging}
+
     # Handle the networking config
     if config['enable_networking']:
         try:
@@ -300,6 +335,7 @@ enable_storage = config['enable_storage']
 config['dnsmasq_dynamic_directory'] = config['dynamic_directory'] + '/dnsmasq'
 config['pdns_dynamic_directory'] = config['dynamic_directory'] + '/pdns'
 config['nft_dynamic_directory'] = config['dynamic_directory'] + '/nft'
+config['dnsmasq_lease_socket'] = config['dnsmasq_dynamic_directory'] + '/leases.sock'
 
 # Create our dynamic directories if they don't exist
 if not os.path.exists(config['dynamic_directory']):
@@ -610,6 +646,13 @@ def cleanup():
     # Forcibly terminate dnsmasq because it gets stuck sometimes
     common.run_os_command('killall dnsmasq')
 
+    # Stop the DHCP lease broker
+    try:
+        if lease_broker:
+            lease_broker.stop()
+    except NameError:
+        pass
+
     # Close the Zookeeper connection
     try:
         zk_conn.stop()
@@ -681,6 +724,17 @@ else:
         '/nodes/{}/networkscount'.format(myhostname): '0',
         '/nodes/{}/domainscount'.format(myhostname): '0',
         '/nodes/{}/runningdomains'.format(myhostname): '',
+        '/nodes/{}/status'.format(myhostname): json.dumps({
+            'memtotal': 0,
+            'memused': 0,
+            'memfree': 0,
+            'memalloc': 0,
+            'memprov': 0,
+            'vcpualloc': 0,
+            'cpuload': 0.0,
+            'domainscount': 0,
+            'runningdomains': ''
+        }),
         # Keepalives and fencing information
         '/nodes/{}/keepalive'.format(myhostname): str(keepalive_time),
         '/nodes/{}/ipmihostname'.format(myhostname): config['ipmi_hostname'],
@@ -753,9 +807,21 @@ if enable_networking:
     add table inet filter
     add chain inet filter forward {{type filter hook forward priority 0; }}
     add chain inet filter input {{type filter hook input priority 0; }}
+    # Add the per-network dispatch maps; each network's rules add their own elements
+    add map inet filter network-input {{ type ifname : verdict; }}
+    add map inet filter network-forward-in4 {{ type ipv4_addr : verdict; flags interval; }}
+    add map inet filter network-forward-out4 {{ type ipv4_addr : verdict; flags interval; }}
+    add map inet filter network-forward-in6 {{ type ipv6_addr : verdict; flags interval; }}
+    add map inet filter network-forward-out6 {{ type ipv6_addr : verdict; flags interval; }}
     # Include static rules and network rules
     include "{rulesdir}/static/*"
     include "{rulesdir}/networks/*"
+    # Jump from the input and forward chains to the matching network's chains
+    add rule inet filter input meta iifname vmap @network-input
+    add rule inet filter forward ip daddr vmap @network-forward-in4
+    add rule inet filter forward ip saddr vmap @network-forward-out4
+    add rule inet filter forward ip6 daddr vmap @network-forward-in6
+    add rule inet filter forward ip6 saddr vmap @network-forward-out6
     """.format(
         rulesdir=config['nft_dynamic_directory']
     )
@@ -777,6 +843,7 @@ common.run_os_command('systemctl stop dnsmasq.service')
 ###############################################################################
 
 logger.out('Setting up objects', state='i')
+setup_start_time = time.time()
 
 d_node = dict()
 d_network = dict()
@@ -796,23 +863,32 @@ if enable_networking:
     if config['daemon_mode'] == 'coordinator':
         dns_aggregator = DNSAggregatorInstance.DNSAggregatorInstance(zk_conn, config, logger)
         metadata_api = MetadataAPIInstance.MetadataAPIInstance(zk_conn, config, logger)
+        # Start the DHCP lease broker used by the dnsmasq lease script
+        lease_broker = LeaseBrokerInstance.LeaseBrokerInstance(zk_conn, config, logger)
+        lease_broker.start()
     else:
         dns_aggregator = None
         metadata_api = None
+        lease_broker = None
 else:
     dns_aggregator = None
     metadata_api = None
+    lease_broker = None
 
 
 # Node objects
+phase_start_time = time.time()
+
+
 @zk_conn.ChildrenWatch('/nodes')
 def update_nodes(new_node_list):
     global node_list, d_node
 
     # Add any missing nodes to the list
-    for node in new_node_list:
-        if node not in node_list:
-            d_node[node] = NodeInstance.NodeInstance(node, myhostname, zk_conn, config, logger, d_node, d_network, d_domain, dns_aggregator, metadata_api)
+    d_node.update(create_instances(
+        [node for node in new_node_list if node not in node_list],
+        lambda node: NodeInstance.NodeInstance(node, myhostname, zk_conn, config, logger, d_node, d_network, d_domain, dns_aggregator, metadata_api)
+    ))
 
     # Remove any deleted nodes from the list
     for node in node_list:
@@ -829,10 +905,63 @@ def update_nodes(new_node_list):
         d_node[node].update_node_list(d_node)
 
 
+log_phase_time('Node object setup', phase_start_time)
+
 # Alias for our local node (passed to network and domain objects)
 this_node = d_node[myhostname]
 
 
+# Begin fencing a node which appears dead
+def fence_dead_node(node_name):
+    logger.out('Node {} seems dead - starting monitor for fencing'.format(node_name), state='w')
+    zk_lock = zkhandler.writelock(zk_conn, '/nodes/{}/daemonstate'.format(node_name))
+    with zk_lock:
+        # Ensures that, if we lost the lock race and come out of waiting,
+        # we won't try to trigger our own fence thread.
+        if zkhandler.readdata(zk_conn, '/nodes/{}/daemonstate'.format(node_name)) != 'dead':
+            fence_thread = Thread(target=fencing.fenceNode, args=(node_name, zk_conn, config, logger), kwargs={})
+            fence_thread.start()
+            # Write the updated data after we start the fence thread
+            zkhandler.writedata(zk_conn, {'/nodes/{}/daemonstate'.format(node_name): 'dead'})
+
+
+# Check a node whose liveness key has vanished, i.e. whose Zookeeper session expired
+def check_lost_node(node_name):
+    if maintenance:
+        return
+
+    try:
+        node_daemon_state = zkhandler.readdata(zk_conn, '/nodes/{}/daemonstate'.format(node_name))
+        node_keepalive = int(zkhandler.readdata(zk_conn, '/nodes/{}/keepalive'.format(node_name)))
+    except Exception:
+        node_daemon_state = 'unknown'
+        node_keepalive = 0
+
+    # Cross-check against the keepalive timestamp; a node that checked in during the last two
+    # intervals is still working and will recreate its key, otherwise begin fencing right away
+    # (if this check is skipped, the keepalive check catches the node as before)
+    node_deadtime = int(time.time()) - (int(config['keepalive_interval']) * 2)
+    if node_keepalive < node_deadtime and node_daemon_state == 'run':
+        fence_dead_node(node_name)
+
+
+# Node liveness
+live_node_list = []
+if config['daemon_mode'] == 'coordinator':
+    zk_conn.ensure_path('/liveness')
+
+    @zk_conn.ChildrenWatch('/liveness')
+    def update_live_nodes(new_live_node_list):
+        global live_node_list
+
+        for node_name in live_node_list:
+            if node_name not in new_live_node_list and node_name in d_node:
+                lost_node_thread = Thread(target=check_lost_node, args=(node_name,), kwargs={})
+                lost_node_thread.start()
+
+        live_node_list = new_live_node_list
+
+
 # Maintenance mode
 @zk_conn.DataWatch('/maintenance')
 def set_maintenance(_maintenance, stat, event=''):
@@ -891,23 +1020,28 @@ def update_primary(new_primary, stat, event=''):
 
 if enable_networking:
     # Network objects
+    phase_start_time = time.time()
+
     @zk_conn.ChildrenWatch('/networks')
     def update_networks(new_network_list):
         global network_list, d_network
 
-        # Add any missing networks to the list
-        for network in new_network_list:
-            if network not in network_list:
-                d_network[network] = VXNetworkInstance.VXNetworkInstance(network, zk_conn, config, logger, this_node, dns_aggregator)
-                if config['daemon_mode'] == 'coordinator' and d_network[network].nettype == 'managed':
-                    try:
-                        dns_aggregator.add_network(d_network[network])
-                    except Exception as e:
-                        logger.out('Failed to create DNS Aggregator for network {}: {}'.format(network, e), 'w')
-                # Start primary functionality
-                if this_node.router_state == 'primary' and d_network[network].nettype == 'managed':
-                    d_network[network].createGateways()
-                    d_network[network].startDHCPServer()
+        # Add any missing networks to the list; each network's devices and firewall are set up concurrently
+        added_network_list = [network for network in new_network_list if network not in network_list]
+        d_network.update(create_instances(
+            added_network_list,
+            lambda network: VXNetworkInstance.VXNetworkInstance(network, zk_conn, config, logger, this_node, dns_aggregator)
+        ))
+        for network in added_network_list:
+            if config['daemon_mode'] == 'coordinator' and d_network[network].nettype == 'managed':
+                try:
+                    dns_aggregator.add_network(d_network[network])
+                except Exception as e:
+                    logger.out('Failed to create DNS Aggregator for network {}: {}'.format(network, e), 'w')
+            # Start primary functionality
+            if this_node.router_state == 'primary' and d_network[network].nettype == 'managed':
+                d_network[network].createGateways()
+                d_network[network].startDHCPServer()
 
         # Remove any deleted networks from the list
         for network in network_list:
@@ -932,22 +1066,27 @@ if enable_networking:
         for node in d_node:
             d_node[node].update_network_list(d_network)
 
+    log_phase_time('Network object setup', phase_start_time)
+
 if enable_hypervisor:
-    # VM command pipeline key
-    @zk_conn.DataWatch('/cmd/domains')
-    def cmd_domains(data, stat, event=''):
-        if data:
-            VMInstance.run_command(zk_conn, logger, this_node, data.decode('ascii'))
+    # VM command queue
+    common.watch_command_queue(
+        zk_conn, 'domains',
+        lambda request_key, data: VMInstance.run_command(zk_conn, logger, this_node, request_key, data)
+    )
 
     # VM domain objects
+    phase_start_time = time.time()
+
     @zk_conn.ChildrenWatch('/domains')
     def update_domains(new_domain_list):
         global domain_list, d_domain
 
         # Add any missing domains to the list
-        for domain in new_domain_list:
-            if domain not in domain_list:
-                d_domain[domain] = VMInstance.VMInstance(domain, zk_conn, config, logger, this_node)
+        d_domain.update(create_instances(
+            [domain for domain in new_domain_list if domain not in domain_list],
+            lambda domain: VMInstance.VMInstance(domain, zk_conn, config, logger, this_node)
+        ))
 
         # Remove any deleted domains from the list
         for domain in domain_list:
@@ -963,22 +1102,27 @@ if enable_hypervisor:
         for node in d_node:
             d_node[node].update_domain_list(d_domain)
 
+    log_phase_time('VM object setup', phase_start_time)
+
 if enable_storage:
-    # Ceph command pipeline key
-    @zk_conn.DataWatch('/cmd/ceph')
-    def cmd_ceph(data, stat, event=''):
-        if data:
-            CephInstance.run_command(zk_conn, logger, this_node, data.decode('ascii'), d_osd)
+    # Ceph command queue
+    common.watch_command_queue(
+        zk_conn, 'ceph',
+        lambda request_key, data: CephInstance.run_command(zk_conn, logger, this_node, request_key, data, d_osd)
+    )
 
     # OSD objects
+    phase_start_time = time.time()
+
     @zk_conn.ChildrenWatch('/ceph/osds')
     def update_osds(new_osd_list):
         global osd_list, d_osd
 
         # Add any missing OSDs to the list
-        for osd in new_osd_list:
-            if osd not in osd_list:
-                d_osd[osd] = CephInstance.CephOSDInstance(zk_conn, this_node, osd)
+        d_osd.update(create_instances(
+            [osd for osd in new_osd_list if osd not in osd_list],
+            lambda osd: CephInstance.CephOSDInstance(zk_conn, this_node, osd)
+        ))
 
         # Remove any deleted OSDs from the list
         for osd in osd_list:
@@ -996,11 +1140,14 @@ if enable_storage:
         global pool_list, d_pool
 
         # Add any missing Pools to the list
-        for pool in new_pool_list:
-            if pool not in pool_list:
-                d_pool[pool] = CephInstance.CephPoolInstance(zk_conn, this_node, pool)
-                d_volume[pool] = dict()
-                volume_list[pool] = []
+        added_pool_list = [pool for pool in new_pool_list if pool not in pool_list]
+        d_pool.update(create_instances(
+            added_pool_list,
+            lambda pool: CephInstance.CephPoolInstance(zk_conn, this_node, pool)
+        ))
+        for pool in added_pool_list:
+            d_volume[pool] = dict()
+            volume_list[pool] = []
 
         # Remove any deleted Pools from the list
         for pool in pool_list:
@@ -1019,9 +1166,10 @@ if enable_storage:
                 global volume_list, d_volume
 
                 # Add any missing Volumes to the list
-                for volume in new_volume_list:
-                    if volume not in volume_list[pool]:
-                        d_volume[pool][volume] = CephInstance.CephVolumeInstance(zk_conn, this_node, pool, volume)
+                d_volume[pool].update(create_instances(
+                    [volume for volume in new_volume_list if volume not in volume_list[pool]],
+                    lambda volume: CephInstance.CephVolumeInstance(zk_conn, this_node, pool, volume)
+                ))
 
                 # Remove any deleted Volumes from the list
                 for volume in volume_list[pool]:
@@ -1033,6 +1181,10 @@ if enable_storage:
                 volume_list[pool] = new_volume_list
                 logger.out('{}Volume list [{pool}]:{} {plist}'.format(fmt_blue, fmt_end, pool=pool, plist=' '.join(volume_list[pool])), state='i')
 
+    log_phase_time('Ceph object setup', phase_start_time)
+
+log_phase_time('Object setup', setup_start_time)
+
 
 ###############################################################################
 # PHASE 9 - Run the daemon
@@ -1494,6 +1646,15 @@ def node_keepalive():
     else:
         this_node.daemon_state = 'run'
 
+    # Ensure our liveness key exists; it is ephemeral, so it vanishes if our session expires
+    if debug:
+        logger.out("Ensure our liveness key exists", state='d', prefix='main-thread')
+    try:
+        if not zk_conn.exists('/liveness/{}'.format(this_node.name)):
+            zk_conn.create('/liveness/{}'.format(this_node.name), this_node.name.encode('ascii'), ephemeral=True, makepath=True)
+    except Exception:
+        logger.out('Failed to set liveness key', state='e')
+
     # Ensure the primary key is properly set
     if debug:
         logger.out("Ensure the primary key is properly set", state='d', prefix='main-thread')
@@ -1558,8 +1719,21 @@ def node_keepalive():
     keepalive_time = int(time.time())
     if debug:
         logger.out("Set our information in zookeeper", state='d', prefix='main-thread')
+    # Peer nodes watch only the combined status key; the individual keys are kept for readers
+    node_status = {
+        'memtotal': this_node.memtotal,
+        'memused': this_node.memused,
+        'memfree': this_node.memfree,
+        'memalloc': this_node.memalloc,
+        'memprov': this_node.memprov,
+        'vcpualloc': this_node.vcpualloc,
+        'cpuload': this_node.cpuload,
+        'domainscount': this_node.domains_count,
+        'runningdomains': ' '.join(this_node.domain_list)
+    }
     try:
         zkhandler.writedata(zk_conn, {
+            '/nodes/{}/status'.format(this_node.name): json.dumps(node_status),
             '/nodes/{}/memtotal'.format(this_node.name): str(this_node.memtotal),
             '/nodes/{}/memused'.format(this_node.name): str(this_node.memused),
             '/nodes/{}/memfree'.format(this_node.name): str(this_node.memfree),
@@ -1638,6 +1812,11 @@ def node_keepalive():
             logger.out("Look for dead nodes and fence them", state='d', prefix='main-thread')
         if config['daemon_mode'] == 'coordinator':
             for node_name in d_node:
+                # Nodes holding a liveness key are alive; their session expiry is handled by the
+                # liveness watch, so only nodes without one need their keepalive checked here
+                if node_name in live_node_list:
+                    continue
+
                 try:
                     node_daemon_state = zkhandler.readdata(zk_conn, '/nodes/{}/daemonstate'.format(node_name))
                     node_keepalive = int(zkhandler.readdata(zk_conn, '/nodes/{}/keepalive'.format(node_name)))
@@ -1650,16 +1829,7 @@ def node_keepalive():
                 # out-of-date while in 'start' state)
                 node_deadtime = int(time.time()) - (int(config['keepalive_interval']) * int(config['fence_intervals']))
                 if node_keepalive < node_deadtime and node_daemon_state == 'run':
-                    logger.out('Node {} seems dead - starting monitor for fencing'.format(node_name), state='w')
-                    zk_lock = zkhandler.writelock(zk_conn, '/nodes/{}/daemonstate'.format(node_name))
-                    with zk_lock:
-                        # Ensures that, if we lost the lock race and come out of waiting,
-                        # we won't try to trigger our own fence thread.
-                        if zkhandler.readdata(zk_conn, '/nodes/{}/daemonstate'.format(node_name)) != 'dead':
-                            fence_thread = Thread(target=fencing.fenceNode, args=(node_name, zk_conn, config, logger), kwargs={})
-                            fence_thread.start()
-                            # Write the updated data after we start the fence thread
-                            zkhandler.writedata(zk_conn, {'/nodes/{}/daemonstate'.format(node_name): 'dead'})
+                    fence_dead_node(node_name)
 
     if debug:
         logger.out("Keepalive finished", state='d', prefix='main-thread')
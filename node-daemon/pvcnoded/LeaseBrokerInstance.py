@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+# LeaseBrokerInstance.py - Class implementing a DHCP lease broker for dnsmasq, run by pvcnoded
+# Part of the Parallel Virtual Cluster (PVC) system
+#
+#    Copyright (C) 2018-2020 Joshua M. Boniface <joshua@boniface.me>
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+###############################################################################
+
+import os
+import json
+import time
+import socketserver
+
+from queue import Queue, Empty
+from threading import Thread, Event
+
+import daemon_lib.network as pvc_network
+
+
+class LeaseRequest(object):
+    # A single lease write, completed by the broker writer thread
+    def __init__(self, action, vni, macaddr, ipaddr=None, hostname=None, expiry='0', clientid='*'):
+        self.action = action
+        self.vni = vni
+        self.macaddr = macaddr
+        self.ipaddr = ipaddr
+        self.hostname = hostname
+        self.expiry = expiry
+        self.clientid = clientid
+        self.done = Event()
+        self.result = None
+
+    def complete(self, result):
+        self.result = result
+        self.done.set()
+
+
+class LeaseBrokerHandler(socketserver.StreamRequestHandler):
+    # Handle one request (a single JSON line) from the dnsmasq lease script
+    def handle(self):
+        broker = self.server.broker
+        try:
+            request = json.loads(self.rfile.readline().decode('utf8'))
+            response = broker.handle_request(request)
+        except Exception as e:
+            response = {'status': 'error', 'message': str(e)}
+        self.wfile.write((json.dumps(response) + '\n').encode('utf8'))
+
+
+class LeaseBrokerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class LeaseBrokerInstance(object):
+    # The time to wait for further lease writes before committing a batch, in seconds
+    batch_delay = 0.05
+    # The time a client waits for its lease write to be committed, in seconds
+    request_timeout = 10
+
+    # Initialization function
+    def __init__(self, zk_conn, config, logger):
+        self.zk_conn = zk_conn
+        self.config = config
+        self.logger = logger
+        self.socket_path = self.config['dnsmasq_lease_socket']
+        self.server = None
+        self.server_thread = None
+        self.writer_thread = None
+        self.thread_stopper = Event()
+        self.queue = Queue()
+
+    def start(self):
+        self.logger.out('Starting DHCP lease broker at {}'.format(self.socket_path), state='i')
+        # Remove any stale socket from a previous run
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        try:
+            self.server = LeaseBrokerServer(self.socket_path, LeaseBrokerHandler)
+            self.server.broker = self
+        except Exception as e:
+            self.logger.out('Error starting DHCP lease broker: {}'.format(e), state='e')
+            self.server = None
+            return
+
+        self.thread_stopper.clear()
+        self.writer_thread = Thread(target=self.run_writer, args=(), kwargs={})
+        self.writer_thread.start()
+        self.server_thread = Thread(target=self.server.serve_forever, args=(), kwargs={})
+        self.server_thread.start()
+        self.logger.out('Successfully started DHCP lease broker', state='o')
+
+    def stop(self):
+        if not self.server:
+            return
+
+        self.logger.out('Stopping DHCP lease broker', state='i')
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.thread_stopper.set()
+        self.writer_thread.join()
+        try:
+            os.remove(self.socket_path)
+        except Exception:
+            pass
+        self.logger.out('Successfully stopped DHCP lease broker', state='o')
+
+    # Handle a request from a client; returns the response dictionary
+    def handle_request(self, request):
+        action = request.get('action')
+        vni = str(request.get('vni'))
+
+        if action == 'init':
+            # Reads are done directly since they don't need batching
+            return {'status': 'ok', 'leases': self.read_leases(vni)}
+
+        if action not in ['add', 'del']:
+            return {'status': 'error', 'message': 'Invalid action "{}"'.format(action)}
+
+        lease_request = LeaseRequest(
+            action,
+            vni,
+            request.get('macaddr'),
+            ipaddr=request.get('ipaddr'),
+            hostname=request.get('hostname'),
+            expiry=request.get('expiry', '0'),
+            clientid=request.get('clientid', '*')
+        )
+        self.queue.put(lease_request)
+        if not lease_request.done.wait(timeout=self.request_timeout):
+            return {'status': 'error', 'message': 'Timed out waiting for lease write'}
+        return lease_request.result
+
+    # Read the leases of a network, in dnsmasq lease database format
+    def read_leases(self, vni):
+        output_list = list()
+        for macaddr, lease_data in pvc_network.getNetworkDHCPLeaseData(self.zk_conn, vni, 'dhcp4_leases').items():
+            output_list.append('{} {} {} {} {}'.format(
+                lease_data.get('expiry', '0'),
+                macaddr,
+                lease_data.get('ipaddr'),
+                lease_data.get('hostname', ''),
+                lease_data.get('clientid', '*')
+            ))
+        return output_list
+
+    # Background writer thread; collects lease writes and commits them in batches
+    def run_writer(self):
+        while not self.thread_stopper.is_set():
+            try:
+                batch = [self.queue.get(timeout=1)]
+            except Empty:
+                continue
+
+            # Collect any further writes that arrive in the meantime
+            time.sleep(self.batch_delay)
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            # Group the writes per network
+            network_batches = dict()
+            for lease_request in batch:
+                network_batches.setdefault(lease_request.vni, list()).append(lease_request)
+
+            for vni, lease_requests in network_batches.items():
+                try:
+                    self.commit_leases(vni, lease_requests)
+                    result = {'status': 'ok'}
+                except Exception as e:
+                    self.logger.out('Failed to commit DHCP lease batch for network {}: {}'.format(vni, e), state='e', prefix='lease-broker')
+                    result = {'status': 'error', 'message': str(e)}
+                for lease_request in lease_requests:
+                    lease_request.complete(result)
+
+    # Commit a batch of lease writes to one network in a single transaction
+    def commit_leases(self, vni, lease_requests):
+        zk_leases_key = '/networks/{}/dhcp4_leases'.format(vni)
+
+        # Only the last write for each MAC address matters
+        final_requests = dict()
+        for lease_request in lease_requests:
+            final_requests[lease_request.macaddr] = lease_request
+
+        if self.config['debug']:
+            self.logger.out('Committing {} lease writes for network {}'.format(len(final_requests), vni), state='d', prefix='lease-broker')
+
+        existing_leases = self.zk_conn.get_children(zk_leases_key)
+
+        transaction = self.zk_conn.transaction()
+        for macaddr, lease_request in final_requests.items():
+            lease_key = '{}/{}'.format(zk_leases_key, macaddr)
+
+            if lease_request.action == 'add':
+                hostname = lease_request.hostname
+                if not hostname:
+                    hostname = ''
+                lease_data = pvc_network.encodeDHCPLeaseData(
+                    lease_request.ipaddr,
+                    hostname,
+                    expiry=lease_request.expiry,
+                    clientid=lease_request.clientid
+                ).encode('utf8')
+            else:
+                lease_data = None
+
+            # Replace or remove any existing lease for this MAC address
+            existing_children = list()
+            if macaddr in existing_leases:
+                existing_children = self.zk_conn.get_children(lease_key)
+                if lease_data is not None and not existing_children:
+                    # An existing single-key lease can just be updated in place
+                    transaction.set_data(lease_key, lease_data)
+                    continue
+                # Otherwise remove it, including the child keys of an old-format lease
+                for child in existing_children:
+                    transaction.delete('{}/{}'.format(lease_key, child))
+                transaction.delete(lease_key)
+
+            if lease_data is not None:
+                transaction.create(lease_key, lease_data)
+
+        results = transaction.commit()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
@@ -24,18 +24,34 @@ import gevent.pywsgi
 import flask
 import sys
 import time
+import select
 import psycopg2
+import psycopg2.pool
+import lxml.objectify
 
-from threading import Thread
+from collections import OrderedDict
+from threading import Thread, Lock, Event
 from psycopg2.extras import RealDictCursor
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 import daemon_lib.vm as pvc_vm
 import daemon_lib.network as pvc_network
+import daemon_lib.common as pvc_common
+import daemon_lib.zkhandler as pvc_zkhandler
 
 
 class MetadataAPIInstance(object):
     mdapi = flask.Flask(__name__)
 
+    # Database connection pool sizes
+    pool_min_connections = 1
+    pool_max_connections = 4
+    # Userdata cache size and lifetime (seconds)
+    userdata_cache_size = 64
+    userdata_cache_ttl = 300
+    # Notification channel used by the API to signal profile/userdata changes
+    userdata_notify_channel = 'pvc_userdata'
+
     # Initialization function
     def __init__(self, zk_conn, config, logger):
         self.zk_conn = zk_conn
@@ -43,6 +59,22 @@ class MetadataAPIInstance(object):
         self.logger = logger
         self.thread = None
         self.md_http_server = None
+        # Watch-maintained index of IP address -> MAC address -> VM UUID
+        self.index_lock = Lock()
+        self.index_generation = 0
+        self.network_leases = dict()  # vni: {mac: ip}
+        self.ip_index = dict()  # ip: mac
+        self.lease_watches = dict()  # (vni, mac): watch id
+        self.vm_macs = dict()  # uuid: [mac]
+        self.mac_index = dict()  # mac: uuid
+        # Database connection pool, created on first use
+        self.db_pool = None
+        self.db_pool_lock = Lock()
+        # Cache of profile -> (timestamp, userdata), invalidated by database notifications
+        self.userdata_cache = OrderedDict()
+        self.userdata_cache_lock = Lock()
+        self.userdata_listener_thread = None
+        self.userdata_listener_stopper = Event()
         self.add_routes()
 
     # Add flask routes inside our instance
@@ -104,6 +136,14 @@ class MetadataAPIInstance(object):
 
     # WSGI start/stop
     def start(self):
+        # Build the lookup index
+        self.start_index()
+
+        # Listen for userdata changes
+        self.userdata_listener_stopper.clear()
+        self.userdata_listener_thread = Thread(target=self.listen_userdata_changes, args=(), kwargs={})
+        self.userdata_listener_thread.start()
+
         # Launch Metadata API
         self.logger.out('Starting Metadata API at 169.254.169.254:80', state='i')
         self.thread = Thread(target=self.launch_wsgi)
@@ -111,7 +151,18 @@ class MetadataAPIInstance(object):
         self.logger.out('Successfully started Metadata API thread', state='o')
 
     def stop(self):
+        # Stop maintaining the lookup index
+        self.stop_index()
+
+        # Stop listening for userdata changes
+        self.userdata_listener_stopper.set()
+        if self.userdata_listener_thread is not None:
+            self.userdata_listener_thread.join()
+            self.userdata_listener_thread = None
+        self.clear_userdata_cache()
+
         if not self.md_http_server:
+            self.close_database_pool()
             return
 
         self.logger.out('Stopping Metadata API at 169.254.169.254:80', state='i')
@@ -124,25 +175,54 @@ class MetadataAPIInstance(object):
             self.logger.out('Successfully stopped Metadata API', state='o')
         except Exception as e:
             self.logger.out('Error stopping Metadata API: {}'.format(e), state='e')
+        self.close_database_pool()
 
     # Helper functions
+    def database_args(self):
+        return {
+            'host': self.config['metadata_postgresql_host'],
+            'port': self.config['metadata_postgresql_port'],
+            'dbname': self.config['metadata_postgresql_dbname'],
+            'user': self.config['metadata_postgresql_user'],
+            'password': self.config['metadata_postgresql_password']
+        }
+
     def open_database(self):
-        conn = psycopg2.connect(
-            host=self.config['metadata_postgresql_host'],
-            port=self.config['metadata_postgresql_port'],
-            dbname=self.config['metadata_postgresql_dbname'],
-            user=self.config['metadata_postgresql_user'],
-            password=self.config['metadata_postgresql_password']
-        )
+        with self.db_pool_lock:
+            if self.db_pool is None:
+                self.db_pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.pool_min_connections,
+                    self.pool_max_connections,
+                    **self.database_args()
+                )
+            db_pool = self.db_pool
+        conn = db_pool.getconn()
         cur = conn.cursor(cursor_factory=RealDictCursor)
         return conn, cur
 
-    def close_database(self, conn, cur):
+    def close_database(self, conn, cur, failed=False):
         cur.close()
-        conn.close()
+        if failed:
+            # Discard the connection rather than return a possibly broken one to the pool
+            self.db_pool.putconn(conn, close=True)
+        else:
+            conn.rollback()
+            self.db_pool.putconn(conn)
 
-    # Obtain a list of templates
+    def close_database_pool(self):
+        with self.db_pool_lock:
+            if self.db_pool is not None:
+                self.db_pool.closeall()
+                self.db_pool = None
+
+    # Obtain the userdata for a profile, from the cache if possible
     def get_profile_userdata(self, vm_profile):
+        with self.userdata_cache_lock:
+            cached = self.userdata_cache.get(vm_profile, None)
+            if cached is not None and time.time() - cached[0] < self.userdata_cache_ttl:
+                self.userdata_cache.move_to_end(vm_profile)
+                return cached[1]
+
         query = """SELECT userdata.userdata FROM profile
         JOIN userdata ON profile.userdata = userdata.id
         WHERE profile.name = %s;
@@ -150,14 +230,225 @@ class MetadataAPIInstance(object):
         args = (vm_profile,)
 
         conn, cur = self.open_database()
-        cur.execute(query, args)
-        data_raw = cur.fetchone()
+        try:
+            cur.execute(query, args)
+            data_raw = cur.fetchone()
+        except Exception:
+            self.close_database(conn, cur, failed=True)
+            raise
         self.close_database(conn, cur)
+        if data_raw is None:
+            return None
         data = data_raw.get('userdata', None)
+
+        with self.userdata_cache_lock:
+            self.userdata_cache[vm_profile] = (time.time(), data)
+            self.userdata_cache.move_to_end(vm_profile)
+            while len(self.userdata_cache) > self.userdata_cache_size:
+                self.userdata_cache.popitem(last=False)
         return data
 
+    def clear_userdata_cache(self):
+        with self.userdata_cache_lock:
+            self.userdata_cache.clear()
+
+    # Listen for profile/userdata change notifications from the API and clear the cache on each;
+    # if the listener connection fails, the cache is cleared and the TTL covers the gap
+    def listen_userdata_changes(self):
+        while not self.userdata_listener_stopper.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.database_args())
+                conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                cur.execute('LISTEN {};'.format(self.userdata_notify_channel))
+                cur.close()
+                self.clear_userdata_cache()
+                while not self.userdata_listener_stopper.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []):
+                        continue
+                    conn.poll()
+                    if conn.notifies:
+                        del conn.notifies[:]
+                        if self.config['debug']:
+                            self.logger.out('Profile or userdata changed; clearing userdata cache', state='d', prefix='Metadata API')
+                        self.clear_userdata_cache()
+            except Exception as e:
+                self.logger.out('Userdata change listener failed: {}'.format(e), state='w', prefix='Metadata API')
+                self.clear_userdata_cache()
+                self.userdata_listener_stopper.wait(5)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    # Lookup index functions
+    # The index is maintained by watches while the Metadata API is running; each set of watches
+    # belongs to one index generation, and terminates itself once the generation changes.
+    def start_index(self):
+        with self.index_lock:
+            self.index_generation += 1
+            generation = self.index_generation
+            self.network_leases = dict()
+            self.ip_index = dict()
+            self.lease_watches = dict()
+            self.vm_macs = dict()
+            self.mac_index = dict()
+
+        @self.zk_conn.ChildrenWatch('/networks')
+        def watch_index_networks(new_network_list):
+            if generation != self.index_generation:
+                return False
+
+            for vni in new_network_list:
+                if vni not in self.network_leases:
+                    self.network_leases[vni] = dict()
+                    try:
+                        nettype = pvc_zkhandler.readdata(self.zk_conn, '/networks/{}/nettype'.format(vni))
+                    except Exception:
+                        nettype = None
+                    if nettype == 'managed':
+                        self.watch_index_network(generation, vni)
+
+            for vni in list(self.network_leases.keys()):
+                if vni not in new_network_list:
+                    self.update_index_leases(generation, vni, list())
+                    del self.network_leases[vni]
+
+        @self.zk_conn.ChildrenWatch('/domains')
+        def watch_index_domains(new_domain_list):
+            if generation != self.index_generation:
+                return False
+
+            for dom_uuid in new_domain_list:
+                if dom_uuid not in self.vm_macs:
+                    self.vm_macs[dom_uuid] = list()
+                    self.watch_index_domain(generation, dom_uuid)
+
+            for dom_uuid in list(self.vm_macs.keys()):
+                if dom_uuid not in new_domain_list:
+                    self.update_index_macs(dom_uuid, list())
+                    del self.vm_macs[dom_uuid]
+
+    def stop_index(self):
+        with self.index_lock:
+            self.index_generation += 1
+
+    def watch_index_network(self, generation, vni):
+        @self.zk_conn.ChildrenWatch('/networks/{}/dhcp4_leases'.format(vni))
+        def watch_index_leases(new_lease_list, event=''):
+            if generation != self.index_generation:
+                return False
+            if event and event.type == 'DELETED':
+                return False
+
+            self.update_index_leases(generation, vni, new_lease_list)
+
+    def watch_index_lease(self, generation, vni, mac, watch_id):
+        # Leases are rewritten in place when renewed or reassigned, so each one is watched for its address
+        @self.zk_conn.DataWatch('/networks/{}/dhcp4_leases/{}'.format(vni, mac))
+        def watch_index_lease_data(data, stat, event=''):
+            if generation != self.index_generation:
+                return False
+            # A watch whose lease was removed from the index (and possibly re-added with a new watch) terminates itself
+            if self.lease_watches.get((vni, mac)) is not watch_id:
+                return False
+
+            ip = None
+            if data is not None:
+                try:
+                    ip = pvc_network.decodeDHCPLeaseData(self.zk_conn, vni, 'dhcp4_leases', mac, data.decode('utf8')).get('ipaddr')
+                except Exception:
+                    pass
+
+            with self.index_lock:
+                if self.lease_watches.get((vni, mac)) is not watch_id:
+                    return False
+                if data is None:
+                    # The lease is gone; it is watched anew if it reappears in the lease list
+                    self.remove_index_lease(vni, mac)
+                    return False
+                old_ip = self.network_leases[vni].get(mac)
+                if old_ip and self.ip_index.get(old_ip) == mac:
+                    del self.ip_index[old_ip]
+                self.network_leases[vni][mac] = ip
+                if ip:
+                    self.ip_index[ip] = mac
+
+    def watch_index_domain(self, generation, dom_uuid):
+        @self.zk_conn.DataWatch('/domains/{}/xml'.format(dom_uuid))
+        def watch_index_xml(data, stat, event=''):
+            if generation != self.index_generation:
+                return False
+            if event and event.type == 'DELETED':
+                return False
+
+            mac_list = list()
+            try:
+                parsed_xml = lxml.objectify.fromstring(data.decode('utf8'))
+                for device in parsed_xml.devices.getchildren():
+                    if device.tag == 'interface':
+                        mac_list.append(device.mac.attrib.get('address'))
+            except Exception:
+                pass
+            self.update_index_macs(dom_uuid, mac_list)
+
+    def update_index_leases(self, generation, vni, new_lease_list):
+        # Track lease membership here; each lease's address is filled in and kept current by its own watch
+        added_leases = dict()
+        with self.index_lock:
+            leases = self.network_leases.setdefault(vni, dict())
+            for mac in list(leases.keys()):
+                if mac not in new_lease_list:
+                    self.remove_index_lease(vni, mac)
+            for mac in new_lease_list:
+                if mac not in leases:
+                    leases[mac] = None
+                    added_leases[mac] = self.lease_watches[(vni, mac)] = object()
+
+        for mac, watch_id in added_leases.items():
+            self.watch_index_lease(generation, vni, mac, watch_id)
+
+    def remove_index_lease(self, vni, mac):
+        # Called with the index lock held
+        ip = self.network_leases[vni].pop(mac, None)
+        if ip and self.ip_index.get(ip) == mac:
+            del self.ip_index[ip]
+        self.lease_watches.pop((vni, mac), None)
+
+    def update_index_macs(self, dom_uuid, new_mac_list):
+        with self.index_lock:
+            for mac in self.vm_macs.get(dom_uuid, list()):
+                if self.mac_index.get(mac) == dom_uuid:
+                    del self.mac_index[mac]
+            for mac in new_mac_list:
+                self.mac_index[mac] = dom_uuid
+            self.vm_macs[dom_uuid] = new_mac_list
+
     # VM details function
     def get_vm_details(self, source_address):
+        # Look up the VM in the index
+        client_macaddr = self.ip_index.get(source_address, None)
+        dom_uuid = self.mac_index.get(client_macaddr, None)
+        if dom_uuid:
+            try:
+                vm_details = pvc_common.getInformationFromXML(self.zk_conn, dom_uuid)
+                # Ensure the VM still has this MAC address
+                for network in vm_details.get('networks'):
+                    if network.get('mac', None) == client_macaddr:
+                        return vm_details
+            except Exception:
+                pass
+
+        # Fall back to a full search of the cluster
+        if self.config['debug']:
+            self.logger.out('Address {} not found in index; searching cluster'.format(source_address), state='d', prefix='Metadata API')
+        return self.search_vm_details(source_address)
+
+    # VM details function (full cluster search)
+    def search_vm_details(self, source_address):
         # Start connection to Zookeeper
         _discard, networks = pvc_network.get_list(self.zk_conn, None)
 
@@ -165,9 +456,9 @@ class MetadataAPIInstance(object):
         host_information = dict()
         networks_managed = (x for x in networks if x.get('type') == 'managed')
         for network in networks_managed:
-            network_leases = pvc_network.getNetworkDHCPLeases(self.zk_conn, network.get('vni'))
-            for network_lease in network_leases:
-                information = pvc_network.getDHCPLeaseInformation(self.zk_conn, network.get('vni'), network_lease)
+            network_leases = pvc_network.getNetworkDHCPLeaseData(self.zk_conn, network.get('vni'), 'dhcp4_leases')
+            for network_lease, lease_data in network_leases.items():
+                information = pvc_network.getDHCPLeaseInformation(self.zk_conn, network.get('vni'), network_lease, type_key='dhcp4_leases', lease_data=lease_data)
                 try:
                     if information.get('ip4_address', None) == source_address:
                         host_information = information
@@ -21,6 +21,7 @@
 ###############################################################################
 
 import time
+import json
 
 from threading import Thread
 
@@ -91,6 +92,12 @@ class NodeInstance(object):
         # Flags
         self.flush_stopper = False
 
+        # Our own running domain list starts from the last recorded one
+        if self.name == self.this_node:
+            running_domains = zkhandler.readdata(self.zk_conn, '/nodes/{}/runningdomains'.format(self.name))
+            if running_domains:
+                self.domain_list = running_domains.split()
+
         # Zookeeper handlers for changed states
         @self.zk_conn.DataWatch('/nodes/{}/daemonstate'.format(self.name))
         def watch_node_daemonstate(data, stat, event=''):
@@ -171,95 +178,29 @@ class NodeInstance(object):
                         self.flush_thread = Thread(target=self.unflush, args=(), kwargs={})
                         self.flush_thread.start()
 
-        @self.zk_conn.DataWatch('/nodes/{}/memfree'.format(self.name))
-        def watch_node_memfree(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            try:
-                data = data.decode('ascii')
-            except AttributeError:
-                data = 0
-
-            if data != self.memfree:
-                self.memfree = data
-
-        @self.zk_conn.DataWatch('/nodes/{}/memused'.format(self.name))
-        def watch_node_memused(data, stat, event=''):
+        # The fast-changing resource metrics are all carried in one status key
+        @self.zk_conn.DataWatch('/nodes/{}/status'.format(self.name))
+        def watch_node_status(data, stat, event=''):
             if event and event.type == 'DELETED':
                 # The key has been deleted after existing before; terminate this watcher
                 # because this class instance is about to be reaped in Daemon.py
                 return False
 
-            try:
-                data = data.decode('ascii')
-            except AttributeError:
-                data = 0
-
-            if data != self.memused:
-                self.memused = data
-
-        @self.zk_conn.DataWatch('/nodes/{}/memalloc'.format(self.name))
-        def watch_node_memalloc(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            try:
-                data = data.decode('ascii')
-            except AttributeError:
-                data = 0
-
-            if data != self.memalloc:
-                self.memalloc = data
-
-        @self.zk_conn.DataWatch('/nodes/{}/vcpualloc'.format(self.name))
-        def watch_node_vcpualloc(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            try:
-                data = data.decode('ascii')
-            except AttributeError:
-                data = 0
-
-            if data != self.vcpualloc:
-                self.vcpualloc = data
-
-        @self.zk_conn.DataWatch('/nodes/{}/runningdomains'.format(self.name))
-        def watch_node_runningdomains(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            try:
-                data = data.decode('ascii').split()
-            except AttributeError:
-                data = []
-
-            if data != self.domain_list:
-                self.domain_list = data
-
-        @self.zk_conn.DataWatch('/nodes/{}/domainscount'.format(self.name))
-        def watch_node_domainscount(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
+            # Our own values are maintained directly by the keepalive and VM instances
+            if self.name == self.this_node:
+                return
 
             try:
-                data = data.decode('ascii')
-            except AttributeError:
-                data = 0
-
-            if data != self.domains_count:
-                self.domains_count = data
+                status = json.loads(data.decode('ascii'))
+            except (AttributeError, ValueError):
+                status = dict()
+
+            self.memfree = status.get('memfree', 0)
+            self.memused = status.get('memused', 0)
+            self.memalloc = status.get('memalloc', 0)
+            self.vcpualloc = status.get('vcpualloc', 0)
+            self.domain_list = status.get('runningdomains', '').split()
+            self.domains_count = status.get('domainscount', 0)
 
     # Update value functions
     def update_node_list(self, d_node):
@@ -25,7 +25,7 @@ import time
 import libvirt
 import json
 
-from threading import Thread
+from threading import Thread, Lock
 
 from xml.etree import ElementTree
 
@@ -35,6 +35,7 @@ import pvcnoded.common as common
 import pvcnoded.VMConsoleWatcherInstance as VMConsoleWatcherInstance
 
 import daemon_lib.common as daemon_common
+import daemon_lib.zkhandler as pvc_zkhandler
 
 
 def flush_locks(zk_conn, logger, dom_uuid, this_node=None):
@@ -76,7 +77,7 @@ def flush_locks(zk_conn, logger, dom_uuid, this_node=None):
 
 
 # Primary command function
-def run_command(zk_conn, logger, this_node, data):
+def run_command(zk_conn, logger, this_node, request_key, data):
     # Get the command and args
     command, args = data.split()
 
@@ -84,23 +85,16 @@ def run_command(zk_conn, logger, this_node, data):
     if command == 'flush_locks':
         dom_uuid = args
 
-        # Verify that the VM is set to run on this node
-        if this_node.d_domain[dom_uuid].getnode() == this_node.name:
-            # Lock the command queue
-            zk_lock = zkhandler.writelock(zk_conn, '/cmd/domains')
-            with zk_lock:
-                # Flush the lock
-                result = flush_locks(zk_conn, logger, dom_uuid, this_node)
-                # Command succeeded
-                if result:
-                    # Update the command queue
-                    zkhandler.writedata(zk_conn, {'/cmd/domains': 'success-{}'.format(data)})
-                # Command failed
-                else:
-                    # Update the command queue
-                    zkhandler.writedata(zk_conn, {'/cmd/domains': 'failure-{}'.format(data)})
-                # Wait 1 seconds before we free the lock, to ensure the client hits the lock
-                time.sleep(1)
+        # Verify that the VM is set to run on this node; read it directly since a stub instance
+        # only refreshes its node on state changes
+        if zkhandler.readdata(zk_conn, '/domains/{}/node'.format(dom_uuid)) == this_node.name:
+            # Claim the request
+            if not common.claim_command(zk_conn, request_key, this_node.name):
+                return
+            # Flush the lock
+            result = flush_locks(zk_conn, logger, dom_uuid, this_node)
+            # Record the result
+            common.finish_command(zk_conn, request_key, result)
 
 
 class VMInstance(object):
@@ -113,21 +107,17 @@ class VMInstance(object):
         self.logger = logger
         self.this_node = this_node
 
-        # Get data from zookeeper
-        self.domname = zkhandler.readdata(zk_conn, '/domains/{}'.format(domuuid))
-        self.state = zkhandler.readdata(self.zk_conn, '/domains/{}/state'.format(self.domuuid))
-        self.node = zkhandler.readdata(self.zk_conn, '/domains/{}/node'.format(self.domuuid))
-        self.lastnode = zkhandler.readdata(self.zk_conn, '/domains/{}/lastnode'.format(self.domuuid))
-        self.last_currentnode = zkhandler.readdata(self.zk_conn, '/domains/{}/node'.format(self.domuuid))
-        self.last_lastnode = zkhandler.readdata(self.zk_conn, '/domains/{}/lastnode'.format(self.domuuid))
-        try:
-            self.pinpolicy = zkhandler.readdata(self.zk_conn, '/domains/{}/pinpolicy'.format(self.domuuid))
-        except Exception:
-            self.pinpolicy = "none"
-        try:
-            self.migration_method = zkhandler.readdata(self.zk_conn, '/domains/{}/migration_method'.format(self.domuuid))
-        except Exception:
-            self.migration_method = 'none'
+        # Get the basic data from zookeeper in one batched read
+        domain_data = pvc_zkhandler.readdatamany(self.zk_conn, [
+            '/domains/{}'.format(self.domuuid),
+            '/domains/{}/state'.format(self.domuuid),
+            '/domains/{}/node'.format(self.domuuid),
+            '/domains/{}/lastnode'.format(self.domuuid)
+        ])
+        self.domname = domain_data['/domains/{}'.format(self.domuuid)]
+        self.state = domain_data['/domains/{}/state'.format(self.domuuid)]
+        self.node = domain_data['/domains/{}/node'.format(self.domuuid)]
+        self.lastnode = domain_data['/domains/{}/lastnode'.format(self.domuuid)]
 
         # These will all be set later
         self.instart = False
@@ -137,11 +127,14 @@ class VMInstance(object):
         self.inshutdown = False
         self.instop = False
 
-        # Libvirt domuuid
-        self.dom = self.lookupByUUID(self.domuuid)
-
-        # Log watcher instance
-        self.console_log_instance = VMConsoleWatcherInstance.VMConsoleWatcherInstance(self.domuuid, self.domname, self.zk_conn, self.config, self.logger, self.this_node)
+        # VMs not assigned to this node are tracked as lightweight stubs holding only their
+        # node and state; they are promoted to full instances once targeted at this node
+        self.stub = True
+        self.promote_lock = Lock()
+        self.dom = None
+        self.console_log_instance = None
+        if self.node == self.this_node.name:
+            self.promote()
 
         # Watch for changes to the state field in Zookeeper
         @self.zk_conn.DataWatch('/domains/{}/state'.format(self.domuuid))
@@ -151,11 +144,48 @@ class VMInstance(object):
                 # because this class instance is about to be reaped in Daemon.py
                 return False
 
+            # Stubs only need their node and state kept current until they are targeted here
+            if self.stub:
+                self.state = data.decode('ascii') if data else None
+                self.node = zkhandler.readdata(self.zk_conn, '/domains/{}/node'.format(self.domuuid))
+                if self.node != self.this_node.name:
+                    return
+                self.promote()
+
             # Perform a management command
             self.logger.out('Updating state of VM {}'.format(self.domuuid), state='i')
             state_thread = Thread(target=self.manage_vm_state, args=(), kwargs={})
             state_thread.start()
 
+    # Promote a stub to a full instance
+    def promote(self):
+        with self.promote_lock:
+            if not self.stub:
+                return
+
+            domain_data = pvc_zkhandler.readdatamany(self.zk_conn, [
+                '/domains/{}/lastnode'.format(self.domuuid),
+                '/domains/{}/pinpolicy'.format(self.domuuid),
+                '/domains/{}/migration_method'.format(self.domuuid)
+            ])
+            self.lastnode = domain_data['/domains/{}/lastnode'.format(self.domuuid)]
+            self.last_currentnode = self.node
+            self.last_lastnode = self.lastnode
+            self.pinpolicy = domain_data['/domains/{}/pinpolicy'.format(self.domuuid)]
+            if self.pinpolicy is None:
+                self.pinpolicy = "none"
+            self.migration_method = domain_data['/domains/{}/migration_method'.format(self.domuuid)]
+            if self.migration_method is None:
+                self.migration_method = 'none'
+
+            # Libvirt domuuid
+            self.dom = self.lookupByUUID(self.domuuid)
+
+            # Log watcher instance
+            self.console_log_instance = VMConsoleWatcherInstance.VMConsoleWatcherInstance(self.domuuid, self.domname, self.zk_conn, self.config, self.logger, self.this_node)
+
+            self.stub = False
+
     # Get data functions
     def getstate(self):
         return self.state
@@ -22,14 +22,22 @@
 
 import os
 import time
+import json
 
 from textwrap import dedent
+from threading import Timer, Lock
 
 import pvcnoded.zkhandler as zkhandler
 import pvcnoded.common as common
 
+import daemon_lib.network as pvc_network
+import daemon_lib.zkhandler as pvc_zkhandler
+
 
 class VXNetworkInstance(object):
+    # Delay (seconds) to coalesce bursts of ACL changes into one firewall update
+    firewall_update_delay = 0.5
+
     # Initialization function
     def __init__(self, vni, zk_conn, config, logger, this_node, dns_aggregator):
         self.vni = vni
@@ -89,30 +97,39 @@ class VXNetworkInstance(object):
 
     # Initialize a managed network
     def init_managed(self):
+        # Read the whole network configuration at once
+        self.network_config = pvc_network.getNetworkConfig(self.zk_conn, self.vni)
         self.old_description = None
-        self.description = None
-        self.domain = None
-        self.name_servers = None
-        self.ip6_gateway = zkhandler.readdata(self.zk_conn, '/networks/{}/ip6_gateway'.format(self.vni))
-        self.ip6_network = zkhandler.readdata(self.zk_conn, '/networks/{}/ip6_network'.format(self.vni))
-        self.ip6_cidrnetmask = zkhandler.readdata(self.zk_conn, '/networks/{}/ip6_network'.format(self.vni)).split('/')[-1]
-        self.dhcp6_flag = (zkhandler.readdata(self.zk_conn, '/networks/{}/dhcp6_flag'.format(self.vni)) == 'True')
-        self.ip4_gateway = zkhandler.readdata(self.zk_conn, '/networks/{}/ip4_gateway'.format(self.vni))
-        self.ip4_network = zkhandler.readdata(self.zk_conn, '/networks/{}/ip4_network'.format(self.vni))
-        self.ip4_cidrnetmask = zkhandler.readdata(self.zk_conn, '/networks/{}/ip4_network'.format(self.vni)).split('/')[-1]
-        self.dhcp4_flag = (zkhandler.readdata(self.zk_conn, '/networks/{}/dhcp4_flag'.format(self.vni)) == 'True')
-        self.dhcp4_start = (zkhandler.readdata(self.zk_conn, '/networks/{}/dhcp4_start'.format(self.vni)) == 'True')
-        self.dhcp4_end = (zkhandler.readdata(self.zk_conn, '/networks/{}/dhcp4_end'.format(self.vni)) == 'True')
+        self.description = self.network_config['description']
+        self.domain = self.network_config['domain']
+        self.name_servers = self.network_config['name_servers'].split(',')
+        self.ip6_gateway = self.network_config['ip6_gateway']
+        self.ip6_network = self.network_config['ip6_network']
+        self.ip6_cidrnetmask = self.network_config['ip6_network'].split('/')[-1]
+        self.dhcp6_flag = (self.network_config['dhcp6_flag'] == 'True')
+        self.ip4_gateway = self.network_config['ip4_gateway']
+        self.ip4_network = self.network_config['ip4_network']
+        self.ip4_cidrnetmask = self.network_config['ip4_network'].split('/')[-1]
+        self.dhcp4_flag = (self.network_config['dhcp4_flag'] == 'True')
+        self.dhcp4_start = self.network_config['dhcp4_start']
+        self.dhcp4_end = self.network_config['dhcp4_end']
 
         self.vxlan_nic = 'vxlan{}'.format(self.vni)
         self.bridge_nic = 'vmbr{}'.format(self.vni)
 
         self.nftables_netconf_filename = '{}/networks/{}.nft'.format(self.config['nft_dynamic_directory'], self.vni)
+        self.nftables_remove_filename = '{}/{}-remove.nft'.format(self.config['nft_dynamic_directory'], self.vni)
         self.firewall_rules = []
+        self.firewall_elements = []
+        self.firewall_active = True
+        self.firewall_lock = Lock()
+        self.firewall_update_timer = None
+        self.firewall_update_lock = Lock()
 
         self.dhcp_server_daemon = None
         self.dnsmasq_hostsdir = '{}/{}'.format(self.config['dnsmasq_dynamic_directory'], self.vni)
         self.dhcp_reservations = []
+        self.dhcp_leases = []
 
         # Create the network hostsdir
         common.run_os_command(
@@ -121,223 +138,52 @@ class VXNetworkInstance(object):
             )
         )
 
+        # The rules for each network live in their own chains, which are replaced as a
+        # whole in a single nft transaction; the base chains reach them via the maps
+        # set up in Daemon.py, so no other network's rules are touched
         self.firewall_rules_base = """# Rules for network {vxlannic}
+add chain inet filter {vxlannic}-input
 add chain inet filter {vxlannic}-in
 add chain inet filter {vxlannic}-out
+flush chain inet filter {vxlannic}-input
+flush chain inet filter {vxlannic}-in
+flush chain inet filter {vxlannic}-out
 add rule inet filter {vxlannic}-in counter
 add rule inet filter {vxlannic}-out counter
 # Allow ICMP traffic into the router from network
-add rule inet filter input ip protocol icmp meta iifname {bridgenic} counter accept
-add rule inet filter input ip6 nexthdr icmpv6 meta iifname {bridgenic} counter accept
+add rule inet filter {vxlannic}-input ip protocol icmp counter accept
+add rule inet filter {vxlannic}-input ip6 nexthdr icmpv6 counter accept
 # Allow DNS, DHCP, and NTP traffic into the router from network
-add rule inet filter input tcp dport 53 meta iifname {bridgenic} counter accept
-add rule inet filter input udp dport 53 meta iifname {bridgenic} counter accept
-add rule inet filter input udp dport 67 meta iifname {bridgenic} counter accept
-add rule inet filter input udp dport 123 meta iifname {bridgenic} counter accept
-add rule inet filter input ip6 nexthdr udp udp dport 547 meta iifname {bridgenic} counter accept
+add rule inet filter {vxlannic}-input tcp dport 53 counter accept
+add rule inet filter {vxlannic}-input udp dport 53 counter accept
+add rule inet filter {vxlannic}-input udp dport 67 counter accept
+add rule inet filter {vxlannic}-input udp dport 123 counter accept
+add rule inet filter {vxlannic}-input ip6 nexthdr udp udp dport 547 counter accept
 # Allow metadata API into the router from network
-add rule inet filter input tcp dport 80 meta iifname {bridgenic} counter accept
+add rule inet filter {vxlannic}-input tcp dport 80 counter accept
 # Block traffic into the router from network
-add rule inet filter input meta iifname {bridgenic} counter drop
-""".format(
-            vxlannic=self.vxlan_nic,
-            bridgenic=self.bridge_nic
-        )
-
-        self.firewall_rules_v4 = """# Jump from forward chain to this chain when matching net (IPv4)
-add rule inet filter forward ip daddr {netaddr4} counter jump {vxlannic}-in
-add rule inet filter forward ip saddr {netaddr4} counter jump {vxlannic}-out
-""".format(
-            netaddr4=self.ip4_network,
-            vxlannic=self.vxlan_nic,
-        )
-        self.firewall_rules_v6 = """# Jump from forward chain to this chain when matching net (IPv4)
-add rule inet filter forward ip6 daddr {netaddr6} counter jump {vxlannic}-in
-add rule inet filter forward ip6 saddr {netaddr6} counter jump {vxlannic}-out
+add rule inet filter {vxlannic}-input counter drop
 """.format(
-            netaddr6=self.ip6_network,
-            vxlannic=self.vxlan_nic,
+            vxlannic=self.vxlan_nic
         )
 
         self.firewall_rules_in = zkhandler.listchildren(self.zk_conn, '/networks/{}/firewall_rules/in'.format(self.vni))
         self.firewall_rules_out = zkhandler.listchildren(self.zk_conn, '/networks/{}/firewall_rules/out'.format(self.vni))
 
         # Zookeper handlers for changed states
-        @self.zk_conn.DataWatch('/networks/{}'.format(self.vni))
-        def watch_network_description(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.description != data.decode('ascii'):
-                self.old_description = self.description
-                self.description = data.decode('ascii')
-                if self.dhcp_server_daemon:
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/domain'.format(self.vni))
-        def watch_network_domain(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.domain != data.decode('ascii'):
-                domain = data.decode('ascii')
-                if self.dhcp_server_daemon:
-                    self.dns_aggregator.remove_network(self)
-                self.domain = domain
-                if self.dhcp_server_daemon:
-                    self.dns_aggregator.add_network(self)
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/name_servers'.format(self.vni))
-        def watch_network_name_servers(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.name_servers != data.decode('ascii'):
-                name_servers = data.decode('ascii').split(',')
-                if self.dhcp_server_daemon:
-                    self.dns_aggregator.remove_network(self)
-                self.name_servers = name_servers
-                if self.dhcp_server_daemon:
-                    self.dns_aggregator.add_network(self)
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/ip6_network'.format(self.vni))
-        def watch_network_ip6_network(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.ip6_network != data.decode('ascii'):
-                ip6_network = data.decode('ascii')
-                self.ip6_network = ip6_network
-                self.ip6_cidrnetmask = ip6_network.split('/')[-1]
-                if self.dhcp_server_daemon:
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/ip6_gateway'.format(self.vni))
-        def watch_network_gateway6(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.ip6_gateway != data.decode('ascii'):
-                orig_gateway = self.ip6_gateway
-                if self.this_node.router_state in ['primary', 'takeover']:
-                    if orig_gateway:
-                        self.removeGateway6Address()
-                self.ip6_gateway = data.decode('ascii')
-                if self.this_node.router_state in ['primary', 'takeover']:
-                    self.createGateway6Address()
-                    if self.dhcp_server_daemon:
-                        self.stopDHCPServer()
-                        self.startDHCPServer()
-                if self.dhcp_server_daemon:
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/dhcp6_flag'.format(self.vni))
-        def watch_network_dhcp6_status(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.dhcp6_flag != (data.decode('ascii') == 'True'):
-                self.dhcp6_flag = (data.decode('ascii') == 'True')
-                if self.dhcp6_flag and not self.dhcp_server_daemon and self.this_node.router_state in ['primary', 'takeover']:
-                    self.startDHCPServer()
-                elif self.dhcp_server_daemon and not self.dhcp4_flag and self.this_node.router_state in ['primary', 'takeover']:
-                    self.stopDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/ip4_network'.format(self.vni))
-        def watch_network_ip4_network(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.ip4_network != data.decode('ascii'):
-                ip4_network = data.decode('ascii')
-                self.ip4_network = ip4_network
-                self.ip4_cidrnetmask = ip4_network.split('/')[-1]
-                if self.dhcp_server_daemon:
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/ip4_gateway'.format(self.vni))
-        def watch_network_gateway4(data, stat, event=''):
+        @self.zk_conn.DataWatch('/networks/{}/config'.format(self.vni))
+        def watch_network_config(data, stat, event=''):
             if event and event.type == 'DELETED':
                 # The key has been deleted after existing before; terminate this watcher
                 # because this class instance is about to be reaped in Daemon.py
                 return False
 
-            if data and self.ip4_gateway != data.decode('ascii'):
-                orig_gateway = self.ip4_gateway
-                if self.this_node.router_state in ['primary', 'takeover']:
-                    if orig_gateway:
-                        self.removeGateway4Address()
-                self.ip4_gateway = data.decode('ascii')
-                if self.this_node.router_state in ['primary', 'takeover']:
-                    self.createGateway4Address()
-                    if self.dhcp_server_daemon:
-                        self.stopDHCPServer()
-                        self.startDHCPServer()
-                if self.dhcp_server_daemon:
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/dhcp4_flag'.format(self.vni))
-        def watch_network_dhcp4_status(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.dhcp4_flag != (data.decode('ascii') == 'True'):
-                self.dhcp4_flag = (data.decode('ascii') == 'True')
-                if self.dhcp4_flag and not self.dhcp_server_daemon and self.this_node.router_state in ['primary', 'takeover']:
-                    self.startDHCPServer()
-                elif self.dhcp_server_daemon and not self.dhcp6_flag and self.this_node.router_state in ['primary', 'takeover']:
-                    self.stopDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/dhcp4_start'.format(self.vni))
-        def watch_network_dhcp4_start(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.dhcp4_start != data.decode('ascii'):
-                self.dhcp4_start = data.decode('ascii')
-                if self.dhcp_server_daemon:
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
-
-        @self.zk_conn.DataWatch('/networks/{}/dhcp4_end'.format(self.vni))
-        def watch_network_dhcp4_end(data, stat, event=''):
-            if event and event.type == 'DELETED':
-                # The key has been deleted after existing before; terminate this watcher
-                # because this class instance is about to be reaped in Daemon.py
-                return False
-
-            if data and self.dhcp4_end != data.decode('ascii'):
-                self.dhcp4_end = data.decode('ascii')
-                if self.dhcp_server_daemon:
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
+            if data:
+                try:
+                    new_config = json.loads(data.decode('utf8'))
+                except Exception:
+                    return
+                self.updateNetworkConfig(new_config)
 
         @self.zk_conn.ChildrenWatch('/networks/{}/dhcp4_reservations'.format(self.vni))
         def watch_network_dhcp_reservations(new_reservations, event=''):
@@ -351,9 +197,19 @@ add rule inet filter forward ip6 saddr {netaddr6} counter jump {vxlannic}-out
                 self.dhcp_reservations = new_reservations
                 if self.this_node.router_state in ['primary', 'takeover']:
                     self.updateDHCPReservations(old_reservations, new_reservations)
-                if self.dhcp_server_daemon:
-                    self.stopDHCPServer()
-                    self.startDHCPServer()
+
+        @self.zk_conn.ChildrenWatch('/networks/{}/dhcp4_leases'.format(self.vni))
+        def watch_network_dhcp_leases(new_leases, event=''):
+            if event and event.type == 'DELETED':
+                # The key has been deleted after existing before; terminate this watcher
+                # because this class instance is about to be reaped in Daemon.py
+                return False
+
+            if self.dhcp_leases != new_leases:
+                self.dhcp_leases = new_leases
+                # Push the changed leases into the DNS aggregator right away
+                if self.dhcp_server_daemon and self.dns_aggregator:
+                    self.dns_aggregator.sync_network(self)
 
         @self.zk_conn.ChildrenWatch('/networks/{}/firewall_rules/in'.format(self.vni))
         def watch_network_firewall_rules_in(new_rules, event=''):
@@ -365,7 +221,7 @@ add rule inet filter forward ip6 saddr {netaddr6} counter jump {vxlannic}-out
             # Don't run on the first pass
             if self.firewall_rules_in != new_rules:
                 self.firewall_rules_in = new_rules
-                self.updateFirewallRules()
+                self.queueFirewallRulesUpdate()
 
         @self.zk_conn.ChildrenWatch('/networks/{}/firewall_rules/out'.format(self.vni))
         def watch_network_firewall_rules_out(new_rules, event=''):
@@ -377,7 +233,7 @@ add rule inet filter forward ip6 saddr {netaddr6} counter jump {vxlannic}-out
             # Don't run on the first pass
             if self.firewall_rules_out != new_rules:
                 self.firewall_rules_out = new_rules
-                self.updateFirewallRules()
+                self.queueFirewallRulesUpdate()
 
         self.createNetworkManaged()
         self.createFirewall()
@@ -385,82 +241,209 @@ add rule inet filter forward ip6 saddr {netaddr6} counter jump {vxlannic}-out
     def getvni(self):
         return self.vni
 
+    # Apply the differences between the current and a new network configuration
+    def updateNetworkConfig(self, new_config):
+        old_config = self.network_config
+        changed = [field for field in new_config if new_config.get(field) != old_config.get(field)]
+        if not changed:
+            return
+        self.network_config = new_config
+
+        is_router = self.this_node.router_state in ['primary', 'takeover']
+        restart_dhcp = False
+
+        if 'description' in changed:
+            self.old_description = self.description
+            self.description = new_config['description']
+            restart_dhcp = True
+
+        if 'domain' in changed or 'name_servers' in changed:
+            if self.dhcp_server_daemon:
+                self.dns_aggregator.remove_network(self)
+            self.domain = new_config['domain']
+            self.name_servers = new_config['name_servers'].split(',')
+            if self.dhcp_server_daemon:
+                self.dns_aggregator.add_network(self)
+            restart_dhcp = True
+
+        if 'ip6_network' in changed:
+            self.ip6_network = new_config['ip6_network']
+            self.ip6_cidrnetmask = self.ip6_network.split('/')[-1]
+            restart_dhcp = True
+
+        if 'ip6_gateway' in changed:
+            if is_router and self.ip6_gateway:
+                self.removeGateway6Address()
+            self.ip6_gateway = new_config['ip6_gateway']
+            if is_router:
+                self.createGateway6Address()
+            restart_dhcp = True
+
+        if 'ip4_network' in changed:
+            self.ip4_network = new_config['ip4_network']
+            self.ip4_cidrnetmask = self.ip4_network.split('/')[-1]
+            restart_dhcp = True
+
+        if 'ip4_gateway' in changed:
+            if is_router and self.ip4_gateway:
+                self.removeGateway4Address()
+            self.ip4_gateway = new_config['ip4_gateway']
+            if is_router:
+                self.createGateway4Address()
+            restart_dhcp = True
+
+        if 'dhcp4_start' in changed or 'dhcp4_end' in changed:
+            self.dhcp4_start = new_config['dhcp4_start']
+            self.dhcp4_end = new_config['dhcp4_end']
+            restart_dhcp = True
+
+        # The firewall jumps depend on the addresses and gateways
+        if set(changed) & set(['ip6_network', 'ip6_gateway', 'ip4_network', 'ip4_gateway']):
+            self.queueFirewallRulesUpdate()
+
+        if 'dhcp6_flag' in changed or 'dhcp4_flag' in changed:
+            self.dhcp6_flag = (new_config['dhcp6_flag'] == 'True')
+            self.dhcp4_flag = (new_config['dhcp4_flag'] == 'True')
+            if (self.dhcp4_flag or self.dhcp6_flag) and not self.dhcp_server_daemon and is_router:
+                self.startDHCPServer()
+                restart_dhcp = False
+            elif self.dhcp_server_daemon and not self.dhcp4_flag and not self.dhcp6_flag and is_router:
+                self.stopDHCPServer()
+                restart_dhcp = False
+
+        # Restart the DHCP server once for all changes
+        if restart_dhcp and self.dhcp_server_daemon:
+            self.stopDHCPServer()
+            self.startDHCPServer()
+
     def updateDHCPReservations(self, old_reservations_list, new_reservations_list):
-        for reservation in new_reservations_list:
-            if reservation not in old_reservations_list:
-                # Add new reservation file
-                filename = '{}/{}'.format(self.dnsmasq_hostsdir, reservation)
-                ipaddr = zkhandler.readdata(
-                    self.zk_conn,
-                    '/networks/{}/dhcp4_reservations/{}/ipaddr'.format(
-                        self.vni,
-                        reservation
-                    )
-                )
-                entry = '{},{}'.format(reservation, ipaddr)
-                # Write the entry
-                with open(filename, 'w') as outfile:
-                    outfile.write(entry)
-
-        for reservation in old_reservations_list:
-            if reservation not in new_reservations_list:
-                # Remove old reservation file
-                filename = '{}/{}'.format(self.dnsmasq_hostsdir, reservation)
-                try:
-                    os.remove(filename)
-                    self.dhcp_server_daemon.signal('hup')
-                except Exception:
-                    pass
+        added_reservations = [reservation for reservation in new_reservations_list if reservation not in old_reservations_list]
+        removed_reservations = [reservation for reservation in old_reservations_list if reservation not in new_reservations_list]
+
+        # Read all new reservations in one batched read
+        reservation_keys = ['/networks/{}/dhcp4_reservations/{}'.format(self.vni, reservation) for reservation in added_reservations]
+        reservation_data = pvc_zkhandler.readdatamany(self.zk_conn, reservation_keys)
+
+        for reservation, key in zip(added_reservations, reservation_keys):
+            if reservation_data[key] is None:
+                continue
+            # Add new reservation file
+            filename = '{}/{}'.format(self.dnsmasq_hostsdir, reservation)
+            ipaddr = pvc_network.decodeDHCPLeaseData(self.zk_conn, self.vni, 'dhcp4_reservations', reservation, reservation_data[key]).get('ipaddr')
+            entry = '{},{}'.format(reservation, ipaddr)
+            # Write the entry
+            with open(filename, 'w') as outfile:
+                outfile.write(entry)
+
+        removed_count = 0
+        for reservation in removed_reservations:
+            # Remove old reservation file
+            filename = '{}/{}'.format(self.dnsmasq_hostsdir, reservation)
+            try:
+                os.remove(filename)
+                removed_count += 1
+            except Exception:
+                pass
+
+        # Added files are picked up by dnsmasq directly, but removals need a reload; send one for the whole batch
+        if removed_count > 0 and self.dhcp_server_daemon:
+            self.dhcp_server_daemon.signal('hup')
+
+    # Map element helpers; an element is added, deleted and re-added so that the
+    # transaction succeeds whether or not the element already exists
+    def firewallAddElement(self, nft_map, key, chain):
+        return dedent("""\
+            add element inet filter {nft_map} {{ {key} : jump {chain} }}
+            delete element inet filter {nft_map} {{ {key} }}
+            add element inet filter {nft_map} {{ {key} : jump {chain} }}
+            """).format(nft_map=nft_map, key=key, chain=chain)
+
+    def firewallRemoveElement(self, nft_map, key, chain):
+        return dedent("""\
+            add element inet filter {nft_map} {{ {key} : jump {chain} }}
+            delete element inet filter {nft_map} {{ {key} }}
+            """).format(nft_map=nft_map, key=key, chain=chain)
+
+    # Coalesce bursts of ACL changes into a single firewall update
+    def queueFirewallRulesUpdate(self):
+        with self.firewall_update_lock:
+            if self.firewall_update_timer is not None:
+                self.firewall_update_timer.cancel()
+            self.firewall_update_timer = Timer(self.firewall_update_delay, self.updateFirewallRules)
+            self.firewall_update_timer.start()
 
     def updateFirewallRules(self):
         if not self.ip4_network:
             return
 
-        self.logger.out(
-            'Updating firewall rules',
-            prefix='VNI {}'.format(self.vni),
-            state='o'
-        )
-        ordered_acls_in = {}
-        ordered_acls_out = {}
-        sorted_acl_list = {'in': [], 'out': []}
-        full_ordered_rules = []
-
-        for acl in self.firewall_rules_in:
-            order = zkhandler.readdata(self.zk_conn, '/networks/{}/firewall_rules/in/{}/order'.format(self.vni, acl))
-            ordered_acls_in[order] = acl
-        for acl in self.firewall_rules_out:
-            order = zkhandler.readdata(self.zk_conn, '/networks/{}/firewall_rules/out/{}/order'.format(self.vni, acl))
-            ordered_acls_out[order] = acl
-
-        for order in sorted(ordered_acls_in.keys()):
-            sorted_acl_list['in'].append(ordered_acls_in[order])
-        for order in sorted(ordered_acls_out.keys()):
-            sorted_acl_list['out'].append(ordered_acls_out[order])
-
-        for direction in 'in', 'out':
-            for acl in sorted_acl_list[direction]:
-                rule_prefix = "add rule inet filter vxlan{}-{} counter".format(self.vni, direction)
-                rule_data = zkhandler.readdata(self.zk_conn, '/networks/{}/firewall_rules/{}/{}/rule'.format(self.vni, direction, acl))
-                rule = '{} {}'.format(rule_prefix, rule_data)
-                full_ordered_rules.append(rule)
-
-        firewall_rules = self.firewall_rules_base
-        if self.ip6_gateway != 'None':
-            firewall_rules += self.firewall_rules_v6
-        if self.ip4_gateway != 'None':
-            firewall_rules += self.firewall_rules_v4
-
-        output = "{}\n# User rules\n{}\n".format(
-            firewall_rules,
-            '\n'.join(full_ordered_rules))
-
-        with open(self.nftables_netconf_filename, 'w') as nfnetfile:
-            nfnetfile.write(dedent(output))
-
-        # Reload firewall rules
-        nftables_base_filename = '{}/base.nft'.format(self.config['nft_dynamic_directory'])
-        common.reload_firewall_rules(self.logger, nftables_base_filename)
+        with self.firewall_lock:
+            if not self.firewall_active:
+                return
+
+            self.logger.out(
+                'Updating firewall rules',
+                prefix='VNI {}'.format(self.vni),
+                state='o'
+            )
+            sorted_acl_list = {'in': [], 'out': []}
+            full_ordered_rules = []
+
+            # Read the order and rule of every ACL in one batched read
+            acl_keys = list()
+            for direction in 'in', 'out':
+                for acl in getattr(self, 'firewall_rules_{}'.format(direction)):
+                    acl_keys.append('/networks/{}/firewall_rules/{}/{}/order'.format(self.vni, direction, acl))
+                    acl_keys.append('/networks/{}/firewall_rules/{}/{}/rule'.format(self.vni, direction, acl))
+            acl_data = pvc_zkhandler.readdatamany(self.zk_conn, acl_keys)
+
+            for direction in 'in', 'out':
+                ordered_acls = {}
+                for acl in getattr(self, 'firewall_rules_{}'.format(direction)):
+                    order = acl_data['/networks/{}/firewall_rules/{}/{}/order'.format(self.vni, direction, acl)]
+                    if order is None:
+                        # The ACL was removed since the list was read
+                        continue
+                    ordered_acls[order] = acl
+                for order in sorted(ordered_acls.keys()):
+                    sorted_acl_list[direction].append(ordered_acls[order])
+
+            for direction in 'in', 'out':
+                for acl in sorted_acl_list[direction]:
+                    rule_prefix = "add rule inet filter vxlan{}-{} counter".format(self.vni, direction)
+                    rule_data = acl_data['/networks/{}/firewall_rules/{}/{}/rule'.format(self.vni, direction, acl)]
+                    if rule_data is None:
+                        continue
+                    rule = '{} {}'.format(rule_prefix, rule_data)
+                    full_ordered_rules.append(rule)
+
+            # Jump from the input and forward chains to this network's chains
+            firewall_elements = [('network-input', '"{}"'.format(self.bridge_nic), '{}-input'.format(self.vxlan_nic))]
+            if self.ip6_gateway != 'None':
+                firewall_elements.append(('network-forward-in6', self.ip6_network, '{}-in'.format(self.vxlan_nic)))
+                firewall_elements.append(('network-forward-out6', self.ip6_network, '{}-out'.format(self.vxlan_nic)))
+            if self.ip4_gateway != 'None':
+                firewall_elements.append(('network-forward-in4', self.ip4_network, '{}-in'.format(self.vxlan_nic)))
+                firewall_elements.append(('network-forward-out4', self.ip4_network, '{}-out'.format(self.vxlan_nic)))
+
+            firewall_rules = self.firewall_rules_base
+            firewall_rules += '# Jump to this network\'s chains from the input and forward chains\n'
+            for element in self.firewall_elements:
+                # Remove any element left over from a since-changed address
+                if element not in firewall_elements:
+                    firewall_rules += self.firewallRemoveElement(*element)
+            for element in firewall_elements:
+                firewall_rules += self.firewallAddElement(*element)
+
+            output = "{}\n# User rules\n{}\n".format(
+                firewall_rules,
+                '\n'.join(full_ordered_rules))
+
+            with open(self.nftables_netconf_filename, 'w') as nfnetfile:
+                nfnetfile.write(dedent(output))
+
+            # Apply this network's rules as one transaction
+            if common.apply_firewall_rules(self.logger, self.nftables_netconf_filename, prefix='VNI {}'.format(self.vni)):
+                self.firewall_elements = firewall_elements
 
     # Create bridged network configuration
     def createNetworkBridged(self):
@@ -639,7 +622,8 @@ add rule inet filter forward ip6 saddr {netaddr6} counter jump {vxlannic}-out
             pvcnoded_config_file = os.environ['PVCD_CONFIG_FILE']
             dhcp_environment = {
                 'DNSMASQ_BRIDGE_INTERFACE': self.bridge_nic,
-                'PVCD_CONFIG_FILE': pvcnoded_config_file
+                'PVCD_CONFIG_FILE': pvcnoded_config_file,
+                'PVCD_LEASE_BROKER_SOCKET': self.config['dnsmasq_lease_socket']
             }
 
             # Define the dnsmasq config fragments
@@ -799,14 +783,37 @@ add rule inet filter forward ip6 saddr {netaddr6} counter jump {vxlannic}-out
             state='o'
         )
 
-        try:
-            os.remove(self.nftables_netconf_filename)
-        except Exception:
-            pass
-
-        # Reload firewall rules
-        nftables_base_filename = '{}/base.nft'.format(self.config['nft_dynamic_directory'])
-        common.reload_firewall_rules(self.logger, nftables_base_filename)
+        with self.firewall_update_lock:
+            if self.firewall_update_timer is not None:
+                self.firewall_update_timer.cancel()
+                self.firewall_update_timer = None
+
+        with self.firewall_lock:
+            self.firewall_active = False
+
+            try:
+                os.remove(self.nftables_netconf_filename)
+            except Exception:
+                pass
+
+            # Remove this network's map elements and chains as one transaction
+            firewall_rules = "# Remove rules for network {}\n".format(self.vxlan_nic)
+            for chain in 'input', 'in', 'out':
+                firewall_rules += "add chain inet filter {}-{}\n".format(self.vxlan_nic, chain)
+            for element in self.firewall_elements:
+                firewall_rules += self.firewallRemoveElement(*element)
+            for chain in 'input', 'in', 'out':
+                firewall_rules += "flush chain inet filter {}-{}\n".format(self.vxlan_nic, chain)
+                firewall_rules += "delete chain inet filter {}-{}\n".format(self.vxlan_nic, chain)
+
+            with open(self.nftables_remove_filename, 'w') as nfremovefile:
+                nfremovefile.write(firewall_rules)
+            common.apply_firewall_rules(self.logger, self.nftables_remove_filename, prefix='VNI {}'.format(self.vni))
+            try:
+                os.remove(self.nftables_remove_filename)
+            except Exception:
+                pass
+            self.firewall_elements = []
 
     def removeGateways(self):
         if self.nettype == 'managed':
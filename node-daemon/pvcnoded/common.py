@@ -112,6 +112,71 @@ def reload_firewall_rules(logger, rules_file):
         logger.out('Failed to reload configuration: {}'.format(stderr), state='e')
 
 
+# Apply a partial firewall rules file as a single atomic transaction
+def apply_firewall_rules(logger, rules_file, prefix=''):
+    retcode, stdout, stderr = run_os_command('/usr/sbin/nft -f {}'.format(rules_file))
+    if retcode != 0:
+        logger.out('Failed to apply firewall rules: {}'.format(stderr), state='e', prefix=prefix)
+    return retcode == 0
+
+
+# Watch a command queue, handling each new request in its own thread
+def watch_command_queue(zk_conn, queue, run_command):
+    handled_requests = set()
+
+    @zk_conn.ChildrenWatch('/cmd/{}'.format(queue))
+    def watch_requests(new_request_list):
+        # Forget requests that have been cleaned up
+        handled_requests.intersection_update(new_request_list)
+        for request in new_request_list:
+            if request in handled_requests:
+                continue
+            handled_requests.add(request)
+            request_key = '/cmd/{}/{}'.format(queue, request)
+            # Never rerun a request that already finished but was not cleaned up
+            if command_finished(zk_conn, request_key):
+                continue
+            data = zkhandler.readdata(zk_conn, request_key)
+            if not data:
+                continue
+            command_thread = Thread(target=run_command, args=(request_key, data), kwargs={})
+            command_thread.start()
+
+
+# Check whether a command request already has a result
+def command_finished(zk_conn, request_key):
+    try:
+        return zk_conn.exists('{}/result'.format(request_key)) is not None
+    except Exception:
+        return False
+
+
+# Claim a command request for this node; only one node can claim each request, and the
+# claim disappears if this node's Zookeeper session is lost. Requests that already have a
+# result are never claimed, since their claim may have vanished only because the node that
+# ran them restarted before the request was cleaned up.
+def claim_command(zk_conn, request_key, node_name):
+    if command_finished(zk_conn, request_key):
+        return False
+    try:
+        zk_conn.create('{}/node'.format(request_key), node_name.encode('ascii'), ephemeral=True)
+    except Exception:
+        return False
+    # The previous claimer may have recorded its result just before its claim disappeared
+    if command_finished(zk_conn, request_key):
+        try:
+            zk_conn.delete('{}/node'.format(request_key))
+        except Exception:
+            pass
+        return False
+    return True
+
+
+# Record the result of a claimed command request
+def finish_command(zk_conn, request_key, result):
+    zkhandler.writedata(zk_conn, {'{}/result'.format(request_key): 'success' if result else 'failure'})
+
+
 # Create IP address
 def createIPAddress(ipaddr, cidrnetmask, dev):
     run_os_command(
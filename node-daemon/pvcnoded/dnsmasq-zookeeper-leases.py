@@ -20,11 +20,11 @@
 #
 ###############################################################################
 import argparse
+import json
 import os
+import socket
 import sys
-import kazoo.client
 import re
-import yaml
 
 
 #
@@ -33,7 +33,7 @@ import yaml
 #
 # General Functions
 #
-def get_zookeeper_key():
+def get_network_vni():
     # Get the interface from environment (passed by dnsmasq)
     try:
         interface = os.environ['DNSMASQ_BRIDGE_INTERFACE']
@@ -42,8 +42,12 @@ def get_zookeeper_key():
         exit(1)
     # Get the ID of the interface (the digits)
     network_vni = re.findall(r'\d+', interface)[0]
+    return network_vni
+
+
+def get_zookeeper_key():
     # Create the key
-    zookeeper_key = '/networks/{}/dhcp4_leases'.format(network_vni)
+    zookeeper_key = '/networks/{}/dhcp4_leases'.format(get_network_vni())
     return zookeeper_key
 
 
@@ -63,7 +67,42 @@ def get_client_id():
     return client_id
 
 
+def broker_request(request):
+    # Send a request to the pvcnoded lease broker; returns None if the broker is unavailable
+    try:
+        socket_path = os.environ['PVCD_LEASE_BROKER_SOCKET']
+    except Exception:
+        return None
+    if not os.path.exists(socket_path):
+        return None
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as broker_socket:
+            broker_socket.settimeout(15)
+            broker_socket.connect(socket_path)
+            broker_socket.sendall((json.dumps(request) + '\n').encode('utf8'))
+            response_raw = b''
+            while not response_raw.endswith(b'\n'):
+                data = broker_socket.recv(65536)
+                if not data:
+                    break
+                response_raw += data
+        response = json.loads(response_raw.decode('utf8'))
+    except Exception as e:
+        print('Failed to contact lease broker: {}'.format(e), file=sys.stderr)
+        return None
+
+    if response.get('status') != 'ok':
+        print('Lease broker request failed: {}'.format(response.get('message')), file=sys.stderr)
+        return None
+    return response
+
+
 def connect_zookeeper():
+    # These are only needed if the lease broker is unavailable, so import them here
+    import kazoo.client
+    import yaml
+
     # We expect the environ to contain the config file
     try:
         pvcnoded_config_file = os.environ['PVCD_CONFIG_FILE']
@@ -93,6 +132,12 @@ def read_data(zk_conn, key):
 
 
 def get_lease(zk_conn, zk_leases_key, macaddr):
+    data = read_data(zk_conn, '{}/{}'.format(zk_leases_key, macaddr))
+    if data.startswith('{'):
+        lease_data = json.loads(data)
+        return lease_data['expiry'], lease_data['ipaddr'], lease_data['hostname'], lease_data['clientid']
+
+    # Old-format leases store each field in a child key
     expiry = read_data(zk_conn, '{}/{}/expiry'.format(zk_leases_key, macaddr))
     ipaddr = read_data(zk_conn, '{}/{}/ipaddr'.format(zk_leases_key, macaddr))
     hostname = read_data(zk_conn, '{}/{}/hostname'.format(zk_leases_key, macaddr))
@@ -119,13 +164,13 @@ def read_lease_database(zk_conn, zk_leases_key):
 def add_lease(zk_conn, zk_leases_key, expiry, macaddr, ipaddr, hostname, clientid):
     if not hostname:
         hostname = ''
-    transaction = zk_conn.transaction()
-    transaction.create('{}/{}'.format(zk_leases_key, macaddr), ''.encode('ascii'))
-    transaction.create('{}/{}/expiry'.format(zk_leases_key, macaddr), expiry.encode('ascii'))
-    transaction.create('{}/{}/ipaddr'.format(zk_leases_key, macaddr), ipaddr.encode('ascii'))
-    transaction.create('{}/{}/hostname'.format(zk_leases_key, macaddr), hostname.encode('ascii'))
-    transaction.create('{}/{}/clientid'.format(zk_leases_key, macaddr), clientid.encode('ascii'))
-    transaction.commit()
+    lease_data = {
+        'ipaddr': ipaddr,
+        'hostname': hostname,
+        'expiry': expiry,
+        'clientid': clientid
+    }
+    zk_conn.create('{}/{}'.format(zk_leases_key, macaddr), json.dumps(lease_data).encode('utf8'))
 
 
 def del_lease(zk_conn, zk_leases_key, macaddr, expiry):
@@ -147,10 +192,16 @@ macaddr = args.macaddr
 ipaddr = args.ipaddr
 hostname = args.hostname
 
-zk_conn = connect_zookeeper()
-zk_leases_key = get_zookeeper_key()
-
 if action == 'init':
+    response = broker_request({'action': 'init', 'vni': get_network_vni()})
+    if response is not None:
+        for data_string in response['leases']:
+            print('Reading lease from lease broker: {}'.format(data_string), file=sys.stderr)
+        print('\n'.join(response['leases']))
+        exit(0)
+
+    zk_conn = connect_zookeeper()
+    zk_leases_key = get_zookeeper_key()
     read_lease_database(zk_conn, zk_leases_key)
     exit(0)
 
@@ -161,9 +212,23 @@ clientid = get_client_id()
 # Choose action
 #
 print('Lease action - {} {} {} {}'.format(action, macaddr, ipaddr, hostname), file=sys.stderr)
-if action == 'add':
-    add_lease(zk_conn, zk_leases_key, expiry, macaddr, ipaddr, hostname, clientid)
-elif action == 'del':
-    del_lease(zk_conn, zk_leases_key, macaddr, expiry)
-elif action == 'old':
-    pass
+
+# Only add and del actions are stored; hand them off to the lease broker in pvcnoded
+# if it's running, otherwise write to Zookeeper directly
+if action in ['add', 'del']:
+    response = broker_request({
+        'action': action,
+        'vni': get_network_vni(),
+        'macaddr': macaddr,
+        'ipaddr': ipaddr,
+        'hostname': hostname,
+        'expiry': expiry,
+        'clientid': clientid
+    })
+    if response is None:
+        zk_conn = connect_zookeeper()
+        zk_leases_key = get_zookeeper_key()
+        if action == 'add':
+            add_lease(zk_conn, zk_leases_key, expiry, macaddr, ipaddr, hostname, clientid)
+        elif action == 'del':
+            del_lease(zk_conn, zk_leases_key, macaddr, expiry)
@@ -21,11 +21,20 @@
 ###############################################################################
 
 import time
+import lxml.objectify
+
+from concurrent.futures import ThreadPoolExecutor
 
 import pvcnoded.zkhandler as zkhandler
 import pvcnoded.common as common
 import pvcnoded.VMInstance as VMInstance
 
+import daemon_lib.common as daemon_common
+import daemon_lib.zkhandler as pvc_zkhandler
+
+# The maximum number of VMs recovered from a fenced node at once
+fence_recovery_workers = 8
+
 
 #
 # Fence thread entry function
@@ -39,8 +48,9 @@ def fenceNode(node_name, zk_conn, config, logger):
         time.sleep(config['keepalive_interval'])
         # Get the state
         node_daemon_state = zkhandler.readdata(zk_conn, '/nodes/{}/daemonstate'.format(node_name))
+        node_is_live = zk_conn.exists('/liveness/{}'.format(node_name)) is not None
         # Is it still 'dead'
-        if node_daemon_state == 'dead':
+        if node_daemon_state == 'dead' and not node_is_live:
             failcount += 1
             logger.out('Node "{}" failed {}/{} saving throws'.format(node_name, failcount, failcount_limit), state='w')
         # It changed back to something else so it must be alive
@@ -76,9 +86,70 @@ def fenceNode(node_name, zk_conn, config, logger):
         migrateFromFencedNode(zk_conn, node_name, config, logger)
 
 
+# Get a snapshot of the nodes which can accept VMs from a fenced node
+def getFenceTargetNodes(zk_conn, node_name):
+    node_fields = ['daemonstate', 'domainstate', 'memused', 'memfree', 'memprov', 'cpuload', 'vcpualloc', 'domainscount']
+
+    full_node_list = zkhandler.listchildren(zk_conn, '/nodes')
+    node_data = pvc_zkhandler.readdatamany(zk_conn, [
+        '/nodes/{}/{}'.format(node, field) for node in full_node_list for field in node_fields
+    ])
+
+    target_nodes = dict()
+    for node in full_node_list:
+        if node == node_name:
+            continue
+
+        data = {field: node_data['/nodes/{}/{}'.format(node, field)] for field in node_fields}
+        if data['daemonstate'] != 'run' or data['domainstate'] != 'ready':
+            continue
+
+        try:
+            target_nodes[node] = {
+                'memtotal': int(data['memused']) + int(data['memfree']),
+                'memprov': int(data['memprov']),
+                'cpuload': float(data['cpuload']),
+                'vcpualloc': int(data['vcpualloc']),
+                'domainscount': int(data['domainscount'])
+            }
+        except (TypeError, ValueError):
+            continue
+
+    return target_nodes
+
+
+# Select a target node from a node snapshot, and account for the VM on it
+def selectFenceTargetNode(target_nodes, node_limit, search_field, dom_memory, dom_vcpus):
+    candidates = [node for node in target_nodes if not node_limit or node in node_limit]
+    if not candidates:
+        return None
+
+    # Mirror the findTargetNode selectors, but against the in-memory snapshot
+    if search_field == 'load':
+        target_node = min(candidates, key=lambda node: target_nodes[node]['cpuload'])
+    elif search_field == 'vcpus':
+        target_node = min(candidates, key=lambda node: target_nodes[node]['vcpualloc'])
+    elif search_field == 'vms':
+        target_node = min(candidates, key=lambda node: target_nodes[node]['domainscount'])
+    else:
+        target_node = max(candidates, key=lambda node: target_nodes[node]['memtotal'] - target_nodes[node]['memprov'])
+        if target_nodes[target_node]['memtotal'] - target_nodes[target_node]['memprov'] <= 0:
+            return None
+
+    # Update the snapshot so that the next placement sees this VM; the load is
+    # assumed to grow by the VM's vCPU count, i.e. the worst case
+    target_nodes[target_node]['memprov'] += dom_memory
+    target_nodes[target_node]['cpuload'] += dom_vcpus
+    target_nodes[target_node]['vcpualloc'] += dom_vcpus
+    target_nodes[target_node]['domainscount'] += 1
+
+    return target_node
+
+
 # Migrate hosts away from a fenced node
 def migrateFromFencedNode(zk_conn, node_name, config, logger):
     logger.out('Migrating VMs from dead node "{}" to new hosts'.format(node_name), state='i')
+    recovery_start_time = time.time()
 
     # Get the list of VMs
     dead_node_running_domains = zkhandler.readdata(zk_conn, '/nodes/{}/runningdomains'.format(node_name)).split()
@@ -86,12 +157,54 @@ def migrateFromFencedNode(zk_conn, node_name, config, logger):
     # Set the node to a custom domainstate so we know what's happening
     zkhandler.writedata(zk_conn, {'/nodes/{}/domainstate'.format(node_name): 'fence-flush'})
 
+    # Get the placement information for all VMs at once
+    domain_fields = ['recovery_priority', 'node_limit', 'node_selector', 'xml']
+    domain_data = pvc_zkhandler.readdatamany(zk_conn, [
+        '/domains/{}/{}'.format(dom_uuid, field) for dom_uuid in dead_node_running_domains for field in domain_fields
+    ])
+
+    domains = list()
+    for dom_uuid in dead_node_running_domains:
+        data = {field: domain_data['/domains/{}/{}'.format(dom_uuid, field)] for field in domain_fields}
+
+        try:
+            recovery_priority = int(data['recovery_priority'])
+        except (TypeError, ValueError):
+            recovery_priority = 0
+
+        node_limit = [node for node in (data['node_limit'] or '').split(',') if node]
+
+        search_field = data['node_selector']
+        if search_field is None or search_field == 'None':
+            search_field = config['migration_target_selector']
+
+        try:
+            _duuid, _dname, _ddescription, dom_memory, dom_vcpus, _dvcputopo = daemon_common.getDomainMainDetails(lxml.objectify.fromstring(data['xml']))
+            dom_memory = int(dom_memory)
+            dom_vcpus = int(dom_vcpus)
+        except Exception:
+            dom_memory = 0
+            dom_vcpus = 0
+
+        domains.append((recovery_priority, dom_uuid, node_limit, search_field, dom_memory, dom_vcpus))
+
+    # Place every VM against a single node snapshot, highest recovery priority first
+    domains.sort(key=lambda domain: domain[0], reverse=True)
+    target_nodes = getFenceTargetNodes(zk_conn, node_name)
+    if config['debug']:
+        logger.out('Found nodes: {}'.format(list(target_nodes.keys())), state='d', prefix='node-flush')
+
+    placements = list()
+    for recovery_priority, dom_uuid, node_limit, search_field, dom_memory, dom_vcpus in domains:
+        target_node = selectFenceTargetNode(target_nodes, node_limit, search_field, dom_memory, dom_vcpus)
+        if config['debug']:
+            logger.out('Selected node {} for VM {} (priority {}, selector {})'.format(target_node, dom_uuid, recovery_priority, search_field), state='d', prefix='node-flush')
+        placements.append((dom_uuid, target_node))
+
     # Migrate a VM after a flush
-    def fence_migrate_vm(dom_uuid):
+    def fence_migrate_vm(dom_uuid, target_node):
         VMInstance.flush_locks(zk_conn, logger, dom_uuid)
 
-        target_node = common.findTargetNode(zk_conn, config, logger, dom_uuid)
-
         if target_node is not None:
             logger.out('Migrating VM "{}" to node "{}"'.format(dom_uuid, target_node), state='i')
             zkhandler.writedata(zk_conn, {
@@ -106,9 +219,19 @@ def migrateFromFencedNode(zk_conn, node_name, config, logger):
                 '/domains/{}/node_autostart'.format(dom_uuid): 'True'
             })
 
-    # Loop through the VMs
-    for dom_uuid in dead_node_running_domains:
-        fence_migrate_vm(dom_uuid)
+        return time.time() - recovery_start_time
+
+    # Recover the VMs in parallel; jobs start in submission (i.e. priority) order
+    with ThreadPoolExecutor(max_workers=fence_recovery_workers) as executor:
+        recovery_jobs = [(dom_uuid, executor.submit(fence_migrate_vm, dom_uuid, target_node)) for dom_uuid, target_node in placements]
+
+    # Report the recovery latency of each VM
+    for dom_uuid, recovery_job in recovery_jobs:
+        try:
+            logger.out('Recovered VM "{}" after {:.2f}s'.format(dom_uuid, recovery_job.result()), state='o')
+        except Exception as e:
+            logger.out('Failed to recover VM "{}": {}'.format(dom_uuid, e), state='e')
+    logger.out('Recovered {} VMs from dead node "{}" in {:.2f}s'.format(len(recovery_jobs), node_name, time.time() - recovery_start_time), state='o')
 
     # Set node in flushed state for easy remigrating when it comes back
     zkhandler.writedata(zk_conn, {'/nodes/{}/domainstate'.format(node_name): 'flushed'})
@@ -20,7 +20,13 @@
 #
 ###############################################################################
 
+import atexit
 import datetime
+import json
+import re
+
+from queue import Queue
+from threading import Thread
 
 
 class Logger(object):
@@ -66,6 +72,21 @@ class Logger(object):
         'x': {'colour': '', 'prompt': last_prompt}
     }
 
+    # Level names, used for the log_sampling configuration and JSON output
+    level_map = {
+        'o': 'ok',
+        'e': 'error',
+        'w': 'warning',
+        't': 'tick',
+        'i': 'info',
+        's': 'system',
+        'd': 'debug',
+        'x': 'none'
+    }
+
+    # ANSI escape sequence matcher, used to strip colours from JSON output
+    ansi_escape = re.compile(r'\x1b(\[.*?[@-~]|\].*?(\x07|\x1b\\))')
+
     # Initialization of instance
     def __init__(self, config):
         self.config = config
@@ -78,19 +99,81 @@ class Logger(object):
         self.last_colour = ''
         self.last_prompt = ''
 
+        # Per-level sampling rates (log 1 of every N messages at this level)
+        self.sample_rates = dict()
+        for level, rate in self.config.get('log_sampling', dict()).items():
+            for state, name in self.level_map.items():
+                if level == name and int(rate) > 1:
+                    self.sample_rates[state] = int(rate)
+        self.sample_counts = {state: 0 for state in self.sample_rates}
+
+        # Start the background writer thread if we're logging asynchronously
+        if self.config.get('log_async', False):
+            self.queue = Queue()
+            self.writer_thread = Thread(target=self.run_writer, args=(), kwargs={}, daemon=True)
+            self.writer_thread.start()
+            # Ensure any queued messages are written out when we exit
+            atexit.register(self.terminate)
+        else:
+            self.queue = None
+            self.writer_thread = None
+
     # Provide a hup function to close and reopen the writer
     def hup(self):
+        if self.queue is not None:
+            # Let the writer thread reopen the file between messages
+            self.queue.put(('hup', None))
+        else:
+            self.reopen()
+
+    def reopen(self):
         self.writer.close()
-        self.writer = open(self.logfile, 'a', buffering=0)
+        self.writer = open(self.logfile, 'a', buffering=1)
+
+    # Flush any queued messages and stop the writer thread
+    def terminate(self):
+        if self.queue is not None:
+            if self.writer_thread.is_alive():
+                self.queue.put(('stop', None))
+                self.writer_thread.join(timeout=5.0)
 
     # Output function
     def out(self, message, state=None, prefix=''):
+        # Drop sampled messages
+        if state in self.sample_rates:
+            self.sample_counts[state] += 1
+            if self.sample_counts[state] % self.sample_rates[state] != 1:
+                return
 
-        # Get the date
+        # Get the date now; formatting is deferred to the writer
+        date = datetime.datetime.now()
+
+        if self.queue is not None:
+            self.queue.put(('out', (message, state, prefix, date)))
+        else:
+            self.write(message, state, prefix, date)
+
+    # Background writer thread
+    def run_writer(self):
+        while True:
+            action, data = self.queue.get()
+            if action == 'out':
+                try:
+                    self.write(*data)
+                except Exception as e:
+                    print('Failed to write log message: {}'.format(e))
+            elif action == 'hup':
+                self.reopen()
+            elif action == 'stop':
+                break
+
+    # Format and write a message to the outputs
+    def write(self, message, state, prefix, date):
+        # Get the date string
         if self.config['log_dates']:
-            date = '{} - '.format(datetime.datetime.now().strftime('%Y/%m/%d %H:%M:%S.%f'))
+            datestr = '{} - '.format(date.strftime('%Y/%m/%d %H:%M:%S.%f'))
         else:
-            date = ''
+            datestr = ''
 
         # Get the format map
         if self.config['log_colours']:
@@ -103,7 +186,7 @@ class Logger(object):
         # Define an undefined state as 'x'; no date in these prompts
         if not state:
             state = 'x'
-            date = ''
+            datestr = ''
 
         # Get colour and prompt from the map
         colour = format_map[state]['colour']
@@ -111,18 +194,28 @@ class Logger(object):
 
         # Append space and separator to prefix
         if prefix != '':
-            prefix = prefix + ' - '
+            prefixstr = prefix + ' - '
+        else:
+            prefixstr = ''
 
         # Assemble message string
-        message = colour + prompt + endc + date + prefix + message
+        output = colour + prompt + endc + datestr + prefixstr + message
 
         # Log to stdout
         if self.config['stdout_logging']:
-            print(message)
+            print(output)
 
         # Log to file
         if self.config['file_logging']:
-            self.writer.write(message + '\n')
+            if self.config.get('log_format', 'text') == 'json':
+                self.writer.write(json.dumps({
+                    'time': date.isoformat(),
+                    'level': self.level_map[state],
+                    'prefix': prefix,
+                    'message': self.ansi_escape.sub('', message)
+                }) + '\n')
+            else:
+                self.writer.write(output + '\n')
 
         # Set last message variables
         self.last_colour = colour